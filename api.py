@@ -0,0 +1,307 @@
+"""Warbler's JSON API, version 1: /api/v1/...
+
+    GET /api/v1/timeline                the logged-in user's home timeline
+    GET /api/v1/users/<id>              a user's profile
+    GET /api/v1/users/<id>/messages     a user's messages
+    GET /api/v1/messages/<id>           one message
+    POST /api/v1/likes                  like and unlike many messages
+    POST /api/v1/follows                follow and unfollow many users
+
+Lists of messages are paginated like the HTML pages: pass the `before` (or
+`after`) cursor from one response to get the next older (or newer) page, and
+`limit` for the page size.
+
+Responses only carry the fields asked for, JSON:API style:
+
+    /api/v1/timeline?fields[messages]=id,text&fields[users]=username
+
+Each author is sent once per response, in "users" (keyed by id), rather
+than with every message. Rows are fetched as tuples of just the requested
+columns, so no ORM objects are built.
+"""
+
+import json
+
+from flask import Blueprint, abort, current_app, g, request
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, LikedMessage, Follows
+from pagination import get_page_args, paginate
+from timelines import home_timeline, update_inbox
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+}
+
+# `liked` (does the logged-in user like it) isn't a column of messages
+MESSAGE_FIELDS = [*MESSAGE_COLUMNS, 'liked']
+
+USER_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'followers_count': User.followers_count,
+    'following_count': User.following_count,
+    'likes_count': User.likes_count,
+}
+
+# What's sent about the author of a message, unless fields[users] is given
+AUTHOR_FIELDS = ['id', 'username', 'image_url']
+
+# Most messages one request may like (or unlike)
+MAX_BATCH = 100
+
+# Most users one request may follow (or unfollow), e.g. importing a graph
+MAX_FOLLOW_BATCH = 10_000
+
+
+def respond(payload, status=200):
+    """A compact JSON response."""
+
+    return current_app.response_class(
+        json.dumps(payload, separators=(",", ":"), ensure_ascii=False),
+        status=status,
+        mimetype="application/json")
+
+
+@api.errorhandler(HTTPException)
+def handle_http_error(error):
+    """Errors are JSON too: {"error": {"status": 404, "message": "..."}}"""
+
+    response = respond(dict(error=dict(status=error.code,
+                                       message=error.description)),
+                       status=error.code)
+
+    # (e.g. Retry-After, on a 429)
+    for name, value in error.get_headers():
+        if name.lower() != 'content-type':
+            response.headers[name] = value
+
+    return response
+
+
+def get_fields(kind, available, default):
+    """The fields asked for with ?fields[<kind>]=a,b (or `default`).
+
+    Responds with 400 for an unknown field.
+    """
+
+    value = request.args.get(f"fields[{kind}]")
+    if value is None:
+        return default
+
+    fields = [name for name in value.split(",") if name]
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        abort(400, f"Unknown {kind} fields: {', '.join(unknown)}")
+
+    return fields
+
+
+def isoformat(timestamp):
+    """Timestamps are stored in UTC."""
+
+    return timestamp.isoformat() + "Z"
+
+
+class MessageFields:
+    """The message and author fields asked for, and how to fetch them.
+
+    Rows of `query()` are (message id, user id, *message columns,
+    *author columns).
+    """
+
+    def __init__(self):
+        self.message_fields = get_fields(
+            'messages', MESSAGE_FIELDS, MESSAGE_FIELDS)
+        self.user_fields = get_fields('users', USER_COLUMNS, AUTHOR_FIELDS)
+
+        self.columns = [name for name in self.message_fields
+                        if name in MESSAGE_COLUMNS]
+        self.liked = 'liked' in self.message_fields and g.viewer is not None
+
+    def query(self):
+        """A query of the columns to fetch, to filter and paginate."""
+
+        return (db.session
+                .query(Message.id, Message.user_id,
+                       *[MESSAGE_COLUMNS[name] for name in self.columns],
+                       *[USER_COLUMNS[name] for name in self.user_fields])
+                .join(User, User.id == Message.user_id))
+
+    def serialize(self, rows):
+        """Turn rows into (messages, users) for a response."""
+
+        liked_ids = set()
+        if self.liked:
+            liked_ids = LikedMessage.liked_ids(g.viewer.id,
+                                               [row[0] for row in rows])
+
+        end = 2 + len(self.columns)
+        has_timestamp = 'timestamp' in self.columns
+        messages = []
+        users = {}
+
+        for row in rows:
+            message = dict(zip(self.columns, row[2:end]))
+            if has_timestamp:
+                message['timestamp'] = isoformat(message['timestamp'])
+            if self.liked:
+                message['liked'] = row[0] in liked_ids
+            messages.append(message)
+
+            if self.user_fields and row[1] not in users:
+                users[row[1]] = dict(zip(self.user_fields, row[end:]))
+
+        return messages, users
+
+    def respond(self, page):
+        """A response with a page of rows."""
+
+        messages, users = self.serialize(page.items)
+
+        return respond(dict(messages=messages, users=users,
+                            before=page.before, after=page.after))
+
+
+@api.get('/timeline')
+def timeline():
+    """Messages of the logged-in user and everyone they follow."""
+
+    if not g.viewer:
+        abort(401)
+
+    fields = MessageFields()
+    before, after, per_page = get_page_args()
+    page = home_timeline(fields.query(), g.viewer.id,
+                         before=before, after=after, per_page=per_page)
+
+    return fields.respond(page)
+
+
+@api.get('/users/<int:user_id>')
+def user(user_id):
+    """A user's profile."""
+
+    fields = get_fields('users', USER_COLUMNS, list(USER_COLUMNS)) or ['id']
+
+    row = (db.session
+           .query(*[USER_COLUMNS[name] for name in fields])
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        abort(404)
+
+    return respond(dict(user=dict(zip(fields, row))))
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages."""
+
+    if not db.session.query(User.id).filter(User.id == user_id).first():
+        abort(404)
+
+    fields = MessageFields()
+    before, after, per_page = get_page_args()
+    page = paginate(fields.query().filter(Message.user_id == user_id),
+                    Message.timestamp, Message.id,
+                    before=before, after=after, per_page=per_page)
+
+    return fields.respond(page)
+
+
+@api.get('/messages/<int:message_id>')
+def message(message_id):
+    """One message."""
+
+    fields = MessageFields()
+    row = fields.query().filter(Message.id == message_id).first()
+    if row is None:
+        abort(404)
+
+    [message], users = fields.serialize([row])
+    return respond(dict(message=message, users=users))
+
+
+def get_id_lists(names, limit):
+    """Lists of ids from a JSON body, e.g. {"like": [1, 2], "unlike": [3]}.
+
+    Returns a dict with a (possibly empty) list for each of `names`.
+    Responds with 415 for a body that isn't JSON and 400 for a bad list.
+
+    Only JSON is accepted, which browsers won't send cross-site unless we
+    allow it (CORS), so no CSRF token is needed.
+    """
+
+    if not request.is_json:
+        abort(415)
+
+    body = request.get_json()
+    lists = {}
+
+    for name in names:
+        ids = body.get(name, []) if isinstance(body, dict) else None
+
+        if (not isinstance(ids, list)
+                or len(ids) > limit
+                or not all(type(id) is int for id in ids)):
+            abort(400, f"{name} must be a list of at most {limit} ids")
+
+        lists[name] = ids
+
+    return lists
+
+
+@api.post('/likes')
+def change_likes():
+    """Like and unlike many messages at once, for the logged-in user.
+
+    Takes {"like": [message ids], "unlike": [message ids]} (unlikes are
+    applied after likes). Responds with how many messages were newly liked
+    and unliked.
+    """
+
+    if not g.viewer:
+        abort(401)
+
+    changes = get_id_lists(['like', 'unlike'], MAX_BATCH)
+
+    liked = LikedMessage.like(g.viewer.id, changes['like'])
+    unliked = LikedMessage.unlike(g.viewer.id, changes['unlike'])
+    db.session.commit()
+
+    return respond(dict(liked=liked, unliked=unliked))
+
+
+@api.post('/follows')
+def change_follows():
+    """Follow and unfollow many users at once, for the logged-in user.
+
+    Takes {"follow": [user ids], "unfollow": [user ids]} (unfollows are
+    applied after follows), in one transaction. Responds with how many
+    users were newly followed and unfollowed.
+    """
+
+    if not g.viewer:
+        abort(401)
+
+    changes = get_id_lists(['follow', 'unfollow'], MAX_FOLLOW_BATCH)
+
+    followed_ids = Follows.follow(g.viewer.id, changes['follow'])
+    unfollowed_ids = Follows.unfollow(g.viewer.id, changes['unfollow'])
+    update_inbox(g.viewer.id, followed_ids=followed_ids,
+                 unfollowed_ids=unfollowed_ids)
+    db.session.commit()
+
+    return respond(dict(followed=len(followed_ids),
+                        unfollowed=len(unfollowed_ids)))
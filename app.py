@@ -1,75 +1,412 @@
+import hashlib
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import tempfile
+import time
+from datetime import datetime
+from glob import glob
+
+import click
+
+from flask import (
+    Blueprint, Flask, current_app, render_template, request, flash, redirect,
+    session, g, jsonify)
+from markupsafe import Markup
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, raiseload
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from forms import OnlyCsrfForm, UserAddForm, LoginForm, MessageForm, UpdateUserForm
-from models import db, connect_db, User, Message, LikedMessage
+from models import (
+    db, connect_db, User, Message, LikedMessage, Follows, TimelineEntry)
+from pagination import get_page_args, paginate
+from timelines import home_timeline, update_inbox
+from passwords import PasswordHasherBusy
+from metrics import Metrics
+from traffic import TrafficRecorder
+from replicas import ReplicaRouter
+from fragment_cache import FragmentCache
+from sessions import FileSessions
+from ratelimit import RateLimiter, parse_rate_limits
+from assets import Assets, build as build_assets
+from api import api
+from migrations import create_db, migrate
+from jobs import (fan_out_message, purge_user, job_counts,
+                  run_pending, run_workers, parse_concurrency)
+from search import search_users, autocomplete_usernames, create_search_indexes
 
 import dotenv
-dotenv.load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# The pages, hooks and commands; create_app() installs them on an app
+warbler = Blueprint('warbler', __name__, cli_group=None)
+
+# Extensions, bound to the app by create_app()
+replica_router = ReplicaRouter()
+metrics = Metrics()
+traffic = TrafficRecorder(session_key=CURR_USER_KEY)
+fragment_cache = FragmentCache()
+assets = Assets()
+session_store = FileSessions(session_key=CURR_USER_KEY)
+rate_limiter = RateLimiter(session_key=CURR_USER_KEY)
+
+
+def create_app(config=None):
+    """Create the Warbler app, configured from the environment (and .env).
+
+    `config` overrides settings, e.g. for tests. Nothing here connects to
+    the database, which is done lazily on first use; create the tables with
+    `flask create-db`.
+    """
+
+    dotenv.load_dotenv()
+
+    app = Flask(__name__)
+    app.app_ctx_globals_class = Globals
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+
+    # GET requests read from this replica, if set; see replicas.py
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': os.environ['DATABASE_REPLICA_URL'].replace(
+                "postgres://", "postgresql://")}
+    app.config['REPLICA_PIN_SECONDS'] = float(
+        os.environ.get('REPLICA_PIN_SECONDS', 10))
+
+    # Connection pool settings, for every engine (e.g. DB_POOL_SIZE=10)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        option: int(os.environ[name])
+        for option, name in [('pool_size', 'DB_POOL_SIZE'),
+                             ('max_overflow', 'DB_MAX_OVERFLOW'),
+                             ('pool_timeout', 'DB_POOL_TIMEOUT'),
+                             ('pool_recycle', 'DB_POOL_RECYCLE')]
+        if name in os.environ
+    }
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_pre_ping'] = (
+        os.environ.get('DB_POOL_PRE_PING') == '1')
+
+    # Push-model home timelines: when on, messages are fanned out to followers'
+    # inboxes at post time and the home page reads a single inbox
+    app.config['TIMELINE_FANOUT'] = os.environ.get('TIMELINE_FANOUT') == '1'
+    app.config['TIMELINE_INBOX_SIZE'] = int(
+        os.environ.get('TIMELINE_INBOX_SIZE', 500))
+
+    # Timelines are paginated by cursor; clients may ask for up to the max
+    # per page
+    app.config['MESSAGES_PER_PAGE'] = int(
+        os.environ.get('MESSAGES_PER_PAGE', 20))
+    app.config['MAX_MESSAGES_PER_PAGE'] = 100
+    app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 24))
+
+    # In strict mode, listing queries raise instead of lazy-loading anything
+    # they didn't ask for up front (catches N+1 queries in development)
+    app.config['STRICT_LOADING'] = os.environ.get('STRICT_LOADING') == '1'
+
+    # Memory cap for the cache of rendered timeline messages
+    app.config['FRAGMENT_CACHE_BYTES'] = int(
+        os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+
+    # Share /metrics between gunicorn workers through this directory, if set
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+    # bcrypt work factor; existing hashes are upgraded as their users log in
+    app.config['BCRYPT_LOG_ROUNDS'] = int(
+        os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['PASSWORD_HASH_WORKERS'] = int(
+        os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+
+    # Admission control (see ratelimit.py): token buckets per client IP and
+    # per user for posts to these endpoints, as requests/seconds, and a cap
+    # on bcrypt operations at once across every process on the host. The
+    # shared state is kept in files in RATE_LIMIT_DIR.
+    app.config['RATE_LIMIT_DIR'] = os.environ.get(
+        'RATE_LIMIT_DIR',
+        os.path.join(tempfile.gettempdir(), "warbler-rate-limits"))
+    app.config['RATE_LIMITS'] = parse_rate_limits(os.environ.get(
+        'RATE_LIMITS',
+        "warbler.login=10/60,warbler.signup=5/60,"
+        "warbler.edit_user_profile=10/60,warbler.messages_add=30/60"))
+    app.config['PASSWORD_HASH_CONCURRENCY'] = int(
+        os.environ.get('PASSWORD_HASH_CONCURRENCY', 2 * (os.cpu_count() or 1)))
+    app.config['PASSWORD_HASH_LOCK_FILE'] = os.path.join(
+        app.config['RATE_LIMIT_DIR'], "password-hashing")
+
+    # Proxies (e.g. a load balancer) in front of the app whose
+    # X-Forwarded-For is trusted, so clients are told apart by their own IP
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+    # Background jobs (see jobs.py): processes per queue for `flask worker`,
+    # seconds between polls of an empty queue, base delay before a retry,
+    # and how long finished jobs with an idempotency key are kept
+    app.config['JOB_CONCURRENCY'] = parse_concurrency(
+        os.environ.get('JOB_CONCURRENCY', "timelines=2,purges=1"))
+    app.config['JOB_POLL_INTERVAL'] = float(
+        os.environ.get('JOB_POLL_INTERVAL', 1))
+    app.config['JOB_RETRY_DELAY'] = float(
+        os.environ.get('JOB_RETRY_DELAY', 10))
+    app.config['JOB_KEEP_SECONDS'] = int(
+        os.environ.get('JOB_KEEP_SECONDS', 24 * 60 * 60))
+
+    # Record every request to this file, for replaying as a load test
+    app.config['TRAFFIC_LOG'] = os.environ.get('TRAFFIC_LOG')
+
+    # Sessions are kept server-side, in files in this directory, which every
+    # web process must share (see sessions.py)
+    app.config['SESSION_DIR'] = os.environ.get(
+        'SESSION_DIR', os.path.join(tempfile.gettempdir(), "warbler-sessions"))
+    # Seconds an anonymous session (e.g. a CSRF token) is kept unused
+    app.config['SESSION_ANONYMOUS_LIFETIME'] = int(
+        os.environ.get('SESSION_ANONYMOUS_LIFETIME', 60 * 60))
+
+    # Only ever turned off to replay recorded traffic against a local server
+    app.config['WTF_CSRF_ENABLED'] = os.environ.get('WTF_CSRF_ENABLED') != '0'
+
+    app.config.update(config or {})
+    app.config['TEMPLATES_VERSION'] = templates_version(app)
+
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['TRUSTED_PROXIES'])
+
+    if app.debug:
+        # development only (and slow to import)
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+
+    replica_router.init_app(app, db)
+    metrics.init_app(app)
+    metrics.add_gauge('warbler_jobs', job_counts)
+    traffic.init_app(app)
+    fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+    assets.init_app(app)
+    session_store.init_app(app)
+    rate_limiter.init_app(app)
+
+    app.register_blueprint(warbler)
+    app.register_blueprint(api)
+
+    return app
+
+
+class Globals(Flask.app_ctx_globals_class):
+    """Flask global, loading the current user's full row on first use.
+
+    `g.viewer` (see add_user_to_g) is all most pages need; `g.user`, the
+    logged-in User (or None), is only queried by pages that touch it.
+    """
+
+    def __getattr__(self, name):
+        if name != 'user':
+            return super().__getattr__(name)
+
+        viewer = self.get('viewer')
+        self.user = User.query.get(viewer.id) if viewer else None
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+        return self.user
 
-connect_db(app)
-db.create_all()
 
 ##############################################################################
 # User signup/login/logout
 
+# Static files don't need the user, forms or session
+STATIC_ENDPOINTS = {'static', 'assets'}
 
-@app.before_request
+
+@warbler.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add a snapshot of curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    `g.viewer` has their id, username and image_url, from the session store
+    (see sessions.py); `g.user` loads the rest when first used.
+    """
+
+    if request.endpoint in STATIC_ENDPOINTS:
+        g.viewer = None
+
+    elif CURR_USER_KEY in session:
+        g.viewer = session_store.viewer(session[CURR_USER_KEY])
+
+        if g.viewer is None:
+            # not cached: load the whole user now, and cache their snapshot
+            g.user = User.query.get(session[CURR_USER_KEY])
+            g.viewer = g.user and session_store.cache_viewer(g.user)
 
     else:
-        g.user = None
+        g.viewer = None
 
 
-@app.before_request
+@warbler.before_app_request
 def add_forms():
     """Provide html with necessary forms via Flask global"""
 
-    g.csrf_form = OnlyCsrfForm()
+    # (the JSON API has no forms)
+    if (request.endpoint not in STATIC_ENDPOINTS
+            and request.blueprint != 'api'):
+        g.csrf_form = OnlyCsrfForm()
+
 
+def load_liked_message_ids(messages):
+    """Put the ids of `messages` the current user likes on Flask global.
+
+    Templates use `g.liked_message_ids` to decide which star to show.
+    """
 
-@app.before_request
-def get_liked_messages():
-    """If we're logged in, add current user liked messages to Flask global."""
-    # if CURR_USER_KEY in session:
-    #     g.user = User.query.get(session[CURR_USER_KEY])
-    if g.user:
-        g.liked_message_ids = [message.id for message in g.user.liked_messages]
+    if g.viewer:
+        g.liked_message_ids = LikedMessage.liked_ids(
+            g.viewer.id, [message.id for message in messages])
+    else:
+        g.liked_message_ids = set()
+
+
+def loading(*options):
+    """Loader options for a listing query.
+
+    Pass the eager loads the page needs, e.g. `loading(joinedload(Message.user))`.
+    In strict mode everything else is set to raise when touched.
+    """
+
+    if current_app.config['STRICT_LOADING']:
+        return [*options, raiseload('*')]
+
+    return list(options)
+
+
+STAR_PLACEHOLDER = Markup("<!--star-->")
+
+STAR_FORM = Markup(
+    '<form action="/messages/{id}/{action}" method="POST">{csrf}'
+    '<button class=\'btn btn-light\'><i class="{icon} fa-star"></i></button>'
+    '</form>')
+
+
+@warbler.app_template_global()
+def render_message(msg):
+    """Render a message for a timeline, from the fragment cache if we can.
+
+    The cached markup is the same for every viewer; the like/unlike star,
+    which depends on the viewer (and carries their CSRF token), is added
+    afterwards. Needs `g.liked_message_ids` (see load_liked_message_ids).
+    """
+
+    key = (msg.id, msg.user.profile_version)
+    html = fragment_cache.get(key)
+
+    if html is None:
+        html = current_app.jinja_env.get_template('messages/item.html').render(
+            msg=msg, STAR_PLACEHOLDER=STAR_PLACEHOLDER)
+        fragment_cache.set(key, html)
+
+    if g.viewer and msg.user_id == g.viewer.id:
+        star = ""
+    else:
+        if 'csrf_tag' not in g:
+            g.csrf_tag = g.csrf_form.hidden_tag()
+
+        liked = msg.id in g.liked_message_ids
+        star = STAR_FORM.format(id=msg.id,
+                                action="unlike" if liked else "like",
+                                icon="fas" if liked else "far",
+                                csrf=g.csrf_tag)
+
+    return Markup(html.replace(STAR_PLACEHOLDER, star))
+
+
+def load_follow_states(users):
+    """Put follow state between the current user and `users` on Flask global.
+
+    `g.following_ids` holds the ids the current user follows and
+    `g.follower_ids` the ids following them, so user grids can check each
+    card without a query per card.
+    """
+
+    if g.viewer:
+        g.following_ids, g.follower_ids = Follows.states(
+            g.viewer.id, [user.id for user in users])
+    else:
+        g.following_ids, g.follower_ids = set(), set()
+
+
+def templates_version(app):
+    """Fingerprint of the templates, so deploying new ones changes ETags."""
+
+    digest = hashlib.sha1()
+    for path in sorted(glob(os.path.join(app.root_path, app.template_folder,
+                                         "**", "*.html"), recursive=True)):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def not_modified(*versions, last_modified=None):
+    """Check the browser's cached copy of this page against its versions.
+
+    `versions` are whatever the page shows that can change (row versions,
+    ids); the viewer's own version is added here. Returns a 304 response if
+    the browser's copy is still current: return it instead of rendering.
+    Otherwise returns None, and the page's response gets an ETag and
+    Last-Modified (see add_header).
+    """
+
+    if '_flashes' in session:
+        return None
+
+    # Pages carry CSRF tokens, which expire: have browsers fetch a fresh
+    # copy at least every half token lifetime
+    csrf_period = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 0
+    csrf_epoch = int(time.time() // (csrf_period / 2)) if csrf_period else 0
+
+    # (just the viewer's row version, unless their row is loaded already)
+    viewer = g.viewer and (
+        db.session.identity_map.get(identity_key(User, g.viewer.id))
+        or (db.session
+            .query(User.id, User.version, User.updated_at)
+            .filter(User.id == g.viewer.id)
+            .first()))
+    validators = repr((current_app.config['TEMPLATES_VERSION'],
+                       request.full_path,
+                       (viewer.id, viewer.version) if viewer else None,
+                       csrf_epoch, versions))
+    g.etag = hashlib.sha1(validators.encode()).hexdigest()
+
+    times = [last_modified, viewer.updated_at if viewer else None]
+    g.last_modified = max([t for t in times if t], default=None)
+
+    response = current_app.response_class(status=200)
+    response.set_etag(g.etag)
+    response.last_modified = g.last_modified
+    response.make_conditional(request)
+
+    return response if response.status_code == 304 else None
 
 
 def do_login(user):
-    """Log in user."""
+    """Log in user (under a new session id)."""
 
+    session.regenerate()
     session[CURR_USER_KEY] = user.id
 
 
 def do_logout():
-    """Logout user."""
+    """Logout user (under a new session id)."""
 
     if CURR_USER_KEY in session:
+        session.regenerate()
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@warbler.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -105,7 +442,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@warbler.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -116,6 +453,7 @@ def login():
                                  form.password.data)
 
         if user:
+            db.session.commit()  # in case the password hash was upgraded
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,7 +463,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@warbler.post('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -144,93 +482,148 @@ def logout():
 # General user routes:
 
 
-@app.get('/users')
+@warbler.get('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames and bios
+    (best matches first), and a 'page' param.
     """
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['USERS_PER_PAGE']
 
     if not search:
-        users = User.query.all()
+        users = (User.query
+                 .order_by(User.id)
+                 .offset((page - 1) * per_page)
+                 .limit(per_page + 1)
+                 .all())
+        has_next = len(users) > per_page
+        users = users[:per_page]
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_next = search_users(search, page=page, per_page=per_page)
+
+    load_follow_states(users)
+
+    return render_template('users/index.html',
+                           users=users,
+                           page=page,
+                           has_next=has_next)
+
+
+@warbler.get('/users/autocomplete')
+def autocomplete_users():
+    """Return JSON of users whose username starts with the 'q' param.
+
+    Returns JSON like:
+        {users: [{id, username, image_url}, ...]}
+    """
+
+    users = autocomplete_usernames(request.args.get('q', ''))
 
-    return render_template('users/index.html', users=users)
+    return jsonify(users=[
+        dict(id=user.id, username=user.username, image_url=user.image_url)
+        for user in users])
 
 
-@app.get('/users/<int:user_id>')
+@warbler.get('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
-    number_of_likes = LikedMessage.query.filter(
-        LikedMessage.user_id == user_id).count()
+
+    response = not_modified(user.version, last_modified=user.updated_at)
+    if response:
+        return response
+
+    before, after, per_page = get_page_args()
+    messages = paginate(Message
+                        .query
+                        .options(*loading(joinedload(Message.user)))
+                        .filter(Message.user_id == user_id),
+                        Message.timestamp, Message.id,
+                        before=before, after=after, per_page=per_page)
+
+    load_liked_message_ids(messages)
+    load_follow_states([user])
 
     return render_template('users/show.html',
                            user=user,
-                           number_of_likes=number_of_likes)
+                           messages=messages)
 
 
-@app.get('/users/<int:user_id>/following')
+@warbler.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     user = User.query.get_or_404(user_id)
+    load_follow_states([user, *user.following])
+
     return render_template('users/following.html', user=user)
 
 
-@app.get('/users/<int:user_id>/followers')
+@warbler.get('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    load_follow_states([user, *user.followers])
+
     return render_template('users/followers.html', user=user)
 
 
-@app.post('/users/follow/<int:follow_id>')
+@warbler.post('/users/follow/<int:follow_id>')
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    Following someone already followed does nothing.
+    """
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_ids = Follows.follow(g.viewer.id, [follow_id])
+    if not followed_ids:
+        User.query.get_or_404(follow_id)
+
+    update_inbox(g.viewer.id, followed_ids=followed_ids)
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{g.viewer.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@warbler.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    unfollowed_ids = Follows.unfollow(g.viewer.id, [follow_id])
+    if not unfollowed_ids:
+        User.query.get_or_404(follow_id)
+
+    update_inbox(g.viewer.id, unfollowed_ids=unfollowed_ids)
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{g.viewer.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@warbler.route('/users/profile', methods=["GET", "POST"])
 def edit_user_profile():
     """Update profile for current user."""
-    if not g.user:
+    if not g.viewer:
         return redirect("/")
 
     form = UpdateUserForm(obj=g.user)
@@ -245,9 +638,14 @@ def edit_user_profile():
             user.image_url = form.image_url.data or User.image_url.default.arg
             user.header_image_url = form.header_image_url.data or User.header_image_url.default.arg
             user.bio = form.bio.data
+            user.profile_version = User.profile_version + 1
+            user.version = User.version + 1
+            user.updated_at = datetime.utcnow()
 
             db.session.commit()
-            return redirect(f"/users/{g.user.id}")
+            session_store.forget_viewer(user.id)
+
+            return redirect(f"/users/{user.id}")
 
         flash("Invalid credentials to edit user")
         return redirect("/")
@@ -256,20 +654,23 @@ def edit_user_profile():
         return render_template("users/edit.html", form=form)
 
 
-@app.post('/users/delete')
+@warbler.post('/users/delete')
 def delete_user():
     """Delete user."""
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     form = OnlyCsrfForm()
 
-    if form.validate_on_submit:
+    if form.validate_on_submit():
         do_logout()
 
-        db.session.delete(g.user)
+        # Hidden from now on; their rows are purged in the background
+        g.user.deleted_at = datetime.utcnow()
+        purge_user.enqueue(user_id=g.user.id, key=f"purge-user-{g.user.id}")
         db.session.commit()
+        session_store.forget_viewer(g.user.id)
 
         return redirect("/signup")
     else:
@@ -280,91 +681,136 @@ def delete_user():
 # Messages routes:
 
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@warbler.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.viewer.id)
+        db.session.add(msg)
+        User.adjust_counters(g.viewer.id, messages_count=1)
+
+        if current_app.config['TIMELINE_FANOUT']:
+            db.session.flush()
+            fan_out_message.enqueue(
+                message_id=msg.id,
+                size=current_app.config['TIMELINE_INBOX_SIZE'])
+
         db.session.commit()
 
-        return redirect(f"/users/{g.user.id}")
+        return redirect(f"/users/{g.viewer.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@warbler.get('/messages/<int:message_id>')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = (Message
+           .query
+           .options(*loading(joinedload(Message.user)))
+           .get_or_404(message_id))
+
+    response = not_modified(
+        msg.id, msg.user.version,
+        last_modified=max(msg.timestamp, msg.user.updated_at))
+    if response:
+        return response
+
+    load_liked_message_ids([msg])
+    load_follow_states([msg.user])
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@warbler.post('/messages/<int:message_id>/delete')
 def messages_destroy(message_id):
     """Delete a message."""
 
-    if not g.user:
+    if not g.viewer:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    User.adjust_counters(msg.user_id, messages_count=-1)
+    User.adjust_counters(
+        select(LikedMessage.user_id)
+        .where(LikedMessage.message_id == msg.id),
+        likes_count=-1)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.invalidate(message_id)
 
-    return redirect(f"/users/{g.user.id}")
+    return redirect(f"/users/{g.viewer.id}")
 
 
-@app.post('/messages/<int:message_id>/like')
+@warbler.post('/messages/<int:message_id>/like')
 def add_liked_message(message_id):
-    """Add a message to user's liked list"""
-    if g.user:
-        form = OnlyCsrfForm()
-        if form.validate_on_submit:
-            message = Message.query.get_or_404(message_id)
-            if message.user_id != g.user.id:
-                g.user.liked_messages.append(message)
-
-                db.session.commit()
-                return redirect('/')
-    flash("Access unauthorized.", "danger")
-    return redirect('/')
+    """Add a message to user's liked list (liking it again does nothing)."""
+
+    return change_like(message_id, LikedMessage.like)
 
 
-@app.post('/messages/<int:message_id>/unlike')
+@warbler.post('/messages/<int:message_id>/unlike')
 def remove_liked_message(message_id):
     """Remove a message from user's liked list"""
-    if g.user:
-        form = OnlyCsrfForm()
 
-        if form.validate_on_submit:
-            message = Message.query.get_or_404(message_id)
-            if message.user_id != g.user.id:
-                g.user.liked_messages.remove(message)
+    return change_like(message_id, LikedMessage.unlike)
+
+
+def change_like(message_id, change):
+    """Like or unlike a message for the current user, then go home."""
+
+    form = OnlyCsrfForm()
+
+    if not g.viewer or not form.validate_on_submit():
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    if not change(g.viewer.id, [message_id]):
+        # nothing changed: 404 if that's because there's no such message
+        Message.query.get_or_404(message_id)
 
-                db.session.commit()
-                return redirect('/')
+    db.session.commit()
 
-    flash("Access unauthorized.", "danger")
     return redirect('/')
 
 
-@app.get("/users/<int:user_id>/likes")
+@warbler.get("/users/<int:user_id>/likes")
 def render_likes(user_id):
     """Renders a list of user's liked messages"""
     user = User.query.get_or_404(user_id)
-    likes = user.liked_messages
+
+    before, after, per_page = get_page_args()
+    likes = paginate(Message
+                     .query
+                     .options(*loading(joinedload(Message.user)))
+                     .join(LikedMessage,
+                           LikedMessage.message_id == Message.id)
+                     .filter(LikedMessage.user_id == user_id),
+                     LikedMessage.timestamp, LikedMessage.message_id,
+                     before=before, after=after, per_page=per_page)
+
+    # authors' profiles are shown too
+    response = not_modified(
+        user.version,
+        [(msg.id, msg.user.profile_version) for msg in likes.items],
+        last_modified=user.updated_at)
+    if response:
+        return response
+
+    load_liked_message_ids(likes)
+
     return render_template("messages/likes.html", likes=likes, user=user)
 
 
@@ -372,29 +818,145 @@ def render_likes(user_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@warbler.get('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, one page at a time
+      (see timelines.py)
     """
 
-    if g.user:
+    if not g.viewer:
+        return render_template('home-anon.html')
 
-        self_and_following_ids = [user.id for user in g.user.following]
-        self_and_following_ids.append(g.user.id)
+    before, after, per_page = get_page_args()
+    messages = home_timeline(Message
+                             .query
+                             .options(*loading(joinedload(Message.user))),
+                             g.viewer.id,
+                             before=before, after=after, per_page=per_page)
+    load_liked_message_ids(messages)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(self_and_following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages)
+    return render_template('home.html', messages=messages)
+
+
+@warbler.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Shed load when too many logins/signups are waiting on bcrypt."""
+
+    return ("Too many requests right now, please try again shortly.", 503,
+            {'Retry-After': '1'})
+
+
+##############################################################################
+# Command-line maintenance
+
+# Users followed per statement by import-follows
+FOLLOW_IMPORT_CHUNK = 10_000
+
+
+@warbler.cli.command('create-db')
+def create_db_command():
+    """Create any missing tables, then apply pending migrations."""
+
+    create_db()
+
+    print("Created tables.")
 
-    else:
-        return render_template('home-anon.html')
+
+@warbler.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations (see migrations.py)."""
+
+    print(f"Applied {migrate()} migrations.")
+
+
+@warbler.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    build_assets(current_app.static_folder)
+    assets.load_manifest()
+
+
+@warbler.cli.command('create-search-indexes')
+def create_search_indexes_command():
+    """Create user search indexes for a database made before search."""
+
+    create_search_indexes()
+
+    print("Created search indexes.")
+
+
+@warbler.cli.command('import-follows')
+@click.argument('user_id', type=int)
+@click.argument('file', type=click.File())
+def import_follows(user_id, file):
+    """Have a user follow everyone listed in FILE (a user id per line).
+
+    All in one transaction, e.g. to bring over a social graph. Users that
+    don't exist or are already followed are skipped.
+    """
+
+    user_ids = []
+    for number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                user_ids.append(int(line.split(",")[0]))
+            except ValueError:
+                raise click.BadParameter(f"line {number} isn't a user id",
+                                         param_hint="FILE")
+
+    followed_ids = []
+    for start in range(0, len(user_ids), FOLLOW_IMPORT_CHUNK):
+        followed_ids += Follows.follow(
+            user_id, user_ids[start:start + FOLLOW_IMPORT_CHUNK])
+
+    update_inbox(user_id, followed_ids=followed_ids)
+    db.session.commit()
+
+    print(f"Followed {len(followed_ids)} of {len(user_ids)} users.")
+
+
+@warbler.cli.command('worker')
+@click.option('--once', is_flag=True,
+              help="Run the jobs that are due, then exit.")
+def worker(once):
+    """Run background jobs, with JOB_CONCURRENCY processes per queue."""
+
+    if once:
+        print(f"Ran {run_pending(metrics=metrics)} jobs.")
+        return
+
+    run_workers(current_app.config['JOB_CONCURRENCY'])
+
+
+@warbler.cli.command('recount-users')
+def recount_users():
+    """Recompute every user's denormalized message/follow/like counters."""
+
+    User.recount()
+    db.session.commit()
+
+    print("Recounted users.")
+
+
+@warbler.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's home timeline inbox.
+
+    Run this before switching TIMELINE_FANOUT on for an existing database.
+    """
+
+    size = current_app.config['TIMELINE_INBOX_SIZE']
+    user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+
+    for user_id in user_ids:
+        TimelineEntry.rebuild(user_id, size)
+        db.session.commit()
+
+    print(f"Rebuilt {len(user_ids)} timelines.")
 
 
 ##############################################################################
@@ -404,10 +966,32 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@warbler.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Set the caching policy of every response.
+
+    Pages checked with `not_modified` may be kept, but must be revalidated
+    (and only by the browser, when they're personalized or use the
+    session). Static files keep
+    their own policy (built assets are immutable). Nothing else may be
+    stored.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if 'etag' in g:
+        response.set_etag(g.etag)
+        response.last_modified = g.last_modified
+        response.cache_control.no_cache = True
+        # (shared caches may only keep a page that's the same for everyone:
+        # not one showing the session, say in a CSRF token, or setting it)
+        if (g.viewer or session.accessed or session.modified
+                or 'Set-Cookie' in response.headers):
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.vary.add('Cookie')
+
+    elif request.endpoint not in STATIC_ENDPOINTS:
+        response.cache_control.no_store = True
+
     return response
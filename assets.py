@@ -0,0 +1,222 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+`flask build-assets` copies every file in static/ to static/dist/ under a
+name including a hash of its content (style.css -> style.3f2a9c1e0b7d.css),
+writes .gz and .br (brotli, see requirements.txt) copies of the files that
+compress well, and records the names in static/dist/manifest.json.
+URLs inside stylesheets are rewritten to the hashed names too.
+
+Templates link assets with `static_url("stylesheets/style.css")` (or a
+"/static/..." URL, e.g. a user's default image). Built assets are served
+from /assets/ with the smallest encoding the browser accepts and cached for
+a year: their URL changes whenever their content does. Without a build,
+`static_url` falls back to plain /static/ URLs.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import request, send_from_directory, url_for
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:  # (without it, only .gz copies are written)
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+
+# Files worth compressing (images are compressed already)
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'image/svg+xml',
+    'image/vnd.microsoft.icon', 'image/x-icon',
+}
+
+# (Accept-Encoding token, file extension), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+CSS_URL = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+def hashed_name(path, content):
+    """style.css -> style.<hash of content>.css"""
+
+    root, ext = posixpath.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def is_compressible(path):
+    mimetype = mimetypes.guess_type(path)[0] or ""
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def build(static_dir, log=print):
+    """Build static_dir/dist and its manifest. Returns the manifest."""
+
+    dist_dir = os.path.join(static_dir, DIST)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and DIST in dirs:
+            dirs.remove(DIST)
+        paths.extend(
+            os.path.relpath(os.path.join(root, name), static_dir)
+            .replace(os.sep, "/")
+            for name in files)
+
+    # Stylesheets last, so the URLs in them can be rewritten to hashed names
+    paths.sort(key=lambda path: (path.endswith(".css"), path))
+    manifest = {}
+
+    for path in paths:
+        with open(os.path.join(static_dir, path), "rb") as f:
+            content = f.read()
+
+        if path.endswith(".css"):
+            content = rewrite_css_urls(path, content, manifest)
+
+        manifest[path] = hashed_name(path, content)
+        write_asset(os.path.join(dist_dir, manifest[path]), content)
+        log(f"{path} -> {manifest[path]}")
+
+    with open(os.path.join(dist_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def rewrite_css_urls(path, content, manifest):
+    """Point url(...)s in a stylesheet at the hashed names of assets."""
+
+    def rewrite(match):
+        quote, url = match.groups()
+
+        if url.startswith("/static/"):
+            target = url[len("/static/"):]
+            prefix = "/assets/"
+        elif "//" in url or url.startswith(("/", "data:")):
+            return match.group(0)
+        else:
+            target = posixpath.normpath(
+                posixpath.join(posixpath.dirname(path), url))
+            prefix = None
+
+        if target not in manifest:
+            return match.group(0)
+
+        if prefix:
+            hashed = prefix + manifest[target]
+        else:
+            hashed = posixpath.relpath(manifest[target],
+                                       posixpath.dirname(path) or ".")
+
+        return f"url({quote}{hashed}{quote})"
+
+    return CSS_URL.sub(rewrite, content.decode("utf-8")).encode("utf-8")
+
+
+def write_asset(path, content):
+    """Write an asset and, when they are smaller, compressed copies."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+    if not is_compressible(path):
+        return
+
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content, quality=11)
+
+    for ext, compressed in variants.items():
+        if len(compressed) < len(content) * 0.9:
+            with open(path + ext, "wb") as f:
+                f.write(compressed)
+
+
+class Assets:
+    """Resolves and serves built static assets."""
+
+    def __init__(self, app=None):
+        self.dist_dir = None
+        self.manifest = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Load the manifest (if built); add static_url() and /assets/."""
+
+        self.dist_dir = os.path.join(app.static_folder, DIST)
+        self.load_manifest()
+
+        app.add_template_global(self.static_url, 'static_url')
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+
+    def load_manifest(self):
+        """(Re)read the manifest written by `build`."""
+
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def static_url(self, path):
+        """URL of a static file, e.g. static_url("stylesheets/style.css").
+
+        Also takes "/static/..." URLs; other URLs are returned unchanged.
+        """
+
+        if not path:
+            return path
+
+        if path.startswith("/static/"):
+            path = path[len("/static/"):]
+        elif "//" in path or path.startswith("/"):
+            return path
+
+        if path in self.manifest:
+            return url_for('assets', filename=self.manifest[path])
+
+        return url_for('static', filename=path)
+
+    def serve(self, filename):
+        """Serve a built asset, precompressed if the browser accepts it."""
+
+        if filename == MANIFEST:
+            raise NotFound()
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        accepted = request.accept_encodings
+        response = None
+
+        for encoding, ext in ENCODINGS:
+            if (accepted[encoding]
+                    and os.path.isfile(
+                        os.path.join(self.dist_dir, filename + ext))):
+                response = send_from_directory(
+                    self.dist_dir, filename + ext, mimetype=mimetype,
+                    max_age=ONE_YEAR)
+                response.content_encoding = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(self.dist_dir, filename,
+                                           mimetype=mimetype,
+                                           max_age=ONE_YEAR)
+
+        response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+        return response
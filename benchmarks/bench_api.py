@@ -0,0 +1,116 @@
+"""Benchmark the JSON API against the HTML pages it mirrors.
+
+Builds a throwaway database in which one reader follows --follows users who
+have all posted, then requests the home timeline, a profile and a message
+as HTML and from /api/v1, and reports requests per second and response
+size for each.
+
+    createdb warbler_bench
+    python benchmarks/bench_api.py --follows 1000
+
+Uses BENCH_DATABASE_URL (default postgresql:///warbler_bench). Every table in
+that database is dropped and recreated.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, Follows  # noqa: E402
+
+app = create_app()
+
+
+def seed(num_follows, messages_per_user):
+    """Create a reader following `num_follows` users who have all posted."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(), [
+        dict(username=f"user{i}", email=f"user{i}@bench.test",
+             password="HASHED_PASSWORD", bio=f"I am user {i}.")
+        for i in range(num_follows + 1)
+    ])
+    reader_id = db.session.query(User.id).filter_by(username="user0").scalar()
+
+    start = datetime.utcnow() - timedelta(days=365)
+    db.session.execute(Message.__table__.insert(), [
+        dict(text=f"message {n} from {user_id}",
+             timestamp=start + timedelta(seconds=user_id * messages_per_user + n),
+             user_id=user_id)
+        for (user_id,) in db.session.query(User.id).filter(User.id != reader_id)
+        for n in range(messages_per_user)
+    ])
+    db.session.execute(Follows.__table__.insert(), [
+        dict(user_being_followed_id=user_id, user_following_id=reader_id)
+        for (user_id,) in db.session.query(User.id).filter(User.id != reader_id)
+    ])
+
+    User.recount()
+    db.session.commit()
+    db.session.execute("ANALYZE")
+
+    return reader_id
+
+
+def measure(client, url, requests):
+    """(requests per second, bytes per response) of GETting `url`."""
+
+    resp = client.get(url)  # warm up caches and connections
+    assert resp.status_code == 200, (url, resp.status_code)
+    size = len(resp.data)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(url)
+    elapsed = time.perf_counter() - start
+
+    return requests / elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--follows", type=int, default=1000)
+    parser.add_argument("--messages-per-user", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    reader_id = seed(args.follows, args.messages_per_user)
+    author_id = reader_id + 1
+    message_id = db.session.query(Message.id).filter_by(
+        user_id=author_id).limit(1).scalar()
+    db.session.remove()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = reader_id
+
+    pages = [
+        ("home", "/", "/api/v1/timeline"),
+        ("profile", f"/users/{author_id}",
+         f"/api/v1/users/{author_id}/messages"),
+        ("message", f"/messages/{message_id}",
+         f"/api/v1/messages/{message_id}"),
+    ]
+
+    print(f"{'page':<8} {'html req/s':>10} {'api req/s':>10} "
+          f"{'html bytes':>10} {'api bytes':>10}")
+    for label, html_url, api_url in pages:
+        html_rps, html_size = measure(client, html_url, args.requests)
+        api_rps, api_size = measure(client, api_url, args.requests)
+        print(f"{label:<8} {html_rps:>10.0f} {api_rps:>10.0f} "
+              f"{html_size:>10} {api_size:>10}")
+
+
+if __name__ == "__main__":
+    main()
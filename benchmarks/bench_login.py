@@ -0,0 +1,74 @@
+"""Benchmark login (bcrypt check) throughput at different work factors.
+
+Drives the app's PasswordHasher from --clients concurrent threads, the way
+request threads would, and reports checks per second overall and per core
+for each bcrypt cost. No database is needed.
+
+    python benchmarks/bench_login.py --costs 10 11 12 --clients 16
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, PasswordHasherBusy  # noqa: E402
+
+
+def run(cost, workers, clients, duration):
+    """Check passwords for `duration` seconds; return (checks, shed, secs)."""
+
+    hasher = PasswordHasher()
+    hasher.rounds = cost
+    hasher.workers = workers
+    hasher.max_pending = workers * 4
+    pw_hash = hasher.generate_password_hash("benchmark-password")
+
+    deadline = time.perf_counter() + duration
+
+    def client():
+        checks = shed = 0
+        while time.perf_counter() < deadline:
+            try:
+                assert hasher.check_password_hash(pw_hash, "benchmark-password")
+                checks += 1
+            except PasswordHasherBusy:
+                shed += 1
+        return checks, shed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda _: client(), range(clients)))
+    elapsed = time.perf_counter() - start
+
+    return (sum(checks for checks, _ in results),
+            sum(shed for _, shed in results),
+            elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--costs", type=int, nargs="+", default=[10, 11, 12])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="hashing threads (PASSWORD_HASH_WORKERS)")
+    parser.add_argument("--clients", type=int, default=16,
+                        help="concurrent request threads")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    cores = min(args.workers, os.cpu_count() or 1)
+    print(f"workers={args.workers} clients={args.clients} cores={cores}")
+
+    for cost in args.costs:
+        checks, shed, elapsed = run(
+            cost, args.workers, args.clients, args.duration)
+        rate = checks / elapsed
+        print(f"cost={cost}: {rate:.1f} logins/s, "
+              f"{rate / cores:.1f} logins/s/core, {shed} shed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Benchmark user search at scale.
+
+Fills a throwaway Postgres database with --users synthetic users (1M by
+default, via generate_series), then compares the old unindexed
+`username LIKE '%q%'` scan with the indexed search and autocomplete.
+
+    createdb warbler_bench
+    python benchmarks/bench_search.py --users 1000000
+
+Uses BENCH_DATABASE_URL (default postgresql:///warbler_bench). Every table in
+that database is dropped and recreated.
+"""
+
+import argparse
+import os
+import sys
+import time
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+
+from app import create_app  # noqa: E402
+from models import db, User  # noqa: E402
+from search import search_users, autocomplete_usernames  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+create_app()  # configures the database
+
+WORDS = ["bird", "song", "coffee", "hiking", "python", "warbler", "music",
+         "garden", "travel", "photo", "chess", "runner", "baker", "poet"]
+
+QUERIES = ["warbler", "user12345", "coffee hik", "zzzz"]
+
+
+def seed(num_users):
+    """Create `num_users` users with pseudo-random usernames and bios."""
+
+    db.drop_all()
+    db.create_all()
+
+    words = "ARRAY[" + ", ".join(f"'{word}'" for word in WORDS) + "]"
+    db.session.execute(text(f"""
+        INSERT INTO users (username, email, password, bio)
+        SELECT
+            'user' || n,
+            'user' || n || '@bench.test',
+            'HASHED_PASSWORD',
+            ({words})[1 + n % {len(WORDS)}] || ' and ' ||
+            ({words})[1 + (n / 7) % {len(WORDS)}] || ' fan'
+        FROM generate_series(1, :num_users) AS n
+    """), dict(num_users=num_users))
+    db.session.commit()
+    db.session.execute(text("ANALYZE users"))
+
+
+def time_ms(fn, repeat):
+    """Median wall time of `fn()` in milliseconds."""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    seed(args.users)
+    print(f"users={args.users}")
+
+    for q in QUERIES:
+        scan = time_ms(lambda: User.query.filter(
+            User.username.like(f"%{q}%")).limit(25).all(), args.repeat)
+        indexed = time_ms(lambda: search_users(q), args.repeat)
+        print(f"q={q!r}: like-scan={scan:.1f}ms search={indexed:.1f}ms")
+
+    for prefix in ["u", "user99", "user123456"]:
+        ms = time_ms(lambda: autocomplete_usernames(prefix), args.repeat)
+        print(f"autocomplete {prefix!r}: {ms:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark app startup: import time, create_app() and the first requests.
+
+Each run is a fresh Python process, like a newly booted worker. It reports
+the median time to import app.py, to build the app as wsgi.py does, to
+serve a first page that needs no database (the anonymous home page) and a
+first page that does (the user list, which also opens the first
+connection), and how many database connections were opened before the
+first request.
+
+    python benchmarks/bench_startup.py --runs 10
+
+Uses BENCH_DATABASE_URL (default postgresql:///warbler_bench), whose tables
+must exist (flask create-db). Nothing is written to it.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+connections = []
+event.listen(Pool, 'connect', lambda *args: connections.append(1))
+
+import app
+imported = time.perf_counter()
+
+from wsgi import app as flask_app
+created = time.perf_counter()
+connections_at_boot = len(connections)
+
+client = flask_app.test_client()
+assert client.get("/").status_code == 200
+first = time.perf_counter()
+assert client.get("/users").status_code == 200
+first_db = time.perf_counter()
+
+print(json.dumps(dict(
+    import_ms=(imported - start) * 1000,
+    build_app_ms=(created - imported) * 1000,
+    first_request_ms=(first - created) * 1000,
+    first_db_request_ms=(first_db - first) * 1000,
+    connections_at_boot=connections_at_boot,
+)))
+"""
+
+
+def run_once():
+    """Start one process; return its timings."""
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = os.environ.get(
+        'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+    env.setdefault('SECRET_KEY', "benchmark")
+
+    output = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    for name in runs[0]:
+        print(f"{name}: {median(run[name] for run in runs):.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark pull vs. push home timelines.
+
+Builds a throwaway database in which one reader follows --follows users, then
+times GET / with TIMELINE_FANOUT off (pull model: IN (...) over every followed
+user) and on (push model: one range scan over the reader's inbox).
+
+    createdb warbler_bench
+    python benchmarks/bench_timeline.py --follows 10000
+
+Uses BENCH_DATABASE_URL (default postgresql:///warbler_bench). Every table in
+that database is dropped and recreated.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, Follows, TimelineEntry  # noqa: E402
+
+app = create_app()
+
+
+def seed(num_follows, messages_per_user):
+    """Create a reader following `num_follows` users who have all posted."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(), [
+        dict(username=f"user{i}", email=f"user{i}@bench.test",
+             password="HASHED_PASSWORD")
+        for i in range(num_follows + 1)
+    ])
+    reader_id = db.session.query(User.id).filter_by(username="user0").scalar()
+
+    start = datetime.utcnow() - timedelta(days=365)
+    db.session.execute(Message.__table__.insert(), [
+        dict(text=f"message {n} from {user_id}",
+             timestamp=start + timedelta(seconds=user_id * messages_per_user + n),
+             user_id=user_id)
+        for (user_id,) in db.session.query(User.id).filter(User.id != reader_id)
+        for n in range(messages_per_user)
+    ])
+    db.session.execute(Follows.__table__.insert(), [
+        dict(user_being_followed_id=user_id, user_following_id=reader_id)
+        for (user_id,) in db.session.query(User.id).filter(User.id != reader_id)
+    ])
+
+    TimelineEntry.rebuild(reader_id, app.config['TIMELINE_INBOX_SIZE'])
+    db.session.commit()
+    db.session.execute("ANALYZE")
+
+    return reader_id
+
+
+def time_homepage(client, fanout, requests):
+    """Median and p95 wall time (ms) of GET / in the given timeline mode."""
+
+    app.config['TIMELINE_FANOUT'] = fanout
+    client.get("/")  # warm up caches and connections
+
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        resp = client.get("/")
+        timings.append((time.perf_counter() - start) * 1000)
+        assert resp.status_code == 200
+
+    timings.sort()
+    return median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--follows", type=int, default=10_000)
+    parser.add_argument("--messages-per-user", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    reader_id = seed(args.follows, args.messages_per_user)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = reader_id
+
+    print(f"follows={args.follows} "
+          f"messages={args.follows * args.messages_per_user}")
+    for label, fanout in [("pull", False), ("push", True)]:
+        p50, p95 = time_homepage(client, fanout, args.requests)
+        print(f"{label}: p50={p50:.1f}ms p95={p95:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
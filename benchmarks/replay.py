@@ -0,0 +1,146 @@
+"""Replay recorded (or synthesized) traffic and report per-route latency.
+
+Record real traffic by running the app with TRAFFIC_LOG=traffic.jsonl, or
+synthesize a mix of home, profile, like and follow requests from the users
+and messages in the database:
+
+    python benchmarks/replay.py --synthesize 10000
+    python benchmarks/replay.py --concurrency 16
+
+By default requests go to the app's test client, in this process. To load
+test a real server instead, start one on this host with the same database and
+SESSION_DIR, with CSRF checks and rate limits off:
+
+    WTF_CSRF_ENABLED=0 RATE_LIMITS= gunicorn -w 4 wsgi:app
+    python benchmarks/replay.py --target http://127.0.0.1:8000
+
+Uses BENCH_DATABASE_URL (default postgresql:///warbler_bench), loaded e.g.
+with bulk_load.py. Like and follow requests change data, and synthesized ones
+are made to be valid against the data as it is, so reload the data (or
+synthesize again) between runs.
+"""
+
+import argparse
+import json
+import os
+import sys
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+os.environ.setdefault('RATE_LIMITS', "")
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, LikedMessage, Follows  # noqa: E402
+from traffic import load_traffic, replay, summarize  # noqa: E402
+
+app = create_app()
+
+# (share of requests, kind)
+MIX = [
+    (0.45, 'home'),
+    (0.25, 'profile'),
+    (0.18, 'like'),
+    (0.12, 'follow'),
+]
+
+
+def synthesize(count, seed=0):
+    """Make `count` requests by random users, following MIX.
+
+    Likes and follows toggle: a user likes a message they don't like yet and
+    unlikes one they do, so every request is valid when replayed in order.
+    """
+
+    rng = Random(seed)
+    user_ids = [id for id, in db.session.query(User.id)]
+    message_ids = [id for id, in db.session.query(Message.id)]
+    liked = {}
+    following = {}
+
+    def liked_by(user_id):
+        if user_id not in liked:
+            liked[user_id] = {id for id, in db.session.query(
+                LikedMessage.message_id).filter_by(user_id=user_id)}
+        return liked[user_id]
+
+    def followed_by(user_id):
+        if user_id not in following:
+            following[user_id] = {id for id, in db.session.query(
+                Follows.user_being_followed_id).filter_by(
+                    user_following_id=user_id)}
+        return following[user_id]
+
+    kinds = [kind for _, kind in MIX]
+    weights = [share for share, _ in MIX]
+
+    for i in range(count):
+        user_id = rng.choice(user_ids)
+        kind = rng.choices(kinds, weights)[0]
+
+        if kind == 'home':
+            method, path = "GET", "/"
+
+        elif kind == 'profile':
+            method, path = "GET", f"/users/{rng.choice(user_ids)}"
+
+        elif kind == 'like':
+            message_id = rng.choice(message_ids)
+            likes = liked_by(user_id)
+            action = "unlike" if message_id in likes else "like"
+            likes.symmetric_difference_update({message_id})
+            method, path = "POST", f"/messages/{message_id}/{action}"
+
+        else:
+            other_id = rng.choice(user_ids)
+            if other_id == user_id:
+                continue
+            follows = followed_by(user_id)
+            action = ("stop-following" if other_id in follows
+                      else "follow")
+            follows.symmetric_difference_update({other_id})
+            method, path = "POST", f"/users/{action}/{other_id}"
+
+        yield dict(ts=i, method=method, path=path, user_id=user_id, form={})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--traffic", default="traffic.jsonl",
+                        help="recorded traffic (JSON lines)")
+    parser.add_argument("--synthesize", type=int, metavar="COUNT",
+                        help="write COUNT synthetic requests to --traffic "
+                             "and exit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target",
+                        help="base URL of a running server (default: the "
+                             "app's test client)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.synthesize:
+        with open(args.traffic, "w") as f:
+            for record in synthesize(args.synthesize, args.seed):
+                f.write(json.dumps(record) + "\n")
+        return
+
+    records = load_traffic(args.traffic)
+    results, seconds = replay(app, records, target=args.target,
+                              concurrency=args.concurrency,
+                              session_key=CURR_USER_KEY)
+
+    print(f"{len(records)} requests, concurrency={args.concurrency}, "
+          f"{seconds:.1f}s")
+    print(f"{'route':<28}{'requests':>9}{'errors':>8}{'req/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for row in summarize(results, seconds):
+        print(f"{row['route']:<28}{row['requests']:>9}{row['errors']:>8}"
+              f"{row['rps']:>9.1f}{row['p50']:>9.1f}{row['p95']:>9.1f}"
+              f"{row['p99']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
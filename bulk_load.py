@@ -0,0 +1,214 @@
+"""Bulk-load Warbler data from CSV files.
+
+Streams generator/users.csv, messages.csv, follows.csv (and likes.csv, if
+present) into the database in chunks, so memory use stays flat however big
+the files are:
+
+- on Postgres, each file is streamed through COPY ... FROM STDIN
+- elsewhere (SQLite), rows go in with executemany, one chunk at a time
+
+Secondary indexes on the loaded tables are dropped first and rebuilt once
+at the end, which is much faster than maintaining them row by row. Then id
+sequences are moved past the loaded ids and the denormalized user counters
+are recomputed.
+
+    python bulk_load.py --reset            # drop & recreate tables first
+    python bulk_load.py --dir /data/warbler --chunk-rows 50000
+"""
+
+import argparse
+import csv
+import os
+import time
+from itertools import islice
+
+from sqlalchemy import bindparam, text
+
+from models import db, User
+
+# (file name, table), in foreign key order
+FILES = [
+    ('users.csv', 'users'),
+    ('messages.csv', 'messages'),
+    ('follows.csv', 'follows'),
+    ('likes.csv', 'liked_messages'),
+]
+
+SERIAL_TABLES = ['users', 'messages']
+
+
+def load_all(data_dir='generator', chunk_rows=10_000, reset=False,
+             log=print):
+    """Load every CSV file found in `data_dir`. Returns {table: rows}."""
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    files = [(os.path.join(data_dir, name), table)
+             for name, table in FILES
+             if os.path.exists(os.path.join(data_dir, name))]
+    tables = [table for _, table in files]
+
+    started = time.perf_counter()
+    indexes = drop_indexes(tables)
+    loaded = {}
+
+    for path, table in files:
+        start = time.perf_counter()
+        loaded[table] = load_file(path, table, chunk_rows)
+        log(report(table, loaded[table], time.perf_counter() - start))
+
+    start = time.perf_counter()
+    create_indexes(indexes)
+    reset_sequences()
+    User.recount()
+    db.session.commit()
+    log(f"rebuilt {len(indexes)} indexes and counters in "
+        f"{time.perf_counter() - start:.1f}s")
+
+    log(report("total", sum(loaded.values()), time.perf_counter() - started))
+    return loaded
+
+
+def report(label, rows, seconds):
+    """Describe a load's throughput."""
+
+    return (f"{label}: {rows} rows in {seconds:.1f}s "
+            f"({rows / max(seconds, 1e-9):,.0f} rows/s)")
+
+
+def load_file(path, table, chunk_rows):
+    """Stream one CSV file (with a header row) into `table`."""
+
+    with open(path, newline='') as f:
+        columns = next(csv.reader(f))
+
+    if db.engine.dialect.name == 'postgresql':
+        return copy_file(path, table, columns)
+
+    return insert_file(path, table, columns, chunk_rows)
+
+
+def copy_file(path, table, columns):
+    """Stream a CSV file through Postgres COPY."""
+
+    connection = db.session.connection().connection
+    cursor = connection.cursor()
+
+    with open(path, newline='') as f:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv, HEADER true)",
+            f, size=1024 * 1024)
+
+    return cursor.rowcount
+
+
+def insert_file(path, table, columns, chunk_rows):
+    """Insert a CSV file with executemany, `chunk_rows` rows at a time."""
+
+    placeholders = {
+        'qmark': "?",
+        'format': "%s",
+        'pyformat': "%s",
+        'numeric': None,
+        'named': None,
+    }[db.engine.dialect.paramstyle]
+
+    if placeholders is None:
+        raise NotImplementedError(
+            f"paramstyle {db.engine.dialect.paramstyle} is not supported")
+
+    statement = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                 f"VALUES ({', '.join([placeholders] * len(columns))})")
+    connection = db.session.connection()
+    rows = 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+
+        while chunk := [tuple(value if value != "" else None for value in row)
+                        for row in islice(reader, chunk_rows)]:
+            connection.exec_driver_sql(statement, chunk)
+            rows += len(chunk)
+
+    return rows
+
+
+def drop_indexes(tables):
+    """Drop secondary indexes of `tables`. Returns their CREATE statements.
+
+    Indexes backing primary keys and unique constraints are kept.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        indexes = db.session.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = ANY(:tables) "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint)"
+        ), dict(tables=tables)).all()
+
+    elif db.engine.dialect.name == 'sqlite':
+        indexes = db.session.execute(text(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND sql IS NOT NULL AND tbl_name IN :tables"
+        ).bindparams(bindparam('tables', expanding=True)),
+            dict(tables=tables)).all()
+
+    else:
+        return []
+
+    for name, _ in indexes:
+        db.session.execute(text(f'DROP INDEX "{name}"'))
+
+    return [definition for _, definition in indexes]
+
+
+def create_indexes(definitions):
+    """Rebuild indexes dropped by `drop_indexes`."""
+
+    for definition in definitions:
+        db.session.execute(text(definition))
+
+
+def reset_sequences():
+    """Move id sequences past the highest loaded ids (Postgres only).
+
+    They never move back: ids of deleted rows aren't handed out again (the
+    session store caches users by id, see sessions.py).
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for table in SERIAL_TABLES:
+        db.session.execute(text(
+            f"SELECT setval(seq, greatest(max_id, last_id, 1), "
+            f"              coalesce(max_id, last_id) IS NOT NULL) "
+            f"FROM (SELECT seq, max_id, pg_sequence_last_value(seq) AS last_id "
+            f"      FROM (SELECT max(id) AS max_id, "
+            f"                   pg_get_serial_sequence('{table}', 'id')"
+            f"::regclass AS seq "
+            f"            FROM {table}) AS loaded) AS sequence"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load Warbler CSVs.")
+    parser.add_argument("--dir", default="generator",
+                        help="directory holding the CSV files")
+    parser.add_argument("--chunk-rows", type=int, default=10_000,
+                        help="rows per executemany batch (non-Postgres)")
+    parser.add_argument("--reset", action="store_true",
+                        help="drop and recreate all tables first")
+    args = parser.parse_args()
+
+    from app import create_app
+    create_app()  # configures the database
+
+    load_all(args.dir, chunk_rows=args.chunk_rows, reset=args.reset)
+
+
+if __name__ == "__main__":
+    main()
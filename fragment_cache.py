@@ -0,0 +1,89 @@
+"""In-process cache of rendered HTML fragments.
+
+Used to cache each message's rendered timeline <li>: a message's text and
+timestamp never change, so its markup only needs rendering again when its
+author changes their profile. Callers put the author's profile version in
+the key, so a profile edit makes the author's old entries unreachable; they
+then age out of the LRU like any other cold entry.
+
+The cache holds at most `max_bytes` of HTML (roughly; Python strings take
+more memory than their length) and evicts least-recently-used entries.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """Thread-safe, size-capped LRU cache of rendered fragments.
+
+    Keys are tuples whose first item is the id of the message (or other
+    row) the fragment shows, so all fragments of a row can be invalidated.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._keys_by_id = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the fragment for `key`, or None."""
+
+        with self._lock:
+            fragment = self._entries.get(key)
+
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+
+            return fragment
+
+    def set(self, key, fragment):
+        """Cache `fragment` for `key`, evicting old entries to make room."""
+
+        if len(fragment) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = fragment
+            self._keys_by_id.setdefault(key[0], set()).add(key)
+            self.size += len(fragment)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, id):
+        """Drop every cached fragment of the row with this id."""
+
+        with self._lock:
+            for key in list(self._keys_by_id.get(id, ())):
+                self._remove(key)
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key))
+
+        keys = self._keys_by_id[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_id[key[0]]
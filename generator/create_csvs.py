@@ -2,29 +2,53 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 100000000 --likes 50000000 --out /data/warbler
+    python bulk_load.py --reset --dir /data/warbler
+
+Output depends only on the options (not the number of processes), so the
+same --seed always gives the same files. Nothing is fetched over the
+network, and rows are streamed to disk, so memory use stays flat.
+
+Follows and likes follow a power law (Zipf): a few celebrity users have a
+huge number of followers and most have a handful. Posting is skewed the same
+way. Work is split into shards of ids, generated in parallel and joined in
+order.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+from shutil import copyfileobj
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import Zipf, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'timestamp']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# Messages are dated in the two years before this (fixed, for repeatability)
+END_DATE = datetime(2021, 10, 1)
 
-# Generate random profile image URLs to use for users
+# Rows per shard. Fixed, so output doesn't depend on the number of processes
+SHARD_ROWS = 100_000
+
+# Faker is slow, so each shard draws text from pools of fake values
+POOL_SIZE = 1000
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +56,197 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (from the splashbase API, saved here so
+# generating doesn't need the network)
+
+HEADER_IMAGE_IDS = [
+    'mnh0n9pHJW', 'mnh0uemhCk', 'mnh121HEWa', 'mnh17lfd9R', 'mnh1d7s3UD',
+    'mnh1jdFvHR', 'mnh1uhYnog', 'mnh25vNOvI', 'mnh29fxz11', 'mnh2m1hnS8',
+    'mo1h6tGOZf', 'mo2wz2LTCs', 'mo2x3aAnRH', 'mo2x80NkDu', 'mo2x9xqeef',
+    'mo2xbk8JUK', 'mo2xdqmle5', 'mo2xfarCvW', 'mo2xgqdEFn', 'mo2xijE2nr',
+    'mopq4kHmAg', 'mopq69jlcS', 'mopq8fyQwI', 'mopqamedKu', 'mopqc3ZZcz',
+    'mopqdfx05t', 'mopqfpSTPN', 'mopqhxFulr', 'mopqj9QUeq', 'mopqkkwK2M',
+    'mp6rzyNlAN', 'mp6s1hAudo', 'mp6s32zb6l', 'mp6s4dzqHA', 'mp6s661UgK',
+    'mp6s7lR1lS', 'mp6s995bvI', 'mp6sasSvPZ', 'mp6scv2xrZ', 'mpp6f50W26',
+    'mpp6gwrYvm', 'mpp6l06zXi', 'mpp6poZxE5', 'mpp6tjdFhf', 'mpp6w0dxAm',
+]
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{id}1st5lhmo1_1280.jpg"
+    for id in HEADER_IMAGE_IDS
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+class Shard:
+    """Generates one shard of one CSV file, with its own seeded randomness."""
+
+    def __init__(self, options, table, start, stop):
+        self.options = options
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+        key = f"{options.seed}:{table}:{start}"
+        self.rng = Random(key)
+        self.fake = Faker()
+        self.fake.seed_instance(key)
+
+    def generate(self, path):
+        """Write this shard's rows (without a header) to `path`."""
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows(getattr(self, self.table)())
+
+    def pool(self, make):
+        return [make() for i in range(POOL_SIZE)]
+
+    def users(self):
+        names = self.pool(self.fake.user_name)
+        domains = self.pool(self.fake.free_email_domain)
+        bios = self.pool(self.fake.sentence)
+        cities = self.pool(self.fake.city)
+        choice = self.rng.choice
+
+        for id in range(self.start, self.stop):
+            # the id suffix keeps usernames and emails unique
+            username = f"{choice(names)}{id}"
+            yield (id, f"{username}@{choice(domains)}", username,
+                   choice(image_urls), PASSWORD, choice(bios),
+                   choice(header_image_urls), choice(cities))
+
+    def messages(self):
+        sentences = self.pool(self.fake.sentence)
+        authors = Zipf(self.options.users, self.options.zipf, stride=0.382)
+        choice = self.rng.choice
+
+        for id in range(self.start, self.stop):
+            text = " ".join(choice(sentences) for i in range(3))
+            yield (id, text[:MAX_WARBLER_LENGTH],
+                   get_random_datetime(now=END_DATE, rng=self.rng),
+                   authors.id(self.rng))
+
+    def follows(self):
+        users = self.options.users
+        celebrities = Zipf(users, self.options.zipf)
+
+        for follower in range(self.start, self.stop):
+            followed = self.distinct(
+                celebrities, per_user(self.options.follows, users, follower),
+                exclude=follower)
+            for user_id in followed:
+                yield (user_id, follower)
+
+    def likes(self):
+        users = self.options.users
+        popular = Zipf(self.options.messages, self.options.zipf)
+
+        for user_id in range(self.start, self.stop):
+            liked = self.distinct(
+                popular, per_user(self.options.likes, users, user_id))
+            for message_id in liked:
+                yield (user_id, message_id,
+                       get_random_datetime(now=END_DATE, rng=self.rng))
+
+    def distinct(self, zipf, count, exclude=None):
+        """Draw `count` different ids from `zipf`, sorted."""
+
+        count = min(count, zipf.n - (exclude is not None))
+        ids = set()
+        draws = 0
+
+        while len(ids) < count:
+            # Zipf mostly redraws the same few ids once those are taken, so
+            # when a user needs most of them, fill up uniformly
+            if draws < 20 * count:
+                id = zipf.id(self.rng)
+            else:
+                id = self.rng.randint(1, zipf.n)
+            draws += 1
+
+            if id != exclude:
+                ids.add(id)
+
+        return sorted(ids)
+
+
+def per_user(total, users, user_id):
+    """How many of `total` rows go to user `user_id` (spread evenly)."""
+
+    return total // users + (user_id <= total % users)
+
+
+def generate_shard(task):
+    """Generate one shard into a temporary file; return the file's path."""
+
+    options, table, start, stop, path = task
+    Shard(options, table, start, stop).generate(path)
+    return path
+
+
+def shards(table, count, rows_per_id=1):
+    """Split ids 1..count into shards of about SHARD_ROWS rows."""
+
+    size = max(1, int(SHARD_ROWS / max(rows_per_id, 1)))
+    for start in range(1, count + 1, size):
+        yield table, start, min(start + size, count + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--follows", type=int, default=5000)
+    parser.add_argument("--likes", type=int, default=0)
+    parser.add_argument("--zipf", type=float, default=1.0,
+                        help="power law exponent (higher is more skewed)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="generator",
+                        help="directory to write the CSV files to")
+    options = parser.parse_args()
+
+    files = [
+        ('users', 'users.csv', USERS_CSV_HEADERS,
+         shards('users', options.users)),
+        ('messages', 'messages.csv', MESSAGES_CSV_HEADERS,
+         shards('messages', options.messages)),
+        ('follows', 'follows.csv', FOLLOWS_CSV_HEADERS,
+         shards('follows', options.users, options.follows / options.users)),
+    ]
+
+    likes_path = os.path.join(options.out, 'likes.csv')
+    if options.likes:
+        files.append(
+            ('likes', 'likes.csv', LIKES_CSV_HEADERS,
+             shards('likes', options.users, options.likes / options.users)))
+    elif os.path.exists(likes_path):
+        os.remove(likes_path)
+
+    os.makedirs(options.out, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=options.out) as parts, \
+            Pool(options.processes) as pool:
+        for table, name, headers, table_shards in files:
+            tasks = [
+                (options, table, start, stop,
+                 os.path.join(parts, f"{table}-{start}.csv"))
+                for table, start, stop in table_shards
+            ]
+
+            path = os.path.join(options.out, name)
+            with open(f"{path}.tmp", 'w', newline='') as out_csv:
+                csv.writer(out_csv).writerow(headers)
+
+                # imap hands back shards in order, as soon as each is done
+                for part in pool.imap(generate_shard, tasks):
+                    with open(part, newline='') as part_csv:
+                        copyfileobj(part_csv, out_csv)
+                    os.remove(part)
+
+            os.replace(f"{path}.tmp", path)
+            print(f"{name}: {len(tasks)} shards")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,52 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
+from math import gcd
 from random import uniform
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, now=None, rng=None):
+    """Get a random datetime within the `year_gap` years before `now`."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = (rng.uniform if rng else uniform)(
+        then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class Zipf:
+    """Draw user ids 1..n with a power-law (Zipf) distribution.
+
+    The rank-r user is drawn with probability proportional to 1 / r**s, so a
+    few "celebrities" are drawn very often and most users rarely. Ranks are
+    spread over ids by a fixed permutation, so celebrities aren't simply the
+    first users, and different `stride`s give different celebrities.
+    """
+
+    def __init__(self, n, s=1.0, stride=0.618):
+        self.n = n
+        self.s = s
+
+        # rank -> id is rank * multiplier mod n, a permutation when coprime
+        self.multiplier = max(1, int(n * stride)) | 1
+        while gcd(self.multiplier, n) != 1:
+            self.multiplier += 1
+
+    def rank(self, rng):
+        """Draw a rank, 0 being the most popular (inverse CDF sampling)."""
+
+        u = rng.random()
+        if self.s == 1:
+            x = (self.n + 1) ** u
+        else:
+            a = 1 - self.s
+            x = (((self.n + 1) ** a - 1) * u + 1) ** (1 / a)
+
+        return min(int(x) - 1, self.n - 1)
+
+    def id(self, rng):
+        """Draw an id."""
+
+        return self.rank(rng) * self.multiplier % self.n + 1
@@ -0,0 +1,451 @@
+"""A durable background job queue for Warbler, kept in the database.
+
+Work that doesn't have to finish before the response (fanning a message out
+to followers' inboxes, purging a deleted account) is enqueued as a job
+instead of being done inline:
+
+    purge_user.enqueue(user_id=user.id)
+    db.session.commit()
+
+A job is a row of the jobs table, inserted in the request's own transaction:
+workers only see it once the request commits, and never if it rolls back.
+
+Workers (`flask worker`) take due jobs with SELECT ... FOR UPDATE SKIP
+LOCKED, so any number of them can share a queue without taking the same job
+twice, and run each job in the transaction holding its row lock. A job's
+changes and its removal from the queue are committed together, so finished
+work is never redone. A job that raises is retried later, with exponential
+backoff, until it runs out of attempts and is marked failed.
+
+Long work is done in bounded steps: a task that returns a dict is run again
+(as the same job) with that as its arguments, e.g. its progress so far. Each
+step commits on its own, so no transaction holds locks for long.
+
+Jobs may be given an idempotency key: a key is only ever enqueued once
+(until finished jobs are purged after JOB_KEEP_SECONDS).
+
+Each queue is worked by its own processes, as many as JOB_CONCURRENCY says
+(e.g. "timelines=4,purges=1"), which caps how many of its jobs run at once
+per `flask worker`. See metrics.py for the queue's metrics.
+"""
+
+import multiprocessing
+import signal
+import time
+import traceback
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select, tuple_
+
+from models import (db, INSERTS, Job, Follows, LikedMessage, Message,
+                    TimelineEntry, User, supports_returning)
+
+# Tasks by name
+TASKS = {}
+
+
+class Task:
+    """A function that can be run as a background job."""
+
+    def __init__(self, function, queue, max_attempts):
+        self.function = function
+        self.name = function.__name__
+        self.queue = queue
+        self.max_attempts = max_attempts
+
+    def __call__(self, **args):
+        return self.function(**args)
+
+    def enqueue(self, key=None, delay=0, **args):
+        """Add a job running this task with `args` (JSON) to the session.
+
+        It can start once the session commits, and `delay` seconds have
+        passed. Returns False (and adds nothing) if a job with this `key`
+        was already enqueued.
+        """
+
+        insert = INSERTS[db.engine.dialect.name](Job.__table__)
+        now = datetime.utcnow()
+
+        return bool(db.session.execute(
+            insert
+            .values(queue=self.queue, task=self.name, args=args, key=key,
+                    attempts=0, max_attempts=self.max_attempts,
+                    enqueued_at=now, run_at=now + timedelta(seconds=delay))
+            .on_conflict_do_nothing(index_elements=['key'])
+        ).rowcount)
+
+
+def task(queue='default', max_attempts=5):
+    """Decorate a function (taking keyword arguments) as a task."""
+
+    def register(function):
+        TASKS[function.__name__] = Task(function, queue, max_attempts)
+        return TASKS[function.__name__]
+
+    return register
+
+
+##############################################################################
+# Running jobs
+
+def pending_jobs(queue):
+    """Query the pending jobs of a queue that are due."""
+
+    return Job.query.filter(Job.queue == queue,
+                            Job.finished_at.is_(None),
+                            Job.failed_at.is_(None),
+                            Job.run_at <= datetime.utcnow())
+
+
+def run_next(queue, metrics=None):
+    """Run the next due job of `queue`, if any, and commit.
+
+    Returns False if there was none.
+    """
+
+    job = (pending_jobs(queue)
+           .order_by(Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return False
+
+    queue, name = job.queue, job.task
+    wait = (datetime.utcnow() - job.run_at).total_seconds()
+    start = time.perf_counter()
+    job.attempts += 1
+
+    try:
+        # (a savepoint: if the task fails, only its own changes are undone
+        # and the job's row stays locked while the failure is recorded)
+        with db.session.begin_nested():
+            next_args = TASKS[job.task](**job.args)
+
+    except Exception:
+        job.last_error = traceback.format_exc()
+
+        if job.attempts >= job.max_attempts:
+            job.failed_at = datetime.utcnow()
+            outcome = 'failed'
+        else:
+            delay = current_app.config['JOB_RETRY_DELAY']
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=delay * 2 ** (job.attempts - 1))
+            outcome = 'retry'
+
+    else:
+        if next_args is not None:
+            job.args = next_args
+            job.attempts = 0
+            job.run_at = datetime.utcnow()
+            outcome = 'continued'
+        elif job.key is None:
+            db.session.delete(job)
+            outcome = 'ok'
+        else:
+            job.finished_at = datetime.utcnow()
+            outcome = 'ok'
+
+    db.session.commit()
+
+    if metrics is not None:
+        metrics.record_job(queue, name, outcome, wait,
+                           time.perf_counter() - start)
+
+    return True
+
+
+def run_pending(queues=None, metrics=None):
+    """Run due jobs of `queues` (default: all) until there are none left.
+
+    Returns how many were run. For tests, and `flask worker --once`.
+    """
+
+    if queues is None:
+        queues = {task.queue for task in TASKS.values()}
+
+    count = 0
+    for queue in sorted(queues):
+        while run_next(queue, metrics):
+            count += 1
+
+    return count
+
+
+def purge_finished(keep_seconds):
+    """Delete finished jobs (kept for their keys) older than `keep_seconds`."""
+
+    Job.query.filter(
+        Job.finished_at < datetime.utcnow() - timedelta(seconds=keep_seconds)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def job_counts():
+    """Jobs in the database by (queue, state), for the warbler_jobs gauge."""
+
+    counts = {(task.queue, state): 0
+              for task in TASKS.values() for state in ('pending', 'failed')}
+
+    rows = (db.session
+            .query(Job.queue, Job.failed_at.isnot(None), func.count())
+            .filter(Job.finished_at.is_(None))
+            .group_by(Job.queue, Job.failed_at.isnot(None)))
+
+    for queue, failed, count in rows:
+        counts[(queue, 'failed' if failed else 'pending')] = count
+
+    return counts
+
+
+##############################################################################
+# Worker processes
+
+def work(queue):
+    """Work one queue until SIGTERM/SIGINT (in a worker process)."""
+
+    from app import create_app, metrics
+
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.append(True))
+
+    app = create_app()
+
+    with app.app_context():
+        purged_at = 0
+
+        while not stopping:
+            purge = time.monotonic() - purged_at > 60
+            work_once(queue, metrics, purge)
+            if purge:
+                purged_at = time.monotonic()
+
+        db.session.remove()
+
+
+def work_once(queue, metrics=None, purge=False):
+    """Run the next job of `queue`, or wait JOB_POLL_INTERVAL for one.
+
+    Also deletes old finished jobs, if `purge`. Errors outside any job's
+    task (e.g. the database going away during a failover) are logged and
+    waited out, so the worker carries on once the database is back.
+    """
+
+    config = current_app.config
+
+    try:
+        ran = run_next(queue, metrics)
+        if purge:
+            purge_finished(config['JOB_KEEP_SECONDS'])
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Worker of queue %r failed", queue)
+        ran = False
+
+    if not ran:
+        time.sleep(config['JOB_POLL_INTERVAL'])
+
+
+def run_workers(concurrency):
+    """Run worker processes, e.g. `{'timelines': 4, 'purges': 1}`.
+
+    Returns once they have all exited: on SIGTERM or SIGINT each finishes
+    its current job first. They are spawned, not forked, so that none
+    inherits this process's database connections.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=work, args=(queue,),
+                                 name=f"warbler-worker-{queue}-{n}")
+                 for queue, count in concurrency.items()
+                 for n in range(count)]
+
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+
+    for process in processes:
+        process.join()
+
+
+def parse_concurrency(value):
+    """Parse JOB_CONCURRENCY, e.g. "timelines=4,purges=1"."""
+
+    concurrency = {}
+    for item in value.split(","):
+        if item.strip():
+            queue, _, count = item.partition("=")
+            concurrency[queue.strip()] = int(count or 1)
+
+    return concurrency
+
+
+##############################################################################
+# Tasks
+
+@task(queue='timelines')
+def fan_out_message(message_id, size):
+    """Deliver a new message to its followers' inboxes."""
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        TimelineEntry.fan_out(message, size)
+
+
+# Rows deleted per run of purge_user
+PURGE_BATCH = 1000
+
+
+def uncount(counter, user_ids):
+    """Take one off a counter of each user, per time they are listed."""
+
+    by_count = defaultdict(list)
+    for user_id, count in Counter(user_ids).items():
+        by_count[count].append(user_id)
+
+    for count, ids in by_count.items():
+        User.adjust_counters(ids, **{counter: -count})
+
+
+def delete_returning(table, key, condition, limit, returning):
+    """Delete up to `limit` rows of `table` matching `condition`.
+
+    Rows are picked by their primary key columns `key`. Returns the
+    `returning` column of the rows deleted. (Without DELETE ... RETURNING,
+    as on SQLite, the batch is selected first, then deleted by key.)
+    """
+
+    if supports_returning():
+        batch = select(*key).where(condition).limit(limit)
+
+        return [value for (value,) in db.session.execute(
+            table.delete()
+            .where(tuple_(*key).in_(batch))
+            .returning(returning))]
+
+    # (labelled, as it may be one of the key columns too)
+    rows = db.session.execute(
+        select(returning.label('value'), *key)
+        .where(condition).limit(limit)).all()
+    if rows:
+        db.session.execute(
+            table.delete()
+            .where(tuple_(*key).in_([tuple(row[1:]) for row in rows])))
+
+    return [row[0] for row in rows]
+
+
+def purge_followers(user_id, limit):
+    """Delete a batch of the user's followers' follows."""
+
+    follows = Follows.__table__
+    follower_ids = delete_returning(
+        follows, follows.primary_key.columns,
+        follows.c.user_being_followed_id == user_id, limit,
+        follows.c.user_following_id)
+
+    uncount('following_count', follower_ids)
+    return len(follower_ids)
+
+
+def purge_following(user_id, limit):
+    """Delete a batch of the user's follows."""
+
+    follows = Follows.__table__
+    followed_ids = delete_returning(
+        follows, follows.primary_key.columns,
+        follows.c.user_following_id == user_id, limit,
+        follows.c.user_being_followed_id)
+
+    uncount('followers_count', followed_ids)
+    return len(followed_ids)
+
+
+def purge_likes_received(user_id, limit):
+    """Delete a batch of likes of the user's messages."""
+
+    likes = LikedMessage.__table__
+    messages = Message.__table__
+    liker_ids = delete_returning(
+        likes, likes.primary_key.columns,
+        likes.c.message_id.in_(select(messages.c.id)
+                               .where(messages.c.user_id == user_id)),
+        limit, likes.c.user_id)
+
+    uncount('likes_count', liker_ids)
+    return len(liker_ids)
+
+
+def purge_messages(user_id, limit):
+    """Delete a batch of the user's messages.
+
+    (Which cascades to the inboxes they were delivered to.)
+    """
+
+    messages = Message.__table__
+    return len(delete_returning(
+        messages, [messages.c.id], messages.c.user_id == user_id, limit,
+        messages.c.id))
+
+
+def purge_likes(user_id, limit):
+    """Delete a batch of the user's likes."""
+
+    likes = LikedMessage.__table__
+    return len(delete_returning(
+        likes, likes.primary_key.columns, likes.c.user_id == user_id, limit,
+        likes.c.message_id))
+
+
+def purge_inbox(user_id, limit):
+    """Delete a batch of the user's home timeline inbox."""
+
+    entries = TimelineEntry.__table__
+    return len(delete_returning(
+        entries, entries.primary_key.columns, entries.c.user_id == user_id,
+        limit, entries.c.message_id))
+
+
+PURGE_STEPS = [
+    ('followers', purge_followers),
+    ('following', purge_following),
+    ('likes_received', purge_likes_received),
+    ('messages', purge_messages),
+    ('likes', purge_likes),
+    ('inbox', purge_inbox),
+]
+
+
+@task(queue='purges')
+def purge_user(user_id, purged=None):
+    """Delete a deleted user's rows, one batch (PURGE_BATCH rows) per run.
+
+    Their follows go first, then the likes of their messages, their
+    messages, their likes, their inbox and finally the user. The counters
+    of other users are fixed as the rows they count are deleted. Returns
+    the progress so far (rows purged, by step) until there's nothing left.
+    """
+
+    purged = dict(purged or {})
+
+    for step, delete_batch in PURGE_STEPS:
+        count = delete_batch(user_id, PURGE_BATCH)
+        if count:
+            purged[step] = purged.get(step, 0) + count
+            return dict(user_id=user_id, purged=purged)
+
+    db.session.execute(
+        User.__table__.delete().where(User.id == user_id))
@@ -0,0 +1,306 @@
+"""Production request metrics for Warbler, in Prometheus text format.
+
+For every request this records, labelled by Flask endpoint:
+
+- warbler_requests_total: requests by method and status code
+- warbler_request_duration_seconds: wall time, as a histogram
+- warbler_sql_statements: SQL statements run, as a histogram
+- warbler_db_duration_seconds: time spent in SQL, as a histogram
+- warbler_render_duration_seconds: time spent rendering Jinja templates
+
+and for background jobs (see jobs.py), labelled by queue:
+
+- warbler_jobs_total: jobs run by task and outcome (ok, continued, retry,
+  failed)
+- warbler_job_wait_seconds: time from due to started, as a histogram
+- warbler_job_duration_seconds: time running, as a histogram
+- warbler_jobs: jobs in the database by state (pending, failed), read
+  when scraped
+
+It hooks into Flask request hooks and signals and SQLAlchemy engine events,
+and costs a few dictionary updates per request. Metrics are served at
+/metrics (set METRICS_TOKEN to require `Authorization: Bearer <token>`).
+
+Each process keeps its own metrics. With several gunicorn workers, set
+METRICS_DIR to a directory they share: every worker then saves its totals
+there every few seconds, and /metrics adds up the saved totals of all of
+them.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from glob import glob
+
+from flask import Response, abort, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+METRICS = {
+    # name: (type, help text, label names, buckets)
+    'warbler_requests_total': (
+        'counter', "Requests handled.",
+        ('endpoint', 'method', 'status'), None),
+    'warbler_request_duration_seconds': (
+        'histogram', "Request latency.",
+        ('endpoint',), DURATION_BUCKETS),
+    'warbler_sql_statements': (
+        'histogram', "SQL statements per request.",
+        ('endpoint',), COUNT_BUCKETS),
+    'warbler_db_duration_seconds': (
+        'histogram', "Time per request spent in SQL.",
+        ('endpoint',), DURATION_BUCKETS),
+    'warbler_render_duration_seconds': (
+        'histogram', "Time per request spent rendering templates.",
+        ('endpoint',), DURATION_BUCKETS),
+    'warbler_jobs_total': (
+        'counter', "Background jobs run.",
+        ('queue', 'task', 'outcome'), None),
+    'warbler_job_wait_seconds': (
+        'histogram', "Time jobs waited to start once due.",
+        ('queue',), JOB_BUCKETS),
+    'warbler_job_duration_seconds': (
+        'histogram', "Time jobs took to run.",
+        ('queue',), JOB_BUCKETS),
+    'warbler_jobs': (
+        'gauge', "Jobs in the database.",
+        ('queue', 'state'), None),
+}
+
+
+class Metrics:
+    """Collects and serves per-endpoint request metrics."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in METRICS}
+        self._saved_at = 0
+        self._gauges = {}
+        self.dir = None
+        self.save_interval = 5.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install request hooks, signals, engine events and /metrics."""
+
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.dir = app.config['METRICS_DIR']
+        self.token = app.config['METRICS_TOKEN']
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        event.listen(Engine, 'before_cursor_execute', self._start_statement)
+        event.listen(Engine, 'after_cursor_execute', self._finish_statement)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    ##########################################################################
+    # Collection
+
+    def _start_request(self):
+        g.metrics = dict(start=time.perf_counter(), statements=0,
+                         db_time=0.0, render_time=0.0, render_start=[])
+
+    def _start_render(self, sender, template, context, **extra):
+        if 'metrics' in g:
+            g.metrics['render_start'].append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        if 'metrics' in g and g.metrics['render_start']:
+            started = g.metrics['render_start'].pop()
+            if not g.metrics['render_start']:  # don't count nested renders
+                g.metrics['render_time'] += time.perf_counter() - started
+
+    def _start_statement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        # statements on one connection run one at a time
+        conn.info['metrics_start'] = time.perf_counter()
+
+    def _finish_statement(self, conn, cursor, statement, parameters, context,
+                          executemany):
+        if has_request_context() and 'metrics' in g:
+            g.metrics['statements'] += 1
+            g.metrics['db_time'] += (time.perf_counter()
+                                     - conn.info['metrics_start'])
+
+    def _finish_request(self, response):
+        if 'metrics' not in g:
+            return response
+
+        stats = g.metrics
+        endpoint = request.endpoint or "none"
+        elapsed = time.perf_counter() - stats['start']
+
+        with self._lock:
+            self._inc('warbler_requests_total',
+                      (endpoint, request.method, str(response.status_code)))
+            self._observe('warbler_request_duration_seconds',
+                          (endpoint,), elapsed)
+            self._observe('warbler_sql_statements',
+                          (endpoint,), stats['statements'])
+            self._observe('warbler_db_duration_seconds',
+                          (endpoint,), stats['db_time'])
+            self._observe('warbler_render_duration_seconds',
+                          (endpoint,), stats['render_time'])
+
+        if self.dir and time.monotonic() - self._saved_at > self.save_interval:
+            self.save()
+
+        return response
+
+    def record_job(self, queue, task, outcome, wait, duration):
+        """Record one run of a background job."""
+
+        with self._lock:
+            self._inc('warbler_jobs_total', (queue, task, outcome))
+            self._observe('warbler_job_wait_seconds', (queue,), wait)
+            self._observe('warbler_job_duration_seconds', (queue,), duration)
+
+        if self.dir and time.monotonic() - self._saved_at > self.save_interval:
+            self.save()
+
+    def add_gauge(self, name, read):
+        """Have `read()` give the values of a gauge, whenever scraped.
+
+        `read` returns {labels tuple: value}. Gauges are read by the process
+        serving /metrics, and never saved or added up across processes.
+        """
+
+        self._gauges[name] = read
+
+    def _inc(self, name, labels, amount=1):
+        values = self._values[name]
+        values[labels] = values.get(labels, 0) + amount
+
+    def _observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        series = self._values[name].get(labels)
+
+        if series is None:
+            # one count per bucket, then +Inf, then the sum
+            series = self._values[name][labels] = [0] * (len(buckets) + 2)
+
+        series[bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+    ##########################################################################
+    # Sharing between worker processes
+
+    def save(self):
+        """Save this process's metrics to METRICS_DIR."""
+
+        with self._lock:
+            data = {name: [[list(labels), value]
+                           for labels, value in values.items()]
+                    for name, values in self._values.items()}
+            self._saved_at = time.monotonic()
+
+        path = os.path.join(self.dir, f"metrics-{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """Get metrics of this process plus other workers' saved metrics."""
+
+        with self._lock:
+            merged = {name: {labels: (list(value)
+                                      if isinstance(value, list) else value)
+                             for labels, value in values.items()}
+                      for name, values in self._values.items()}
+
+        if not self.dir:
+            return merged
+
+        own_file = f"metrics-{os.getpid()}.json"
+
+        for path in glob(os.path.join(self.dir, "metrics-*.json")):
+            if os.path.basename(path) == own_file:
+                continue
+
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for name, series in data.items():
+                for labels, value in series:
+                    labels = tuple(labels)
+                    current = merged[name].get(labels)
+                    if current is None:
+                        merged[name][labels] = value
+                    elif isinstance(value, list):
+                        merged[name][labels] = [
+                            a + b for a, b in zip(current, value)]
+                    else:
+                        merged[name][labels] = current + value
+
+        return merged
+
+    ##########################################################################
+    # Exposition
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+
+        lines = []
+        collected = self.collect()
+        for name, read in self._gauges.items():
+            collected[name] = read()
+
+        for name, values in collected.items():
+            kind, help_text, label_names, buckets = METRICS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in sorted(values.items()):
+                label_text = ",".join(
+                    f'{label}="{escape_label(str(label_value))}"'
+                    for label, label_value in zip(label_names, labels))
+
+                if kind in ('counter', 'gauge'):
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip([*buckets, "+Inf"], value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}}'
+                                 f" {cumulative}")
+                lines.append(f"{name}_sum{{{label_text}}} {value[-1]}")
+                lines.append(f"{name}_count{{{label_text}}} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        """Serve metrics to a Prometheus scraper."""
+
+        if (self.token
+                and request.headers.get('Authorization')
+                != f"Bearer {self.token}"):
+            abort(401)
+
+        return Response(self.render(),
+                        content_type="text/plain; version=0.0.4")
+
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+
+    return (value
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'))
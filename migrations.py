@@ -0,0 +1,147 @@
+"""Versioned schema migrations for Warbler.
+
+`db.create_all()` creates missing tables, with every index the models
+declare, but never changes a table that already exists. Changes to
+existing tables are listed here as numbered migrations. The schema_version
+table records which ones a database has had, and `flask migrate` creates
+any missing tables, then applies the rest in order, each in its own
+transaction.
+
+A new database gets the current schema straight from the models, so
+`flask create-db` records every migration as applied without running it.
+
+To change the schema, change the models, then append a migration making the
+same change to an existing database. Write it for Postgres, and so that it
+can be run again safely (IF NOT EXISTS): a database rebuilt with
+create_all() may already have the change.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select, text
+
+from models import db, User
+
+schema_version = db.Table(
+    'schema_version',
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('description', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+# (version, description, SQL statements), oldest first
+MIGRATIONS = [
+    (1, "Row versions of users, for conditional GETs", [
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()",
+    ]),
+    (2, "Indexes for profiles, likes pages, home timelines and following", [
+        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp "
+        "ON messages (user_id, timestamp, id)",
+        "CREATE INDEX IF NOT EXISTS ix_liked_messages_user_id_timestamp "
+        "ON liked_messages (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_follows_user_following_id "
+        "ON follows (user_following_id, user_being_followed_id)",
+    ]),
+    (3, "Deleted users, hidden at once and purged in the background", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS ix_users_deleted "
+        "ON users (id) WHERE deleted_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_timeline_entries_message_id "
+        "ON timeline_entries (message_id)",
+        # (so queries are planned knowing that hardly anyone is deleted)
+        "ANALYZE users",
+    ]),
+    (4, "Denormalized counters and profile versions of users", [
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 1",
+        # (the counts so far, as User.recount() would: one grouped count
+        # per table)
+        "UPDATE users SET messages_count = counts.count "
+        "FROM (SELECT user_id AS id, count(*) FROM messages "
+        "GROUP BY user_id) AS counts WHERE users.id = counts.id",
+        "UPDATE users SET followers_count = counts.count "
+        "FROM (SELECT user_being_followed_id AS id, count(*) FROM follows "
+        "GROUP BY user_being_followed_id) AS counts "
+        "WHERE users.id = counts.id",
+        "UPDATE users SET following_count = counts.count "
+        "FROM (SELECT user_following_id AS id, count(*) FROM follows "
+        "GROUP BY user_following_id) AS counts WHERE users.id = counts.id",
+        "UPDATE users SET likes_count = counts.count "
+        "FROM (SELECT user_id AS id, count(*) FROM liked_messages "
+        "GROUP BY user_id) AS counts WHERE users.id = counts.id",
+    ]),
+    (5, "Likes pages' index covers their (timestamp, message_id) order", [
+        "CREATE INDEX IF NOT EXISTS "
+        "ix_liked_messages_user_id_timestamp_message_id "
+        "ON liked_messages (user_id, timestamp, message_id)",
+        "DROP INDEX IF EXISTS ix_liked_messages_user_id_timestamp",
+    ]),
+]
+
+
+def current_version():
+    """The version of the connected database's schema (0 if unversioned)."""
+
+    schema_version.create(db.engine, checkfirst=True)
+
+    return db.session.execute(
+        select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def record(version, description):
+    db.session.execute(schema_version.insert().values(
+        version=version, description=description,
+        applied_at=datetime.utcnow()))
+
+
+def migrate(log=print):
+    """Apply pending migrations, in order. Returns how many were applied.
+
+    Tables added since the database was made (e.g. timeline_entries, jobs)
+    are created from the models first, as migrations may index them.
+    """
+
+    db.create_all()
+
+    version = current_version()
+    pending = [migration for migration in MIGRATIONS
+               if migration[0] > version]
+
+    for version, description, statements in pending:
+        for statement in statements:
+            db.session.execute(text(statement))
+
+        record(version, description)
+        db.session.commit()
+        log(f"Applied migration {version}: {description}")
+
+    return len(pending)
+
+
+def create_db(log=print):
+    """Create any missing tables, then bring the schema up to date.
+
+    A database without tables is created from the models and marked as
+    having every migration.
+    """
+
+    is_new = not inspect(db.engine).has_table(User.__tablename__)
+
+    if is_new:
+        db.create_all()
+        for version, description, _ in MIGRATIONS:
+            record(version, description)
+        db.session.commit()
+
+    return migrate(log)
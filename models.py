@@ -2,11 +2,16 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    and_, event, func, literal, or_, select, text, true, tuple_, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, with_loader_criteria
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import PasswordHasher
+from replicas import RoutingSQLAlchemy
+
+bcrypt = PasswordHasher()
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,6 +31,132 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # Who a user follows (following pages, timelines). Who follows a user
+    # is served by the primary key, which starts with the followed id.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def follow(cls, user_id, user_ids):
+        """Have a user follow these users, in a single INSERT.
+
+        Users that don't exist (or are deleted), the user themself and users
+        already followed are skipped. Adjusts both sides' counters; returns
+        the ids newly followed. The cost doesn't depend on how many users are
+        followed already. (Without INSERT ... RETURNING, as on SQLite, the
+        users not followed yet are selected first.)
+        """
+
+        if not user_ids:
+            return []
+
+        followable = (select(User.id, literal(user_id))
+                      .where(User.id.in_(user_ids), User.id != user_id,
+                             User.deleted_at.is_(None)))
+
+        insert = INSERTS[db.engine.dialect.name](cls.__table__)
+        if supports_returning():
+            followed_ids = [followed_id for (followed_id,) in
+                            db.session.execute(
+                                insert
+                                .from_select(['user_being_followed_id',
+                                              'user_following_id'],
+                                             followable)
+                                .on_conflict_do_nothing()
+                                .returning(cls.user_being_followed_id))]
+        else:
+            followed = (select(cls.user_being_followed_id)
+                        .where(cls.user_following_id == user_id))
+            followed_ids = [followed_id for (followed_id, _) in
+                            db.session.execute(
+                                followable.where(User.id.notin_(followed)))]
+            if followed_ids:
+                db.session.execute(
+                    insert.values([
+                        dict(user_being_followed_id=followed_id,
+                             user_following_id=user_id)
+                        for followed_id in followed_ids])
+                    .on_conflict_do_nothing())
+
+        if followed_ids:
+            User.adjust_counters(user_id, following_count=len(followed_ids))
+            User.adjust_counters(followed_ids, followers_count=1)
+
+        return followed_ids
+
+    @classmethod
+    def unfollow(cls, user_id, user_ids):
+        """Have a user stop following these users, in a single DELETE.
+
+        Adjusts both sides' counters; returns the ids no longer followed.
+        (Without DELETE ... RETURNING, the users followed are selected first.)
+        """
+
+        if not user_ids:
+            return []
+
+        if supports_returning():
+            unfollowed_ids = [followed_id for (followed_id,) in
+                              db.session.execute(
+                                  cls.__table__.delete()
+                                  .where(cls.user_following_id == user_id,
+                                         cls.user_being_followed_id.in_(
+                                             user_ids))
+                                  .returning(cls.user_being_followed_id))]
+        else:
+            unfollowed_ids = [followed_id for (followed_id,) in
+                              db.session.execute(
+                                  select(cls.user_being_followed_id)
+                                  .where(cls.user_following_id == user_id,
+                                         cls.user_being_followed_id.in_(
+                                             user_ids)))]
+            if unfollowed_ids:
+                db.session.execute(
+                    cls.__table__.delete()
+                    .where(cls.user_following_id == user_id,
+                           cls.user_being_followed_id.in_(unfollowed_ids)))
+
+        if unfollowed_ids:
+            User.adjust_counters(user_id,
+                                 following_count=-len(unfollowed_ids))
+            User.adjust_counters(unfollowed_ids, followers_count=-1)
+
+        return unfollowed_ids
+
+    @classmethod
+    def states(cls, user_id, user_ids):
+        """Resolve follow state between a user and a batch of users.
+
+        Returns (following_ids, follower_ids): the ids among `user_ids` that
+        the user follows, and the ids among them that follow the user.
+        Uses one query however many users are asked about.
+        """
+
+        following_ids, follower_ids = set(), set()
+
+        if not user_ids:
+            return following_ids, follower_ids
+
+        edges = db.session.query(
+            cls.user_being_followed_id,
+            cls.user_following_id,
+        ).filter(or_(
+            (cls.user_following_id == user_id)
+            & cls.user_being_followed_id.in_(user_ids),
+            (cls.user_being_followed_id == user_id)
+            & cls.user_following_id.in_(user_ids),
+        ))
+
+        for followed_id, follower_id in edges:
+            if follower_id == user_id:
+                following_ids.add(followed_id)
+            if followed_id == user_id:
+                follower_ids.add(follower_id)
+
+        return following_ids, follower_ids
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,8 +203,80 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped whenever the profile (username, image, ...) changes, so caches
+    # of anything showing the profile can tell they are out of date
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    # Denormalized counts, so the profile header doesn't need to load (or
+    # COUNT) whole relationships. Kept up to date by the routes that post,
+    # delete, follow, unfollow, like and unlike; repair with User.recount().
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Bumped, with updated_at, whenever the user or anything shown on their
+    # pages changes (profile, counters, follows, likes), so pages can be
+    # revalidated by version instead of re-rendered
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # Set when the account is deleted: from then on the user and their
+    # messages are left out of every query (see hide_deleted_users) while a
+    # background job purges their rows (see jobs.purge_user)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # The (few) deleted users, which every query of messages leaves out
+    __table_args__ = (
+        db.Index('ix_users_deleted', 'id',
+                 postgresql_where=text("deleted_at IS NOT NULL")),
+    )
+
     messages = db.relationship(
         'Message',
+        back_populates='user',
         order_by='Message.timestamp.desc()')
 
     liked_messages = db.relationship(
@@ -86,32 +289,127 @@ class User(db.Model):
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        overlaps="following",
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        overlaps="followers",
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def liked_message_ids(self, message_ids):
+        """Get the set of ids among `message_ids` of messages this user likes.
+
+        `message_ids` are e.g. the messages on the page being rendered: they
+        are checked in one query, so the cost depends on the size of the page
+        rather than on how many messages the user has ever liked.
+        """
+
+        return LikedMessage.liked_ids(self.id, message_ids)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query.filter_by(
+                user_being_followed_id=self.id,
+                user_following_id=other_user.id,
+            ).exists()
+        ).scalar()
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return db.session.query(
+            Follows.query.filter_by(
+                user_being_followed_id=other_user.id,
+                user_following_id=self.id,
+            ).exists()
+        ).scalar()
+
+    def follow_states(self, user_ids):
+        """Resolve follow state between this user and a batch of users.
+
+        See Follows.states.
+        """
+
+        return Follows.states(self.id, user_ids)
+
+    @classmethod
+    def adjust_counters(cls, user_ids, **deltas):
+        """Add `deltas` to counters of these users in a single UPDATE.
+
+        `user_ids` is a user id, list of ids or a select of ids, e.g.:
+
+            User.adjust_counters(user.id, following_count=1)
+
+        Call this in the same transaction as the change being counted. Also
+        bumps the users' versions.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        cls.query.filter(cls.id.in_(user_ids)).update({
+            **{getattr(cls, name): getattr(cls, name) + delta
+               for name, delta in deltas.items()},
+            **cls.next_version(),
+        }, synchronize_session=False)
+
+    @classmethod
+    def next_version(cls):
+        """Values for an UPDATE that bumps users' versions."""
+
+        return {cls.version: cls.version + 1,
+                cls.updated_at: datetime.utcnow()}
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute the denormalized counters from the source tables.
+
+        Recounts every user if `user_ids` is None.
+        """
+
+        counters = {
+            cls.messages_count: Message.user_id,
+            cls.followers_count: Follows.user_being_followed_id,
+            cls.following_count: Follows.user_following_id,
+            cls.likes_count: LikedMessage.user_id,
+        }
+
+        if user_ids is not None:
+            cls.query.filter(cls.id.in_(user_ids)).update({
+                **{counter: (select(func.count())
+                             .where(column == cls.id)
+                             .scalar_subquery())
+                   for counter, column in counters.items()},
+                **cls.next_version(),
+            }, synchronize_session=False)
+            return
+
+        # For everyone, one grouped count per table is far cheaper than a
+        # subquery per user
+        cls.query.update({
+            **{counter: 0 for counter in counters},
+            **cls.next_version(),
+        }, synchronize_session=False)
+
+        for counter, column in counters.items():
+            counts = (select(column.label('id'), func.count().label('count'))
+                      .group_by(column)
+                      .subquery())
+            db.session.execute(
+                update(cls)
+                .where(cls.id == counts.c.id)
+                .values({counter: counts.c.count})
+                .execution_options(synchronize_session=False))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -120,7 +418,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = bcrypt.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -141,6 +439,9 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different work factor than is
+        configured now, it is transparently re-hashed (the caller commits).
         """
 
         user = cls.query.filter_by(username=username).first()
@@ -148,6 +449,8 @@ class User(db.Model):
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
+                if bcrypt.needs_rehash(user.password):
+                    user.password = bcrypt.generate_password_hash(password)
                 return user
 
         return False
@@ -180,7 +483,15 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship('User')
+    # Lazy by default; listing queries ask for authors up front with
+    # joinedload(Message.user) rather than loading one per rendered message
+    user = db.relationship('User', back_populates='messages')
+
+    # A user's messages, newest first (profiles, timelines)
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
 
 
 class LikedMessage(db.Model):
@@ -206,6 +517,363 @@ class LikedMessage(db.Model):
         default=datetime.utcnow,
     )
 
+    # A user's likes, newest first (likes pages, paged by keyset on
+    # (timestamp, message_id))
+    __table_args__ = (
+        db.Index('ix_liked_messages_user_id_timestamp_message_id',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    @classmethod
+    def like(cls, user_id, message_ids):
+        """Have a user like these messages, in a single INSERT.
+
+        Messages that don't exist, are the user's own, are by a deleted user
+        or are already liked are skipped. Adjusts the user's likes_count;
+        returns how many messages were newly liked. The cost doesn't depend
+        on how many likes the user already has.
+        """
+
+        if not message_ids:
+            return 0
+
+        likable = (select(literal(user_id), Message.id,
+                          literal(datetime.utcnow()))
+                   .join(User, User.id == Message.user_id)
+                   .where(Message.id.in_(message_ids),
+                          Message.user_id != user_id,
+                          User.deleted_at.is_(None)))
+
+        insert = INSERTS[db.engine.dialect.name](cls.__table__)
+        liked = db.session.execute(
+            insert
+            .from_select(['user_id', 'message_id', 'timestamp'], likable)
+            .on_conflict_do_nothing()
+        ).rowcount
+
+        if liked:
+            User.adjust_counters(user_id, likes_count=liked)
+
+        return liked
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """The ids among `message_ids` of messages a user likes (one query)."""
+
+        if not message_ids:
+            return set()
+
+        return {message_id for (message_id,) in (
+            db.session.query(cls.message_id)
+            .filter(cls.user_id == user_id,
+                    cls.message_id.in_(message_ids)))}
+
+    @classmethod
+    def unlike(cls, user_id, message_ids):
+        """Have a user unlike these messages, in a single DELETE.
+
+        Adjusts the user's likes_count; returns how many likes were removed.
+        """
+
+        if not message_ids:
+            return 0
+
+        unliked = cls.query.filter(
+            cls.user_id == user_id,
+            cls.message_id.in_(message_ids),
+        ).delete(synchronize_session=False)
+
+        if unliked:
+            User.adjust_counters(user_id, likes_count=-unliked)
+
+        return unliked
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted_users(state):
+    """Leave deleted users, and their messages, out of every ORM query.
+
+    Queries with the `include_deleted` execution option see everything, as
+    do refreshes of objects already loaded. (Core statements on tables
+    aren't affected.)
+    """
+
+    if (not state.is_select
+            or state.is_column_load
+            or state.execution_options.get('include_deleted')):
+        return
+
+    users = User.__table__
+    deleted_ids = select(users.c.id).where(users.c.deleted_at.isnot(None))
+
+    state.statement = state.statement.options(
+        with_loader_criteria(User, User.deleted_at.is_(None),
+                             include_aliases=True),
+        with_loader_criteria(Message, Message.user_id.notin_(deleted_ids),
+                             include_aliases=True),
+    )
+
+
+# INSERT constructs with ON CONFLICT support, by dialect
+INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def supports_returning():
+    """Whether INSERT and DELETE can return the rows they touch.
+
+    Postgres can; SQLite can't (not as far as SQLAlchemy 1.4 knows), so
+    callers select the rows first there.
+    """
+
+    return db.engine.dialect.full_returning
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's materialized home timeline ("inbox").
+
+    Used when the app runs with push-model (fan-out-on-write) timelines:
+    posting a message copies a pointer to it into the inbox of the author and
+    of every follower, so reading the home page is a single range scan over
+    one user's inbox instead of an IN (...) query over everyone they follow.
+
+    Each inbox is bounded to the most recent `size` entries.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # (for deleting messages, which cascades to their entries)
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def deliver(cls, rows):
+        """Insert entries from a select of (user_id, message_id, timestamp).
+
+        Entries already in an inbox are skipped: a message's fan-out job
+        may run after a follow has backfilled it into the follower's inbox.
+        """
+
+        # (SQLite reads the ON of ON CONFLICT as a join's, unless the select
+        # has a WHERE)
+        insert = INSERTS[db.engine.dialect.name](cls.__table__)
+        db.session.execute(
+            insert
+            .from_select(['user_id', 'message_id', 'timestamp'],
+                         rows.where(true()))
+            .on_conflict_do_nothing(index_elements=['user_id', 'message_id']))
+
+    @classmethod
+    def fan_out(cls, message, size):
+        """Deliver `message` to its author's and followers' inboxes.
+
+        Message must already be flushed (so it has an id and timestamp).
+        """
+
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == message.user_id))
+        recipients = followers.union_all(select(literal(message.user_id)))
+
+        cls.deliver(select(recipients.subquery().c[0],
+                           literal(message.id),
+                           literal(message.timestamp)))
+
+        cls.trim(recipients, size)
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, size):
+        """Copy the most recent messages of `followed_id` into an inbox."""
+
+        recent = (select(literal(user_id), Message.id, Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(size))
+
+        cls.deliver(recent)
+
+        cls.trim([user_id], size)
+
+    @classmethod
+    def rebuild(cls, user_id, size):
+        """Recompute an inbox from scratch with the pull-model query.
+
+        Used after an unfollow (the inbox has to be topped up from the
+        remaining followed users) and to populate inboxes for existing users.
+        """
+
+        author_ids = (select(Follows.user_being_followed_id)
+                      .where(Follows.user_following_id == user_id)
+                      .union_all(select(literal(user_id))))
+        recent = (select(literal(user_id), Message.id, Message.timestamp)
+                  .where(Message.user_id.in_(author_ids))
+                  .order_by(Message.timestamp.desc())
+                  .limit(size))
+
+        cls.query.filter(cls.user_id == user_id).delete(
+            synchronize_session=False)
+        cls.deliver(recent)
+
+    @classmethod
+    def is_full(cls, user_id, size):
+        """Does a user's inbox hold `size` entries (so may have lost some)?"""
+
+        return (db.session.query(cls.message_id)
+                .filter(cls.user_id == user_id)
+                .offset(size - 1)
+                .limit(1)
+                .first()) is not None
+
+    @classmethod
+    def trim(cls, user_ids, size):
+        """Drop everything but the newest `size` entries of these inboxes.
+
+        `user_ids` may be a list or a select of user ids. Each inbox is
+        trimmed below its (size + 1)th newest entry, found by stepping
+        `size` entries down its index, so the cost depends on `size` and
+        what's dropped, not on how many entries the inboxes hold.
+        """
+
+        recipients = (select(User.id.label('user_id'))
+                      .where(User.id.in_(user_ids))
+                      .subquery('recipients'))
+
+        newer = cls.__table__.alias('newer')
+        if db.engine.dialect.name == 'sqlite':
+            # (no LATERAL: compare each entry with its own inbox's cutoff)
+            cutoff = (select(newer.c.timestamp, newer.c.message_id)
+                      .where(newer.c.user_id == cls.user_id)
+                      .order_by(newer.c.timestamp.desc(),
+                                newer.c.message_id.desc())
+                      .offset(size)
+                      .limit(1)
+                      .scalar_subquery())
+            overflow = (select(cls.user_id, cls.message_id)
+                        .where(cls.user_id.in_(select(recipients.c.user_id)),
+                               tuple_(cls.timestamp, cls.message_id)
+                               <= cutoff))
+        else:
+            cutoff = (select(newer.c.timestamp, newer.c.message_id)
+                      .where(newer.c.user_id == recipients.c.user_id)
+                      .order_by(newer.c.timestamp.desc(),
+                                newer.c.message_id.desc())
+                      .offset(size)
+                      .limit(1)
+                      .lateral('cutoff'))
+            overflow = (select(cls.user_id, cls.message_id)
+                        .select_from(recipients)
+                        .join(cutoff, true())
+                        .join(cls, and_(
+                            cls.user_id == recipients.c.user_id,
+                            tuple_(cls.timestamp, cls.message_id)
+                            <= tuple_(cutoff.c.timestamp,
+                                      cutoff.c.message_id))))
+
+        cls.query.filter(
+            tuple_(cls.user_id, cls.message_id).in_(overflow)
+        ).delete(synchronize_session=False)
+
+
+class Job(db.Model):
+    """A unit of deferred work in the job queue (see jobs.py).
+
+    A job is pending until it finishes (jobs with a key are kept, marked
+    finished, so the key can't be enqueued again; others are deleted) or
+    runs out of attempts (marked failed, and kept for inspection).
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    queue = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    task = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # Idempotency key: a job is only enqueued once per key
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    enqueued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # Not run before this (later after each failed attempt)
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        # workers take the pending job of a queue that is due first
+        db.Index('ix_jobs_queue_run_at', 'queue', 'run_at',
+                 postgresql_where=text(
+                     "finished_at IS NULL AND failed_at IS NULL")),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -215,3 +883,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
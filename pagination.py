@@ -0,0 +1,116 @@
+"""Keyset (cursor) pagination for Warbler timelines.
+
+Timelines are ordered newest-first on a (timestamp, id) key. Instead of an
+OFFSET, each page is fetched with a `WHERE (timestamp, id) < cursor` range
+condition, so a page deep into someone's history costs the same as the first.
+"""
+
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque-ish cursor string from a (timestamp, id) key."""
+
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into a (timestamp, id) key.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    timestamp, _, id = cursor.rpartition("_")
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+class Page:
+    """One page of a keyset-paginated timeline.
+
+    `before` is the cursor for the next (older) page and `after` the cursor
+    for the previous (newer) page; either is None when there is no such page.
+    `last` is the cursor of the last (oldest) item, if there are any.
+    """
+
+    def __init__(self, items, before=None, after=None, last=None):
+        self.items = items
+        self.before = before
+        self.after = after
+        self.last = last
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate(query, timestamp_col, id_col, before=None, after=None,
+             per_page=20):
+    """Fetch one newest-first page of `query`, keyed on (timestamp, id).
+
+    `before`/`after` are decoded cursors: the page holds the items
+    immediately older than `before` or immediately newer than `after`
+    (at most one of them should be given).
+
+    Items are whatever `query` selects: model instances, or tuples of
+    values for a query of several columns.
+    """
+
+    width = len(query.column_descriptions)
+    key = tuple_(timestamp_col, id_col)
+    query = query.add_columns(timestamp_col, id_col)
+
+    if after:
+        rows = (query
+                .filter(key > tuple_(*after))
+                .order_by(timestamp_col.asc(), id_col.asc())
+                .limit(per_page + 1)
+                .all())
+        has_newer, has_older = len(rows) > per_page, True
+        rows = list(reversed(rows[:per_page]))
+
+    else:
+        if before:
+            query = query.filter(key < tuple_(*before))
+        rows = (query
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(per_page + 1)
+                .all())
+        has_newer, has_older = bool(before), len(rows) > per_page
+        rows = rows[:per_page]
+
+    if not rows:
+        return Page([])
+
+    last = encode_cursor(*rows[-1][width:])
+
+    return Page(
+        [row[0] if width == 1 else tuple(row[:width]) for row in rows],
+        before=last if has_older else None,
+        after=encode_cursor(*rows[0][width:]) if has_newer else None,
+        last=last,
+    )
+
+
+def get_page_args():
+    """Get keyset pagination arguments from the querystring.
+
+    Returns (before, after, per_page). Responds with 400 for a bad cursor.
+    """
+
+    try:
+        before, after = [decode_cursor(request.args[name])
+                         if request.args.get(name) else None
+                         for name in ('before', 'after')]
+    except ValueError:
+        abort(400)
+
+    config = current_app.config
+    per_page = request.args.get('limit', config['MESSAGES_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, config['MAX_MESSAGES_PER_PAGE']))
+
+    return before, after, per_page
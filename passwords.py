@@ -0,0 +1,134 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing and checking run on a small, bounded
+pool of threads (bcrypt releases the GIL while it works) rather than
+directly on request threads. At most PASSWORD_HASH_QUEUE operations may be
+running or waiting at once; beyond that, callers wait up to
+PASSWORD_HASH_TIMEOUT seconds for room and then get PasswordHasherBusy,
+which the app turns into a fast 503 instead of letting a login burst tie up
+every worker.
+
+That bound is per process. PASSWORD_HASH_CONCURRENCY also caps operations
+running or waiting across every process on the host (see ratelimit.py's
+HostSlots); past it, callers get PasswordHasherBusy at once rather than
+queueing behind work the CPUs can't get to soon.
+
+The work factor is BCRYPT_LOG_ROUNDS. Hashes made with a different factor
+still verify, and `needs_rehash` tells callers to upgrade them.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from ratelimit import HostSlots
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashing operations are already queued."""
+
+
+class PasswordHasher:
+    """Bounded, off-request-thread bcrypt hashing."""
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = os.cpu_count() or 1
+        self.max_pending = self.workers * 4
+        self.timeout = 2.0
+        self.host_slots = None
+
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from the Flask app config."""
+
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', self.workers)
+        app.config.setdefault('PASSWORD_HASH_QUEUE',
+                              app.config['PASSWORD_HASH_WORKERS'] * 4)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', self.timeout)
+        app.config.setdefault('PASSWORD_HASH_CONCURRENCY', None)
+        app.config.setdefault('PASSWORD_HASH_LOCK_FILE', None)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.max_pending = app.config['PASSWORD_HASH_QUEUE']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+        concurrency = app.config['PASSWORD_HASH_CONCURRENCY']
+        lock_file = app.config['PASSWORD_HASH_LOCK_FILE']
+        self.host_slots = (HostSlots(lock_file, concurrency)
+                           if concurrency and lock_file else None)
+
+        self._executor = None
+
+    def _submit(self, fn, *args):
+        """Run `fn(*args)` on the hashing pool and wait for its result."""
+
+        host_slot = None
+        if self.host_slots is not None:
+            host_slot = self.host_slots.acquire()
+            if host_slot is None:
+                raise PasswordHasherBusy()
+
+        try:
+            return self._submit_locally(fn, *args)
+        finally:
+            if host_slot is not None:
+                self.host_slots.release(host_slot)
+
+    def _submit_locally(self, fn, *args):
+        """Run `fn(*args)` once there's room in this process's queue."""
+
+        with self._lock:
+            # Threads don't survive a fork, so each process gets its own pool
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="password-hasher")
+                self._executor_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+
+            slots = self._slots
+            executor = self._executor
+
+        if not slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy()
+
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+
+    def generate_password_hash(self, password):
+        """Hash `password` with the configured work factor."""
+
+        return self._submit(
+            lambda: bcrypt.hashpw(
+                password.encode('utf-8'), bcrypt.gensalt(self.rounds)
+            ).decode('utf-8'))
+
+    def check_password_hash(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._submit(
+            lambda: bcrypt.checkpw(
+                password.encode('utf-8'), pw_hash.encode('utf-8')))
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
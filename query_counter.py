@@ -0,0 +1,50 @@
+"""Count the SQL statements an engine executes.
+
+Used by the tests to pin down how many queries a route may run:
+
+    with max_queries(db.engine, 5):
+        client.get("/")
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Record statements executed on `engine` while in the `with` block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.parameters = []
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def max_queries(engine, limit):
+    """Fail with AssertionError if the block runs more than `limit` queries."""
+
+    with QueryCounter(engine) as counter:
+        yield counter
+
+    if counter.count > limit:
+        statements = "\n\n".join(counter.statements)
+        raise AssertionError(
+            f"{counter.count} queries run, expected at most {limit}:\n\n"
+            f"{statements}")
@@ -0,0 +1,217 @@
+"""Rate limiting and admission control for Warbler, shared across processes.
+
+Posts to the routes in RATE_LIMITS (logging in, signing up, editing a
+profile, posting a message) draw from token buckets: one per client IP and
+one per logged-in user, per route. A limit of (10, 60) allows a burst of 10,
+then one more every 6 seconds. A request finding its bucket empty is turned
+away with a 429 and a Retry-After header, before the route does any work.
+
+The buckets live in a memory-mapped file in RATE_LIMIT_DIR, so every
+gunicorn worker on the host draws from the same ones. The file is a fixed
+table of BUCKET_SLOTS slots, indexed by a hash of the bucket's key. Each
+slot is locked (with an fcntl byte-range lock) only while it's updated. A
+key finding its slot used by another key starts with a full bucket, so
+collisions only ever make limits more lenient.
+
+HostSlots caps how many of something (bcrypt operations, see passwords.py)
+run at once across every process on the host, again with byte-range locks:
+the kernel releases those of a process that dies, so none leak.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+# A bucket: key hash, tokens left, when they were counted
+SLOT = struct.Struct("<Qdd")
+BUCKET_SLOTS = 1 << 16
+
+# Methods that are never limited (they don't do the work worth limiting)
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+def parse_rate_limits(value):
+    """Parse RATE_LIMITS, e.g. "warbler.login=10/60,warbler.signup=5/60".
+
+    Returns {endpoint: (requests, seconds)}.
+    """
+
+    limits = {}
+    for item in value.split(","):
+        if item.strip():
+            endpoint, _, limit = item.partition("=")
+            requests, _, seconds = limit.partition("/")
+            limits[endpoint.strip()] = (int(requests), float(seconds))
+
+    return limits
+
+
+class SharedFile:
+    """A file shared between processes, locked a byte range at a time.
+
+    Each process opens it once (a forked child opens it again).
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+            self._pid = os.getpid()
+            self.opened()
+
+        return self._fd
+
+    def opened(self):
+        """Called once the file is open in this process."""
+
+    def lock(self, offset, length, blocking=True):
+        """Lock a byte range; returns False if not blocking and it's taken."""
+
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self.fileno(), flags, length, offset)
+        except (BlockingIOError, PermissionError):
+            return False
+
+        return True
+
+    def unlock(self, offset, length):
+        fcntl.lockf(self.fileno(), fcntl.LOCK_UN, length, offset)
+
+
+class SharedBuckets(SharedFile):
+    """Token buckets in a memory-mapped file."""
+
+    def __init__(self, path, slots=BUCKET_SLOTS):
+        super().__init__(path, slots * SLOT.size)
+        self.slots = slots
+        self._map = None
+
+    def opened(self):
+        self._map = mmap.mmap(self._fd, self.size)
+
+    def take(self, key, requests, seconds):
+        """Take a token from bucket `key`, if it has one.
+
+        The bucket holds `requests` tokens, refilled over `seconds`. Returns
+        0 if there was a token, otherwise how many seconds until there will
+        be.
+        """
+
+        tag = int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        offset = tag % self.slots * SLOT.size
+        rate = requests / seconds
+        now = time.time()
+
+        # (byte-range locks don't exclude the threads of one process)
+        with self._lock:
+            self.lock(offset, SLOT.size)
+            try:
+                slot_tag, tokens, counted_at = SLOT.unpack_from(self._map,
+                                                                offset)
+                if slot_tag != tag:
+                    tokens, counted_at = requests, now
+
+                tokens = min(requests,
+                             tokens + max(0, now - counted_at) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / rate
+
+                SLOT.pack_into(self._map, offset, tag, tokens, now)
+            finally:
+                self.unlock(offset, SLOT.size)
+
+        return wait
+
+
+class HostSlots(SharedFile):
+    """At most `count` holders at once, across every process on the host.
+
+    Slot i is a lock on byte i of the file.
+    """
+
+    def __init__(self, path, count):
+        super().__init__(path, max(count, 1))
+        self.count = count
+        self._held = set()
+
+    def opened(self):
+        self._held = set()
+
+    def acquire(self):
+        """Take a free slot, without waiting; returns it, or None."""
+
+        with self._lock:
+            self.fileno()
+
+            for slot in range(self.count):
+                if slot not in self._held and self.lock(slot, 1, False):
+                    self._held.add(slot)
+                    return slot
+
+        return None
+
+    def release(self, slot):
+        with self._lock:
+            self.unlock(slot, 1)
+            self._held.discard(slot)
+
+
+class RateLimiter:
+    """Turns away posts over their route's limits with a fast 429."""
+
+    def __init__(self, app=None, session_key="curr_user"):
+        self.session_key = session_key
+        self.buckets = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.buckets = SharedBuckets(
+            os.path.join(app.config['RATE_LIMIT_DIR'], "buckets"))
+
+        app.before_request(self.check)
+
+    def check(self):
+        """Take a token from the client's and the user's buckets."""
+
+        if request.method in SAFE_METHODS:
+            return
+
+        limit = current_app.config['RATE_LIMITS'].get(request.endpoint)
+        if limit is None:
+            return
+
+        keys = [f"{request.endpoint} ip {request.remote_addr}"]
+        user_id = session.get(self.session_key)
+        if user_id is not None:
+            keys.append(f"{request.endpoint} user {user_id}")
+
+        wait = max(self.buckets.take(key, *limit) for key in keys)
+        if wait:
+            raise TooManyRequests(
+                "Too many requests, please slow down.",
+                retry_after=math.ceil(wait))
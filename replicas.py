@@ -0,0 +1,88 @@
+"""Read-replica routing for Warbler.
+
+When a "replica" bind is configured (DATABASE_REPLICA_URL), GET and HEAD
+requests read from it; everything else, and every write, goes to the
+primary:
+
+- A session routed to the replica sends SELECTs there. The first flush or
+  other statement switches it back to the primary for the rest of the
+  session, so a request always reads its own writes.
+- After a request that may have written (any POST), the user's session
+  cookie pins them to the primary for REPLICA_PIN_SECONDS, so they don't
+  see a stale page while the replica catches up.
+
+To try it locally, point DATABASE_REPLICA_URL at a copy of the database, or
+at a streaming replica of a second local Postgres.
+"""
+
+import time
+
+from flask import request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+
+REPLICA_BIND = 'replica'
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class RoutingSession(SignallingSession):
+    """Session that can send its reads to the replica."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('use_replica'):
+            if (self._flushing or clause is None
+                    or not getattr(clause, 'is_select', False)):
+                # writing: read from the primary from now on
+                self.info['use_replica'] = False
+            else:
+                return self.db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """Decides per request whether `db.session` may read from the replica."""
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Install request hooks."""
+
+        app.config.setdefault('REPLICA_PIN_SECONDS', 10)
+        self.app = app
+        self.db = db
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    @property
+    def enabled(self):
+        return REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or ())
+
+    def _start_request(self):
+        self.db.session.info['use_replica'] = (
+            self.enabled
+            and request.method in SAFE_METHODS
+            and session.get('primary_until', 0) < time.time())
+
+    def _finish_request(self, response):
+        if self.enabled and request.method not in SAFE_METHODS:
+            session['primary_until'] = (
+                time.time() + self.app.config['REPLICA_PIN_SECONDS'])
+
+        return response
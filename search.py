@@ -0,0 +1,210 @@
+"""Indexed, ranked user search for Warbler.
+
+On Postgres, username + bio are indexed with a full-text (tsvector)
+expression index, and usernames with pg_trgm (substring and fuzzy matching)
+when that extension is available. Without pg_trgm, search falls back to
+word-prefix matching only.
+
+On SQLite, an FTS5 table mirrors users, kept in sync by triggers.
+
+The indexes are created along with the users table; for a database created
+before search existed, run `flask create-search-indexes`.
+"""
+
+import re
+
+from sqlalchemy import DDL, case, event, func, literal_column, or_, text
+
+from models import db, User
+
+# Must match the expression in the index exactly for Postgres to use it
+USER_DOCUMENT = (
+    "to_tsvector('simple', coalesce(username, '') || ' ' || coalesce(bio, ''))")
+
+POSTGRES_TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)",
+]
+
+POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+    "ON users ((lower(username) COLLATE \"C\"))",
+    f"CREATE INDEX IF NOT EXISTS ix_users_document "
+    f"ON users USING gin (({USER_DOCUMENT}))",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, bio, content='users', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+    "BEGIN INSERT INTO users_fts (rowid, username, bio) "
+    "VALUES (new.id, new.username, new.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+    "BEGIN INSERT INTO users_fts (users_fts, rowid, username, bio) "
+    "VALUES ('delete', old.id, old.username, old.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE ON users "
+    "BEGIN INSERT INTO users_fts (users_fts, rowid, username, bio) "
+    "VALUES ('delete', old.id, old.username, old.bio); "
+    "INSERT INTO users_fts (rowid, username, bio) "
+    "VALUES (new.id, new.username, new.bio); END",
+    "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+]
+
+
+def trigram_available(bind):
+    """Can the pg_trgm extension be installed on this Postgres server?"""
+
+    return bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).first() is not None
+
+
+for statement in POSTGRES_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in POSTGRES_TRIGRAM_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(
+                     dialect='postgresql',
+                     callable_=lambda ddl, target, bind, **kw:
+                         trigram_available(bind)))
+
+for statement in SQLITE_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+
+def create_search_indexes():
+    """Create the search indexes for an existing users table."""
+
+    statements = {
+        'postgresql': POSTGRES_DDL,
+        'sqlite': SQLITE_DDL,
+    }.get(db.engine.dialect.name, [])
+
+    if (db.engine.dialect.name == 'postgresql'
+            and trigram_available(db.session)):
+        statements = POSTGRES_TRIGRAM_DDL + statements
+
+    for statement in statements:
+        db.session.execute(text(statement))
+
+    db.session.commit()
+    _trigram_installed.clear()
+
+
+# engine url -> whether pg_trgm is installed there
+_trigram_installed = {}
+
+
+def trigram_installed():
+    """Is pg_trgm installed in the connected Postgres database?"""
+
+    url = str(db.engine.url)
+
+    if url not in _trigram_installed:
+        _trigram_installed[url] = db.session.execute(text(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )).first() is not None
+
+    return _trigram_installed[url]
+
+
+def search_terms(query):
+    """Split a search query into words, dropping punctuation."""
+
+    return re.findall(r"\w+", query.lower())
+
+
+def escape_like(value):
+    """Escape LIKE wildcards in user input (use with escape='\\')."""
+
+    return (value
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def search_users(query, page=1, per_page=24):
+    """Find users matching `query` in username or bio, best matches first.
+
+    Every word of the query must match (the last one as a prefix, so this
+    also serves search-as-you-type). Returns (users, has_next_page).
+    """
+
+    terms = search_terms(query)
+    if not terms:
+        return [], False
+
+    if db.engine.dialect.name == 'postgresql':
+        results = _search_users_postgres(query, terms)
+    elif db.engine.dialect.name == 'sqlite':
+        results = _search_users_sqlite(terms)
+    else:
+        results = (User.query
+                   .filter(User.username.ilike(f"%{escape_like(query)}%",
+                                               escape="\\"))
+                   .order_by(User.username))
+
+    users = results.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return users[:per_page], len(users) > per_page
+
+
+def _search_users_postgres(query, terms):
+    """Ranked search over the full-text and (if present) trigram indexes."""
+
+    document = literal_column(USER_DOCUMENT)
+    tsquery = func.to_tsquery(
+        'simple', " & ".join(f"{term}:*" for term in terms))
+    pattern = escape_like(query.strip())
+
+    matches = document.op('@@')(tsquery)
+    rank = (func.ts_rank(document, tsquery)
+            + case((User.username.ilike(f"{pattern}%", escape="\\"), 1),
+                   else_=0))
+
+    # Substring matches on usernames are only cheap with a trigram index
+    if trigram_installed():
+        matches = or_(
+            User.username.ilike(f"%{pattern}%", escape="\\"), matches)
+        rank = rank + func.similarity(User.username, query)
+
+    return (User.query
+            .filter(matches)
+            .order_by(rank.desc(), User.id))
+
+
+def _search_users_sqlite(terms):
+    """Ranked search over the FTS5 mirror table."""
+
+    match = " ".join(f'"{term}"*' for term in terms)
+    fts = text(
+        "SELECT rowid AS id, bm25(users_fts, 10.0, 1.0) AS rank FROM users_fts "
+        "WHERE users_fts MATCH :match"
+    ).bindparams(match=match).columns(id=db.Integer, rank=db.Float).subquery()
+
+    return (User.query
+            .join(fts, fts.c.id == User.id)
+            .order_by(fts.c.rank, User.id))
+
+
+def autocomplete_usernames(prefix, limit=10):
+    """Get up to `limit` users whose username starts with `prefix`."""
+
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+
+    username = func.lower(User.username)
+
+    # A "C" collation index serves both the prefix LIKE and the ordering
+    if db.engine.dialect.name == 'postgresql':
+        username = username.collate("C")
+
+    return (User.query
+            .filter(username.like(f"{escape_like(prefix)}%", escape="\\"))
+            .order_by(username)
+            .limit(limit)
+            .all())
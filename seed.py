@@ -1,21 +1,12 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+Drops and recreates all tables, then bulk-loads generator/*.csv. For big
+data sets or other directories, use bulk_load.py directly.
+"""
 
-from models import User, Message, Follows
-from app import db
-from csv import DictReader
+from app import create_app
+from bulk_load import load_all
 
+create_app()  # configures the database
 
-db.drop_all()
-db.create_all()
-
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+load_all('generator', reset=True)
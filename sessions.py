@@ -0,0 +1,287 @@
+"""Server-side sessions for Warbler, kept in files.
+
+The session cookie only holds a random session id; the session itself is a
+file in SESSION_DIR, written (atomically) only when the session changes.
+Every web process must see the same directory: the default, under the
+system's temporary directory, suits any number of processes on one host.
+Point it at a tmpfs such as /dev/shm to keep sessions in shared memory.
+
+Sessions unused for PERMANENT_SESSION_LIFETIME are expired, and their files
+swept away, every hour or so, by whichever process next saves a session.
+Anonymous sessions (nobody logged in: e.g. just a CSRF token) are kept in
+their own directory, and expire after SESSION_ANONYMOUS_LIFETIME, so that
+visitors who never log in can't fill SESSION_DIR. A session gets a new id
+whenever someone logs in or out with it (see FileSession.regenerate), so an
+id handed out before can't be used after.
+
+The same directory caches a snapshot of each logged-in user: a Viewer, with
+just what every page shows of them (the nav bar's link and picture). Pages
+read it from `g.viewer` without a query; the snapshot is forgotten when the
+user edits their profile, or deletes their account.
+"""
+
+import json
+import os
+import re
+import secrets
+import tempfile
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Session ids: 32 random bytes, URL-safe base64
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{43}")
+
+# Seconds between refreshes of an unchanged session's mtime (its last use),
+# and between sweeps of expired sessions
+TOUCH_SECONDS = 60 * 60
+SWEEP_SECONDS = 60 * 60
+
+
+class Viewer:
+    """What every page needs of the logged-in user."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+    def __repr__(self):
+        return f"<Viewer #{self.id}: {self.username}>"
+
+
+class FileSession(CallbackDict, SessionMixin):
+    """A session, marked modified when changed and accessed when read."""
+
+    def __init__(self, initial=None, sid=None, anonymous=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.anonymous = anonymous  # (where it's stored, if it is)
+        self.regenerated = False
+        self.modified = False
+        self.accessed = False
+
+    def regenerate(self):
+        """Save this session under a new id, dropping the old one."""
+
+        self.regenerated = True
+        self.modified = True
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+
+class FileSessions(SessionInterface):
+    """Flask session interface keeping sessions (and viewers) in files."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, app=None, session_key="curr_user"):
+        self.session_key = session_key
+        self.directory = None
+        self.lifetime = None
+        self.anonymous_lifetime = None
+        self._swept_at = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['SESSION_DIR']
+        self.lifetime = app.permanent_session_lifetime.total_seconds()
+        self.anonymous_lifetime = app.config['SESSION_ANONYMOUS_LIFETIME']
+
+        for name in ("viewers", "anonymous"):
+            os.makedirs(os.path.join(self.directory, name), mode=0o700,
+                        exist_ok=True)
+        app.session_interface = self
+
+    ##########################################################################
+    # Sessions
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+
+        if sid and SESSION_ID.fullmatch(sid):
+            for anonymous in (False, True):
+                data = self.load(sid, anonymous)
+                if data is not None:
+                    return FileSession(data, sid, anonymous)
+
+        return FileSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.sid is not None:
+                self.delete(session.sid, session.anonymous)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        anonymous = self.session_key not in session
+        if session.sid is not None and (session.regenerated or
+                                        session.anonymous != anonymous):
+            self.delete(session.sid, session.anonymous)
+            if session.regenerated:
+                session.sid = None
+
+        new = session.sid is None
+        if new or session.modified or session.anonymous != anonymous:
+            session.sid = self.save(dict(session), session.sid, anonymous)
+            session.anonymous = anonymous
+
+        if new or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+
+    def load(self, sid, anonymous=False):
+        """The data of session `sid`, or None if it's gone or expired."""
+
+        try:
+            with open(self.session_path(sid, anonymous), "rb") as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        lifetime = self.anonymous_lifetime if anonymous else self.lifetime
+        age = time.time() - mtime
+        if age > lifetime:
+            self.delete(sid, anonymous)
+            return None
+
+        if age > min(TOUCH_SECONDS, lifetime / 4):
+            self.touch(sid, anonymous)
+
+        return self.serializer.loads(data.decode())
+
+    def save(self, data, sid=None, anonymous=False):
+        """Save `data` as session `sid` (or a new one); returns its id."""
+
+        if sid is None:
+            sid = secrets.token_urlsafe(32)
+            self.sweep()
+
+        self.write(self.session_path(sid, anonymous),
+                   self.serializer.dumps(data))
+
+        return sid
+
+    def delete(self, sid, anonymous=False):
+        remove(self.session_path(sid, anonymous))
+
+    def touch(self, sid, anonymous=False):
+        try:
+            os.utime(self.session_path(sid, anonymous))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Delete expired sessions, if not done lately by this process.
+
+        Cached viewers not reloaded for as long are deleted too.
+        """
+
+        now = time.time()
+        if now - self._swept_at < SWEEP_SECONDS:
+            return
+        self._swept_at = now
+
+        for name, lifetime in [("", self.lifetime),
+                               ("viewers", self.lifetime),
+                               ("anonymous", self.anonymous_lifetime)]:
+            with os.scandir(os.path.join(self.directory, name)) as entries:
+                for entry in entries:
+                    try:
+                        if (entry.is_file() and now - entry.stat().st_mtime
+                                > lifetime):
+                            remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def session_path(self, sid, anonymous=False):
+        if anonymous:
+            return os.path.join(self.directory, "anonymous", sid)
+
+        return os.path.join(self.directory, sid)
+
+    ##########################################################################
+    # Viewers
+
+    def viewer(self, user_id):
+        """The cached snapshot of user `user_id`, or None if not cached."""
+
+        try:
+            with open(self.viewer_path(user_id)) as f:
+                return Viewer(*json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def cache_viewer(self, user):
+        """Cache (and return) a snapshot of `user`."""
+
+        viewer = Viewer(user.id, user.username, user.image_url)
+        self.write(self.viewer_path(user.id),
+                   json.dumps([viewer.id, viewer.username, viewer.image_url]))
+
+        return viewer
+
+    def forget_viewer(self, user_id):
+        """Drop the cached snapshot of a user (after they change)."""
+
+        remove(self.viewer_path(user_id))
+
+    def viewer_path(self, user_id):
+        return os.path.join(self.directory, "viewers", str(int(user_id)))
+
+    ##########################################################################
+
+    def write(self, path, text):
+        """Replace the file at `path` with `text`, atomically."""
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        except BaseException:
+            remove(temp_path)
+            raise
+
+
+def remove(path):
+    """Delete a file, if it's still there."""
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,161 @@
+"""JSON API tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, LikedMessage
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create test client, two users (u1 following u2) and messages."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        messages = [Message(text=f"message {n}", user_id=u2.id)
+                    for n in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.message_ids = [message.id for message in messages]
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_timeline(self):
+        """test the timeline pages through followed users' messages"""
+
+        with self.client as c:
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json['error']['status'], 401)
+
+            self.login(c)
+            resp = c.get("/api/v1/timeline?limit=2")
+            data = resp.json
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([message['id'] for message in data['messages']],
+                             self.message_ids[:0:-1])
+            self.assertEqual(data['messages'][0]['liked'], False)
+            self.assertEqual(data['users'],
+                             {str(self.u2_id): dict(id=self.u2_id,
+                                                    username="u2",
+                                                    image_url=User.image_url
+                                                    .default.arg)})
+
+            resp = c.get(f"/api/v1/timeline?limit=2&before={data['before']}")
+
+            self.assertEqual([message['id'] for message in resp.json['messages']],
+                             self.message_ids[:1])
+            self.assertIsNone(resp.json['before'])
+
+    def test_sparse_fields(self):
+        """test only the fields asked for are sent"""
+
+        with self.client as c:
+            resp = c.get(f"/api/v1/users/{self.u2_id}/messages"
+                         "?fields[messages]=id,text&fields[users]=")
+
+            self.assertEqual(resp.json['messages'][0],
+                             dict(id=self.message_ids[-1], text="message 2"))
+            self.assertEqual(resp.json['users'], {})
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}"
+                         "?fields[users]=username,bio")
+
+            self.assertEqual(resp.json, dict(user=dict(username="u2",
+                                                       bio=None)))
+
+            resp = c.get("/api/v1/users/1?fields[users]=password")
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.json['error']['message'])
+
+    def test_message(self):
+        """test a message, and a missing one"""
+
+        with self.client as c:
+            resp = c.get(f"/api/v1/messages/{self.message_ids[0]}")
+
+            self.assertEqual(resp.json['message']['text'], "message 0")
+            self.assertTrue(resp.json['message']['timestamp'].endswith("Z"))
+            self.assertNotIn("liked", resp.json['message'])
+
+            resp = c.get("/api/v1/messages/0")
+
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.content_type, "application/json")
+
+    def test_change_likes(self):
+        """test liking and unliking a batch of messages"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post("/api/v1/likes",
+                          json=dict(like=self.message_ids + [0]))
+
+            self.assertEqual(resp.json, dict(liked=3, unliked=0))
+
+            resp = c.post("/api/v1/likes",
+                          json=dict(like=self.message_ids[:1],
+                                    unlike=self.message_ids[1:]))
+
+            self.assertEqual(resp.json, dict(liked=0, unliked=2))
+            self.assertEqual(
+                [like.message_id for like in LikedMessage.query.all()],
+                self.message_ids[:1])
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            resp = c.post("/api/v1/likes", json=dict(like="1,2"))
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.post("/api/v1/likes", data=dict(like=1))
+            self.assertEqual(resp.status_code, 415)
+
+    def test_change_follows(self):
+        """test following and unfollowing a batch of users"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post("/api/v1/follows", json=dict(unfollow=[self.u2_id]))
+
+            self.assertEqual(resp.json, dict(followed=0, unfollowed=1))
+            self.assertEqual(Follows.query.count(), 0)
+
+            resp = c.post("/api/v1/follows",
+                          json=dict(follow=[self.u1_id, self.u2_id, 0]))
+
+            self.assertEqual(resp.json, dict(followed=1, unfollowed=0))
+            self.assertEqual(Follows.query.count(), 1)
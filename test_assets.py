@@ -0,0 +1,104 @@
+"""Static asset pipeline tests."""
+
+from wsgi import app
+from app import assets
+import brotli
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from assets import build
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test building, resolving and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build a copy of the static files."""
+
+        self.static_dir = tempfile.mkdtemp()
+        shutil.copytree(app.static_folder, self.static_dir, dirs_exist_ok=True)
+        self.manifest = build(self.static_dir, log=lambda line: None)
+
+        assets.dist_dir = os.path.join(self.static_dir, "dist")
+        assets.load_manifest()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Go back to the app's own (unbuilt) static files."""
+
+        assets.dist_dir = os.path.join(app.static_folder, "dist")
+        assets.load_manifest()
+        shutil.rmtree(self.static_dir)
+
+    def test_build(self):
+        """test hashed names, compressed copies and rewritten CSS URLs"""
+
+        css = self.manifest["stylesheets/style.css"]
+        self.assertRegex(css, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+
+        dist = os.path.join(self.static_dir, "dist")
+        self.assertTrue(os.path.exists(os.path.join(dist, css + ".gz")))
+        self.assertFalse(os.path.exists(os.path.join(
+            dist, self.manifest["images/warbler-hero.jpg"] + ".gz")))
+
+        with gzip.open(os.path.join(dist, css + ".gz"), "rt") as f:
+            self.assertIn(
+                f'url("/assets/{self.manifest["images/nav-bg.png"]}")',
+                f.read())
+
+    def test_static_url(self):
+        """test templates link the hashed names"""
+
+        with app.test_request_context():
+            self.assertEqual(
+                assets.static_url("/static/images/default-pic.png"),
+                f"/assets/{self.manifest['images/default-pic.png']}")
+            self.assertEqual(assets.static_url("https://a.test/x.png"),
+                             "https://a.test/x.png")
+
+        resp = self.client.get("/users")
+        self.assertIn(f'href="/assets/{self.manifest["stylesheets/style.css"]}"',
+                      resp.get_data(as_text=True))
+
+    def test_serve(self):
+        """test precompressed copies are served, cached for a year"""
+
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        self.assertNotIn("Set-Cookie", resp.headers)
+        self.assertIn(b"background-image",
+                      gzip.decompress(resp.get_data()))
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
+
+    def test_serve_brotli(self):
+        """test a brotli copy is built, and preferred when accepted"""
+
+        css = self.manifest['stylesheets/style.css']
+        self.assertTrue(os.path.exists(
+            os.path.join(self.static_dir, "dist", css + ".br")))
+
+        resp = self.client.get(f"/assets/{css}",
+                               headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn(b"background-image", brotli.decompress(resp.get_data()))
+        resp.close()
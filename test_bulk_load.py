@@ -0,0 +1,84 @@
+"""Bulk loader tests."""
+
+from wsgi import app
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User, Message, Follows
+from bulk_load import load_all
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+
+CSV_FILES = {
+    'users.csv': (
+        "id,email,username,image_url,password,bio,header_image_url,location\n"
+        "9001,a@test.com,alice,,HASHED_PASSWORD,\"Hi, I'm Alice\",,\n"
+        "9002,b@test.com,bob,,HASHED_PASSWORD,,,Boston\n"),
+    'messages.csv': (
+        "id,text,timestamp,user_id\n"
+        "9001,hello,2021-01-01 00:00:00,9001\n"
+        "9002,world,2021-01-02 00:00:00,9001\n"),
+    'follows.csv': (
+        "user_being_followed_id,user_following_id\n"
+        "9001,9002\n"),
+}
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading CSV files."""
+
+    def setUp(self):
+        """Empty the tables and write a small data set."""
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        for name, content in CSV_FILES.items():
+            with open(os.path.join(self.dir.name, name), "w") as f:
+                f.write(content)
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the CSV files."""
+
+        db.session.rollback()
+        self.dir.cleanup()
+
+    def test_load_all(self):
+        """test rows, counters and id sequences after a load"""
+
+        with app.app_context():
+            loaded = load_all(self.dir.name, log=lambda line: None)
+
+        self.assertEqual(loaded, {'users': 2, 'messages': 2, 'follows': 1})
+
+        alice = User.query.get(9001)
+        bob = User.query.get(9002)
+        self.assertEqual(alice.bio, "Hi, I'm Alice")
+        self.assertIsNone(alice.location)
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertEqual(bob.following_count, 1)
+        self.assertEqual(Follows.query.count(), 1)
+
+        message = Message(text="new", user_id=bob.id)
+        db.session.add(message)
+        db.session.commit()
+        self.assertGreater(message.id, 9002)
+
+    def test_keeps_indexes(self):
+        """test secondary indexes are rebuilt after loading"""
+
+        def index_names():
+            return {name for name, in db.session.execute(db.text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'users'"))}
+
+        before = index_names()
+        with app.app_context():
+            load_all(self.dir.name, log=lambda line: None)
+
+        self.assertEqual(index_names(), before)
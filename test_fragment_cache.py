@@ -0,0 +1,114 @@
+"""Fragment cache tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY, fragment_cache
+import os
+from unittest import TestCase
+from models import db, User, Message, LikedMessage
+from fragment_cache import FragmentCache
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the LRU cache itself."""
+
+    def test_lru_eviction(self):
+        """test least recently used entries go first once over the cap"""
+
+        cache = FragmentCache(max_bytes=10)
+        cache.set((1, 1), "aaaa")
+        cache.set((2, 1), "bbbb")
+        cache.get((1, 1))
+        cache.set((3, 1), "cccc")
+
+        self.assertEqual(cache.get((1, 1)), "aaaa")
+        self.assertIsNone(cache.get((2, 1)))
+        self.assertEqual(cache.size, 8)
+
+    def test_invalidate(self):
+        """test invalidating an id drops all of its versions"""
+
+        cache = FragmentCache()
+        cache.set((1, 1), "old")
+        cache.set((1, 2), "new")
+        cache.set((2, 1), "other")
+        cache.invalidate(1)
+
+        self.assertIsNone(cache.get((1, 1)))
+        self.assertIsNone(cache.get((1, 2)))
+        self.assertEqual(len(cache), 1)
+
+
+class MessageFragmentTestCase(TestCase):
+    """Test cached rendering of timeline messages."""
+
+    def setUp(self):
+        """Create test client, a viewer and an author with a message."""
+
+        User.query.delete()
+        Message.query.delete()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        viewer = User(username="viewer",
+                      email="viewer@test.com",
+                      password="HASHED_PASSWORD")
+        author = User(username="author",
+                      email="author@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([viewer, author])
+        db.session.commit()
+
+        author.messages.append(Message(text="cached message"))
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.message_id = author.messages[0].id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def get_profile(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            return c.get(f"/users/{self.author_id}").get_data(as_text=True)
+
+    def test_cached_and_star_spliced(self):
+        """test a message is rendered once but its star follows the viewer"""
+
+        html = self.get_profile()
+        self.assertIn("cached message</p>", html)
+        self.assertIn(f'action="/messages/{self.message_id}/like"', html)
+        self.assertEqual(len(fragment_cache), 1)
+
+        db.session.add(LikedMessage(user_id=self.viewer_id,
+                                    message_id=self.message_id))
+        db.session.commit()
+
+        hits = fragment_cache.hits
+        html = self.get_profile()
+        self.assertEqual(fragment_cache.hits, hits + 1)
+        self.assertIn(f'action="/messages/{self.message_id}/unlike"', html)
+
+    def test_profile_edit_changes_key(self):
+        """test an author's profile change is picked up"""
+
+        self.get_profile()
+
+        author = User.query.get(self.author_id)
+        author.username = "renamed"
+        author.profile_version = User.profile_version + 1
+        db.session.commit()
+
+        self.assertIn("@renamed</a>", self.get_profile())
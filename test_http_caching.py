@@ -0,0 +1,147 @@
+"""HTTP caching (conditional GET) tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+from unittest import TestCase
+from flask import template_rendered
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test validators, 304s and Cache-Control on pages."""
+
+    def setUp(self):
+        """Create test client, two users and a message."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        m1 = Message(text="hello", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.rendered = []
+        template_rendered.connect(self.record_render, app)
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        template_rendered.disconnect(self.record_render, app)
+
+    def record_render(self, sender, template, context, **extra):
+        self.rendered.append(template.name)
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_not_modified(self):
+        """test a current ETag gets a 304 without rendering"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers['Cache-Control'])
+            self.assertIn("no-cache", resp.headers['Cache-Control'])
+            self.assertNotIn("no-store", resp.headers['Cache-Control'])
+            self.assertIn("Cookie", resp.headers['Vary'])
+
+            self.rendered.clear()
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(self.rendered, [])
+
+    def test_changes_invalidate(self):
+        """test following a user changes the validators of their page"""
+
+        with self.client as c:
+            self.login(c)
+
+            etag = c.get(f"/users/{self.u2_id}").headers['ETag']
+            c.post(f"/users/follow/{self.u2_id}")
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_viewers_differ(self):
+        """test another viewer's copy isn't current"""
+
+        with self.client as c:
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn("public", resp.headers['Cache-Control'])
+
+            self.login(c)
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": resp.headers['ETag']})
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_session_pages_private(self):
+        """test an anonymous page setting a session cookie isn't public"""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.u2_id}")
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+        self.assertIn("Set-Cookie", resp.headers)
+        self.assertIn("private", resp.headers['Cache-Control'])
+        self.assertNotIn("public", resp.headers['Cache-Control'])
+
+    def test_last_modified(self):
+        """test If-Modified-Since is honoured"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.u2_id}/likes")
+            last_modified = resp.headers['Last-Modified']
+
+            resp = c.get(f"/users/{self.u2_id}/likes",
+                         headers={"If-Modified-Since": last_modified})
+
+            self.assertEqual(resp.status_code, 304)
+
+    def test_other_responses(self):
+        """test other pages aren't stored, and static files are"""
+
+        with self.client as c:
+            resp = c.get("/users")
+            self.assertIn("no-store", resp.headers['Cache-Control'])
+            self.assertNotIn("ETag", resp.headers)
+
+            resp = c.get("/static/favicon.ico")
+            self.assertNotIn("no-store", resp.headers.get('Cache-Control', ""))
+            resp.close()
@@ -0,0 +1,239 @@
+"""Background job queue tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY, metrics
+import os
+from unittest import TestCase
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import DBAPIError
+from models import db, User, Message, Follows, LikedMessage, Job
+import jobs
+from jobs import task, run_next, run_pending, job_counts, work_once
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@task(queue='test', max_attempts=2)
+def remember(value, fail=False):
+    """Record `value` (then fail, if asked)."""
+
+    calls.append(value)
+    User.query.filter_by(username="u1").update({'bio': value})
+
+    if fail:
+        raise ValueError(value)
+
+
+class JobsTestCase(TestCase):
+    """Test enqueueing and running jobs."""
+
+    def setUp(self):
+        """Create test client and a user; empty the queue."""
+
+        Job.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        calls.clear()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_run_after_commit(self):
+        """test jobs run once committed, and are then removed"""
+
+        remember.enqueue(value="rolled back")
+        db.session.rollback()
+        remember.enqueue(value="committed")
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, ["committed"])
+        self.assertEqual(User.query.get(self.u1_id).bio, "committed")
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_idempotency_key(self):
+        """test a key is only enqueued once, even after it has run"""
+
+        self.assertTrue(remember.enqueue(key="once", value="first"))
+        self.assertFalse(remember.enqueue(key="once", value="second"))
+        db.session.commit()
+        run_pending()
+
+        self.assertFalse(remember.enqueue(key="once", value="third"))
+        db.session.commit()
+        run_pending()
+
+        self.assertEqual(calls, ["first"])
+
+    def test_retry_then_fail(self):
+        """test a failing job is undone, retried later, then marked failed"""
+
+        with app.app_context():
+            app.config['JOB_RETRY_DELAY'] = 0
+            remember.enqueue(value="boom", fail=True)
+            db.session.commit()
+
+            self.assertTrue(run_next('test'))
+            job = Job.query.one()
+            self.assertEqual(job.attempts, 1)
+            self.assertIsNone(job.failed_at)
+            self.assertIsNone(User.query.get(self.u1_id).bio)
+
+            self.assertTrue(run_next('test'))
+            job = Job.query.one()
+            self.assertEqual(job.attempts, 2)
+            self.assertIsNotNone(job.failed_at)
+            self.assertIn("ValueError: boom", job.last_error)
+
+            self.assertFalse(run_next('test'))
+            self.assertEqual(calls, ["boom", "boom"])
+            self.assertEqual(job_counts()[('test', 'failed')], 1)
+
+    def test_delay(self):
+        """test a delayed job isn't run before it is due"""
+
+        remember.enqueue(value="later", delay=60)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 0)
+        self.assertEqual(job_counts()[('test', 'pending')], 1)
+
+    def test_worker_survives_database_errors(self):
+        """test a worker logs a database error, then carries on"""
+
+        remember.enqueue(value="after the error")
+        db.session.commit()
+
+        # (a failed statement leaves the session unusable, much as a
+        # dropped connection does)
+        with self.assertRaises(DBAPIError):
+            db.session.execute(text("SELECT 1 / 0"))
+
+        interval = app.config['JOB_POLL_INTERVAL']
+        app.config['JOB_POLL_INTERVAL'] = 0
+        try:
+            with self.assertLogs(app.logger, 'ERROR'):
+                with app.app_context():
+                    work_once('test', purge=True)
+            self.assertEqual(calls, [])
+
+            with app.app_context():
+                work_once('test', purge=True)
+        finally:
+            app.config['JOB_POLL_INTERVAL'] = interval
+
+        self.assertEqual(calls, ["after the error"])
+
+    def test_delete_user_hides_then_purges(self):
+        """test a deleted user is hidden at once, then purged in batches"""
+
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add(u2)
+        db.session.commit()
+        u2_id = u2.id
+
+        m1 = Message(text="from u1", user_id=self.u1_id)
+        m2 = Message(text="from u2", user_id=u2_id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        m1_id, m2_id = m1.id, m2.id
+
+        Follows.follow(self.u1_id, [u2_id])
+        Follows.follow(u2_id, [self.u1_id])
+        LikedMessage.like(self.u1_id, [m2_id])
+        LikedMessage.like(u2_id, [m1_id])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/users/delete")
+
+            self.assertEqual(c.get(f"/users/{self.u1_id}").status_code, 404)
+
+        self.assertEqual([user.username for user in User.query], ["u2"])
+        self.assertIsNone(Message.query.get(m1_id))
+        self.assertEqual(User.query.get(u2_id).followers, [])
+
+        jobs.PURGE_BATCH = 1
+        try:
+            run_next('purges')
+        finally:
+            jobs.PURGE_BATCH = 1000
+
+        job = Job.query.one()
+        self.assertEqual(job.args, dict(user_id=self.u1_id,
+                                        purged=dict(followers=1)))
+
+        run_pending()
+
+        u2 = User.query.get(u2_id)
+        self.assertEqual((u2.followers_count, u2.following_count,
+                          u2.likes_count), (0, 0, 0))
+        self.assertEqual(db.session.execute(
+            select(func.count()).select_from(User.__table__)).scalar(), 1)
+        self.assertEqual(LikedMessage.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertIsNotNone(Job.query.one().finished_at)
+
+    def test_deleted_user_not_followed_or_liked(self):
+        """test nobody can follow a deleted user, or like their messages"""
+
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add(u2)
+        db.session.commit()
+        u2_id = u2.id
+
+        m1 = Message(text="from u1", user_id=self.u1_id)
+        db.session.add(m1)
+        db.session.commit()
+        m1_id = m1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/users/delete")
+
+        self.assertEqual(Follows.follow(u2_id, [self.u1_id]), [])
+        self.assertEqual(LikedMessage.like(u2_id, [m1_id]), 0)
+        db.session.commit()
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(LikedMessage.query.count(), 0)
+        u2 = User.query.get(u2_id)
+        self.assertEqual((u2.following_count, u2.likes_count), (0, 0))
+
+    def test_metrics(self):
+        """test job runs and queue depth are exposed as metrics"""
+
+        remember.enqueue(value="measured")
+        remember.enqueue(value="waiting", delay=60)
+        db.session.commit()
+        run_pending(metrics=metrics)
+
+        text = self.client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_jobs_total'
+                      '{queue="test",task="remember",outcome="ok"}', text)
+        self.assertIn('warbler_job_wait_seconds_count{queue="test"}', text)
+        self.assertIn('warbler_jobs{queue="test",state="pending"} 1', text)
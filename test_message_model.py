@@ -1,6 +1,6 @@
 """Message model tests."""
 
-from app import app
+from wsgi import app
 import os
 from unittest import TestCase
 from models import LikedMessage, db, User, Message
@@ -93,3 +93,15 @@ class MessageModelTestCase(TestCase):
         """ Test for if message is not liked by user"""
 
         self.assertNotIn(self.test_message2, self.test_user.liked_messages)
+
+    def test_liked_message_ids(self):
+        """test checking which of a batch of messages are liked"""
+
+        self.test_user.liked_messages.append(self.test_message2)
+        db.session.commit()
+
+        batch = [self.test_message.id, self.test_message2.id]
+        self.assertEqual(self.test_user.liked_message_ids(batch),
+                         {self.test_message2.id})
+        self.assertEqual(self.test_user.liked_message_ids([]), set())
+        self.assertEqual(self.test_user2.liked_message_ids(batch), set())
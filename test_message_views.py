@@ -1,6 +1,7 @@
 """Message View tests."""
 
-from app import app, CURR_USER_KEY
+from wsgi import app
+from app import CURR_USER_KEY
 from unittest import TestCase
 from models import db, Message, User, LikedMessage
 import os
@@ -9,6 +10,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATE_LIMITS'] = {}
 
 
 class MessageViewTestCase(TestCase):
@@ -140,6 +142,23 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(self.test_message_id2, msg.message_id)
 
+    def test_add_liked_message_twice(self):
+        """test liking a message again changes nothing"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/messages/{self.test_message_id2}/like")
+            resp = c.post(f"/messages/{self.test_message_id2}/like")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(LikedMessage.query.count(), 1)
+            self.assertEqual(User.query.get(self.testuser.id).likes_count, 1)
+
+            resp = c.post("/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+
     def test_fail_add_liked_message(self):
         """test for fail adding liked message with no valid user"""
 
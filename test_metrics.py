@@ -0,0 +1,78 @@
+"""Request metrics tests."""
+
+from wsgi import app
+from app import metrics
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test the /metrics endpoint."""
+
+    def setUp(self):
+        """Create test client."""
+
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        metrics.token = None
+        metrics.dir = None
+
+    def test_metrics(self):
+        """test requests are recorded per endpoint"""
+
+        with self.client as c:
+            c.get("/users")
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("# TYPE warbler_request_duration_seconds histogram",
+                          text)
+            self.assertIn('warbler_requests_total'
+                          '{endpoint="warbler.list_users",'
+                          'method="GET",status="200"}', text)
+            self.assertIn('warbler_sql_statements_bucket'
+                          '{endpoint="warbler.list_users",le="+Inf"}', text)
+            self.assertIn('warbler_render_duration_seconds_count'
+                          '{endpoint="warbler.list_users"}', text)
+
+    def test_metrics_token(self):
+        """test a configured token is required to read metrics"""
+
+        metrics.token = "secret"
+
+        with self.client as c:
+            self.assertEqual(c.get("/metrics").status_code, 401)
+
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer secret"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_shared_between_workers(self):
+        """test saved metrics of other processes are added up"""
+
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            metrics.dir = metrics_dir
+
+            with open(os.path.join(metrics_dir, "metrics-1.json"), "w") as f:
+                f.write('{"warbler_requests_total": '
+                        '[[["other_worker", "GET", "200"], 7]]}')
+
+            with self.client as c:
+                text = c.get("/metrics").get_data(as_text=True)
+
+            self.assertIn('warbler_requests_total{endpoint="other_worker",'
+                          'method="GET",status="200"} 7', text)
@@ -0,0 +1,109 @@
+"""Keyset pagination tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message
+from pagination import encode_cursor, decode_cursor, paginate
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PaginationTestCase(TestCase):
+    """Test cursor pagination of timelines."""
+
+    def setUp(self):
+        """Create test client, add a user with five messages."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        start = datetime(2021, 9, 1)
+        messages = [Message(text=f"message {i}",
+                            timestamp=start + timedelta(minutes=i),
+                            user_id=user.id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        # newest first
+        self.message_ids = [m.id for m in reversed(messages)]
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def page(self, **kwargs):
+        return paginate(Message.query.filter_by(user_id=self.user_id),
+                        Message.timestamp, Message.id, **kwargs)
+
+    def test_cursor_round_trip(self):
+        """test a cursor decodes back to its key"""
+
+        key = (datetime(2021, 9, 1, 12, 30, 15, 123456), 42)
+        self.assertEqual(decode_cursor(encode_cursor(*key)), key)
+
+        with self.assertRaises(ValueError):
+            decode_cursor("not-a-cursor")
+
+    def test_first_page(self):
+        """test first page has only an older cursor"""
+
+        page = self.page(per_page=2)
+
+        self.assertEqual([m.id for m in page], self.message_ids[:2])
+        self.assertIsNone(page.after)
+        self.assertIsNotNone(page.before)
+
+    def test_walk_older_and_back(self):
+        """test following before cursors to the end and an after cursor back"""
+
+        second = self.page(per_page=2,
+                           before=decode_cursor(self.page(per_page=2).before))
+        last = self.page(per_page=2, before=decode_cursor(second.before))
+
+        self.assertEqual([m.id for m in second], self.message_ids[2:4])
+        self.assertEqual([m.id for m in last], self.message_ids[4:])
+        self.assertIsNone(last.before)
+
+        newer = self.page(per_page=2, after=decode_cursor(last.after))
+        self.assertEqual([m.id for m in newer], self.message_ids[2:4])
+
+    def test_profile_page_size(self):
+        """test the profile page honors limit and links to older messages"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}?limit=2")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("message 4</p>", html)
+            self.assertIn("message 3</p>", html)
+            self.assertNotIn("message 2</p>", html)
+            self.assertIn("Older</a>", html)
+
+    def test_bad_cursor(self):
+        """test a malformed cursor is a bad request"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
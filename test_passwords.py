@@ -0,0 +1,41 @@
+"""Password hasher tests."""
+
+from unittest import TestCase
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test bounded bcrypt hashing."""
+
+    def setUp(self):
+        """Make a fast hasher."""
+
+        self.hasher = PasswordHasher()
+        self.hasher.rounds = 4
+
+    def test_hash_and_check(self):
+        """test a hash checks against its password only"""
+
+        pw_hash = self.hasher.generate_password_hash("secret")
+
+        self.assertTrue(self.hasher.check_password_hash(pw_hash, "secret"))
+        self.assertFalse(self.hasher.check_password_hash(pw_hash, "guess"))
+
+    def test_needs_rehash(self):
+        """test hashes are flagged when the work factor changes"""
+
+        pw_hash = self.hasher.generate_password_hash("secret")
+        self.assertFalse(self.hasher.needs_rehash(pw_hash))
+
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(pw_hash))
+        self.assertTrue(self.hasher.needs_rehash("not a bcrypt hash"))
+
+    def test_busy(self):
+        """test callers are turned away when the queue is full"""
+
+        self.hasher.max_pending = 0
+        self.hasher.timeout = 0.01
+
+        with self.assertRaises(PasswordHasherBusy):
+            self.hasher.generate_password_hash("secret")
@@ -0,0 +1,97 @@
+"""Query count tests: listing pages must not issue a query per row."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, LikedMessage
+from query_counter import max_queries
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 5
+MESSAGES_PER_AUTHOR = 3
+
+
+class QueryCountTestCase(TestCase):
+    """Test that listing routes run a fixed number of queries."""
+
+    def setUp(self):
+        """Create a viewer following several authors with liked messages."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        app.config['STRICT_LOADING'] = True
+
+        self.client = app.test_client()
+
+        viewer = User(username="viewer",
+                      email="viewer@test.com",
+                      password="HASHED_PASSWORD")
+        authors = [User(username=f"author{i}",
+                        email=f"author{i}@test.com",
+                        password="HASHED_PASSWORD")
+                   for i in range(NUM_AUTHORS)]
+        db.session.add_all([viewer, *authors])
+        db.session.commit()
+
+        for author in authors:
+            viewer.following.append(author)
+            viewer.followers.append(author)
+            for i in range(MESSAGES_PER_AUTHOR):
+                author.messages.append(Message(text=f"{author.username} {i}"))
+        db.session.commit()
+
+        for author in authors:
+            db.session.add(LikedMessage(user_id=viewer.id,
+                                        message_id=author.messages[0].id))
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = authors[0].id
+        self.message_id = authors[0].messages[0].id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        app.config['STRICT_LOADING'] = False
+
+    def assertMaxQueries(self, url, limit):
+        """GET `url` as the viewer and check how many queries it ran."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            with max_queries(db.engine, limit):
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_homepage(self):
+        self.assertMaxQueries("/", 3)
+
+    def test_users_show(self):
+        self.assertMaxQueries(f"/users/{self.author_id}", 5)
+
+    def test_render_likes(self):
+        self.assertMaxQueries(f"/users/{self.viewer_id}/likes", 3)
+
+    def test_messages_show(self):
+        self.assertMaxQueries(f"/messages/{self.message_id}", 4)
+
+    def test_list_users(self):
+        self.assertMaxQueries("/users", 3)
+
+    def test_users_followers(self):
+        self.assertMaxQueries(f"/users/{self.viewer_id}/followers", 4)
+
+    def test_show_following(self):
+        self.assertMaxQueries(f"/users/{self.viewer_id}/following", 4)
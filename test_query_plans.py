@@ -0,0 +1,147 @@
+"""Query plan tests: hot pages must not scan whole tables."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+from unittest import TestCase
+from sqlalchemy import text
+from models import db, User, Message, Follows
+from query_counter import QueryCounter
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Big enough that reading a whole table costs more than using an index
+NUM_USERS = 2000
+MESSAGES_PER_USER = 100
+FOLLOWS_PER_USER = 20
+
+# Big tables, which hot queries must reach through an index
+INDEXED_TABLES = {'messages', 'liked_messages', 'follows'}
+
+SEED = [
+    # users 1..NUM_USERS
+    """INSERT INTO users (email, username, password)
+       SELECT 'user' || n || '@test.com', 'user' || n, 'HASHED_PASSWORD'
+       FROM generate_series(1, :users) AS n""",
+    # MESSAGES_PER_USER messages each
+    """INSERT INTO messages (text, timestamp, user_id)
+       SELECT 'message ' || n, now() - n * interval '1 minute', id
+       FROM users, generate_series(1, :messages) AS n""",
+    # each user follows the next FOLLOWS_PER_USER users...
+    """INSERT INTO follows (user_being_followed_id, user_following_id)
+       SELECT followed.id, users.id
+       FROM users JOIN users AS followed
+         ON followed.id BETWEEN users.id + 1 AND users.id + :follows""",
+    # ...and likes the messages of the next one
+    """INSERT INTO liked_messages (user_id, message_id, timestamp)
+       SELECT users.id, messages.id, messages.timestamp
+       FROM users JOIN messages ON messages.user_id = users.id + 1""",
+]
+
+
+def seq_scans(plan):
+    """Tables read with a sequential scan anywhere in an EXPLAIN plan."""
+
+    tables = set()
+    if plan['Node Type'] == 'Seq Scan':
+        tables.add(plan['Relation Name'])
+
+    for child in plan.get('Plans', []):
+        tables |= seq_scans(child)
+
+    return tables
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN every query of the hot pages against a seeded database."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Seed users, messages, follows and likes; update statistics."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for statement in SEED:
+            db.session.execute(text(statement),
+                               dict(users=NUM_USERS, messages=MESSAGES_PER_USER,
+                                    follows=FOLLOWS_PER_USER))
+            # (or the next statement is planned for the tables other tests
+            # left nearly empty, and takes minutes)
+            db.session.execute(text("ANALYZE"))
+
+        User.recount()
+        db.session.commit()
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+
+        cls.user_id = db.session.query(User.id).filter_by(
+            username=f"user{NUM_USERS // 2}").scalar()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Leave the tables empty for other tests."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def assert_indexed(self, url):
+        """Fail if any SELECT `url` runs would scan a whole big table."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with QueryCounter(db.engine) as queries:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+
+        with db.engine.connect() as connection:
+            for statement, parameters in zip(queries.statements,
+                                             queries.parameters):
+                if not statement.lstrip().upper().startswith("SELECT"):
+                    continue
+
+                [[[explained]]] = connection.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + statement, parameters).all()
+                scanned = seq_scans(explained['Plan']) & INDEXED_TABLES
+
+                self.assertFalse(scanned,
+                                 f"{url} scans {scanned}:\n{statement}")
+
+    def test_homepage(self):
+        """test the home timeline uses indexes"""
+
+        self.assert_indexed("/")
+
+    def test_users_show(self):
+        """test a profile uses indexes"""
+
+        self.assert_indexed(f"/users/{self.user_id}")
+
+    def test_render_likes(self):
+        """test a likes page uses indexes"""
+
+        self.assert_indexed(f"/users/{self.user_id}/likes")
+
+    def test_users_followers(self):
+        """test followers and following pages use indexes"""
+
+        self.assert_indexed(f"/users/{self.user_id}/followers")
+        self.assert_indexed(f"/users/{self.user_id}/following")
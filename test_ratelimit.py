@@ -0,0 +1,189 @@
+"""Rate limiting and admission control tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY, rate_limiter
+import multiprocessing
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User, Message
+from passwords import PasswordHasher, PasswordHasherBusy
+from ratelimit import SharedBuckets, HostSlots, parse_rate_limits
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def take_in_child(buckets, queue):
+    queue.put(buckets.take("shared", 2, 60))
+
+
+def acquire_in_child(slots, queue):
+    queue.put(slots.acquire())
+
+
+class SharedStateTestCase(TestCase):
+    """Test buckets and slots are shared between processes."""
+
+    def setUp(self):
+        """Make a directory for the shared files."""
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.fork = multiprocessing.get_context('fork')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def in_child(self, target, shared):
+        queue = self.fork.Queue()
+        child = self.fork.Process(target=target, args=(shared, queue))
+        child.start()
+        child.join()
+
+        return queue.get()
+
+    def test_parse_rate_limits(self):
+        """test RATE_LIMITS parses to {endpoint: (requests, seconds)}"""
+
+        self.assertEqual(parse_rate_limits("a.b=10/60, c.d=1/0.5,"),
+                         {'a.b': (10, 60.0), 'c.d': (1, 0.5)})
+        self.assertEqual(parse_rate_limits(""), {})
+
+    def test_buckets(self):
+        """test a bucket empties, then says how long until it refills"""
+
+        buckets = SharedBuckets(os.path.join(self.dir.name, "buckets"))
+
+        self.assertEqual(buckets.take("shared", 2, 60), 0)
+        self.assertEqual(self.in_child(take_in_child, buckets), 0)
+
+        wait = buckets.take("shared", 2, 60)
+        self.assertGreater(wait, 29)
+        self.assertLessEqual(wait, 30)
+
+        self.assertEqual(buckets.take("other", 2, 60), 0)
+
+    def test_host_slots(self):
+        """test slots are capped across processes, and freed on release"""
+
+        slots = HostSlots(os.path.join(self.dir.name, "slots"), 2)
+
+        first = slots.acquire()
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(self.in_child(acquire_in_child, slots))
+
+        second = slots.acquire()
+        self.assertIsNotNone(second)
+        self.assertIsNone(slots.acquire())
+        self.assertIsNone(self.in_child(acquire_in_child, slots))
+
+        slots.release(first)
+        self.assertEqual(self.in_child(acquire_in_child, slots), first)
+
+    def test_password_hasher_sheds_load(self):
+        """test hashing fails fast once the host's slots are taken"""
+
+        hasher = PasswordHasher()
+        hasher.rounds = 4
+        hasher.host_slots = HostSlots(os.path.join(self.dir.name, "slots"),
+                                      1)
+
+        self.assertTrue(hasher.generate_password_hash("secret"))
+
+        slot = hasher.host_slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.generate_password_hash("secret")
+
+        hasher.host_slots.release(slot)
+        self.assertTrue(hasher.generate_password_hash("secret"))
+
+
+class RateLimiterTestCase(TestCase):
+    """Test posts over a route's limit are turned away."""
+
+    def setUp(self):
+        """Create test client and a user; limit posting messages."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.buckets = rate_limiter.buckets
+        rate_limiter.buckets = SharedBuckets(
+            os.path.join(self.dir.name, "buckets"))
+
+        self.limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMITS'] = {'warbler.messages_add': (2, 60),
+                                     'api.change_likes': (1, 60)}
+
+    def tearDown(self):
+        """Clean up any fouled transaction; restore the limits."""
+
+        db.session.rollback()
+        rate_limiter.buckets = self.buckets
+        app.config['RATE_LIMITS'] = self.limits
+        self.dir.cleanup()
+
+    def post_message(self, c, ip):
+        return c.post("/messages/new", data={"text": "Hello"},
+                      environ_base={'REMOTE_ADDR': ip})
+
+    def test_limited_per_ip(self):
+        """test a client is limited, but not others, and not GETs"""
+
+        with self.client as c:
+            for _ in range(2):
+                self.assertEqual(self.post_message(c, "10.0.0.1").status_code,
+                                 302)
+
+            resp = self.post_message(c, "10.0.0.1")
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers['Retry-After'], "30")
+
+            self.assertEqual(self.post_message(c, "10.0.0.2").status_code,
+                             302)
+            self.assertEqual(c.get("/messages/new",
+                                   environ_base={'REMOTE_ADDR': "10.0.0.1"}
+                                   ).status_code, 302)
+
+    def test_limited_per_user(self):
+        """test a user is limited whichever address they post from"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(self.post_message(c, "10.0.0.1").status_code,
+                             302)
+            self.assertEqual(self.post_message(c, "10.0.0.2").status_code,
+                             302)
+            self.assertEqual(self.post_message(c, "10.0.0.3").status_code,
+                             429)
+
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_api_429(self):
+        """test the JSON API's 429s are JSON, with Retry-After"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/api/v1/likes", json={"like": []})
+            resp = c.post("/api/v1/likes", json={"like": []})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.json['error']['status'], 429)
+            self.assertEqual(resp.headers['Retry-After'], "60")
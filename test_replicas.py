@@ -0,0 +1,94 @@
+"""Read-replica routing tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+import time
+from unittest import TestCase
+from models import db, User
+from query_counter import QueryCounter
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test GETs read from the replica and writers read from the primary."""
+
+    def setUp(self):
+        """Use the test database as its own replica; create two users."""
+
+        # a second engine on the same database stands in for the replica
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+
+        User.query.delete()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+        self.primary = QueryCounter(db.engine)
+        self.replica = QueryCounter(db.get_engine(app, 'replica'))
+
+    def tearDown(self):
+        """Clean up any fouled transaction; go back to a single database."""
+
+        db.session.rollback()
+        app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_get_reads_replica(self):
+        """test GET requests only read from the replica"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.primary, self.replica:
+                resp = c.get(f"/users/{self.u2_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(self.replica.count, 0)
+        self.assertEqual(self.primary.count, 0)
+
+    def test_writer_pinned_to_primary(self):
+        """test a write goes to the primary and pins the user there"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.primary, self.replica:
+                c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertEqual(self.replica.count, 0)
+            self.assertGreater(self.primary.count, 0)
+
+            with self.replica:
+                resp = c.get(f"/users/{self.u1_id}/following")
+
+            self.assertIn("@u2", resp.get_data(as_text=True))
+            self.assertEqual(self.replica.count, 0)
+
+    def test_pin_expires(self):
+        """test a pinned user goes back to the replica after the window"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                sess['primary_until'] = time.time() - 1
+
+            with self.replica:
+                c.get(f"/users/{self.u2_id}")
+
+        self.assertGreater(self.replica.count, 0)
@@ -0,0 +1,157 @@
+"""Server-side session and viewer snapshot tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY, session_store
+import os
+import time
+from unittest import TestCase
+from models import db, User, Message
+from query_counter import max_queries
+from sessions import SESSION_ID
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATE_LIMITS'] = {}
+
+
+class SessionsTestCase(TestCase):
+    """Test sessions are kept server-side, and viewers cached."""
+
+    def setUp(self):
+        """Create test client and a user."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User.signup(username="u1", email="u1@test.com",
+                         password="password", image_url=None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def session_id(self, client):
+        cookies = [cookie for cookie in client.cookie_jar
+                   if cookie.name == app.session_cookie_name]
+        return cookies[0].value if cookies else None
+
+    def test_cookie_holds_only_session_id(self):
+        """test the session is saved server-side, and deleted on logout"""
+
+        with self.client as c:
+            c.post("/login", data={"username": "u1", "password": "password"})
+
+            sid = self.session_id(c)
+            self.assertRegex(sid, SESSION_ID)
+            self.assertEqual(session_store.load(sid)[CURR_USER_KEY],
+                             self.u1_id)
+
+            c.post("/logout", follow_redirects=True)
+
+            self.assertIsNone(session_store.load(sid))
+
+    def test_new_session_id_on_login_and_logout(self):
+        """test a session id known before login (or logout) is no use after"""
+
+        with self.client as c:
+            c.get("/messages/new", follow_redirects=True)
+            with c.session_transaction() as sess:
+                sess["planted"] = True
+            before = self.session_id(c)
+
+            c.post("/login", data={"username": "u1", "password": "password"})
+            logged_in = self.session_id(c)
+
+            self.assertNotEqual(logged_in, before)
+            self.assertIsNone(session_store.load(before, anonymous=True))
+            self.assertTrue(session_store.load(logged_in)["planted"])
+
+            c.post("/logout")
+            after = self.session_id(c)
+
+            self.assertNotIn(after, [before, logged_in])
+            self.assertIsNone(session_store.load(logged_in))
+
+        with self.client as c:
+            c.set_cookie("localhost", app.session_cookie_name, before)
+            self.assertEqual(c.get("/messages/new").status_code, 302)
+
+    def test_anonymous_session_expires_soon(self):
+        """test sessions nobody's logged in with are kept briefly, apart"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess["csrf_token"] = "token"
+            sid = self.session_id(c)
+
+            self.assertIsNone(session_store.load(sid))
+            self.assertEqual(session_store.load(sid, anonymous=True),
+                             {"csrf_token": "token"})
+
+            old = time.time() - session_store.anonymous_lifetime - 1
+            os.utime(session_store.session_path(sid, anonymous=True),
+                     (old, old))
+
+            self.assertIsNone(session_store.load(sid, anonymous=True))
+
+    def test_bad_or_expired_session(self):
+        """test unknown, malformed and expired session ids are ignored"""
+
+        sid = session_store.save({CURR_USER_KEY: self.u1_id})
+
+        for cookie in ["x" * 43, "../" * 15, sid]:
+            with self.client as c:
+                c.set_cookie("localhost", app.session_cookie_name, cookie)
+
+                if cookie == sid:
+                    self.assertEqual(c.get("/messages/new").status_code, 200)
+                    old = time.time() - session_store.lifetime - 1
+                    os.utime(session_store.session_path(sid), (old, old))
+
+                self.assertEqual(c.get("/messages/new").status_code, 302)
+
+    def test_viewer_cached(self):
+        """test pages only showing the nav bar don't load the user"""
+
+        session_store.forget_viewer(self.u1_id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with max_queries(db.engine, 1):
+                c.get("/messages/new")
+
+            with max_queries(db.engine, 0):
+                resp = c.get("/messages/new")
+
+            self.assertIn('alt="u1"', resp.get_data(as_text=True))
+
+    def test_viewer_forgotten_on_profile_edit(self):
+        """test a profile edit shows in the nav bar at once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/messages/new")
+            c.post("/users/profile", data={
+                "username": "u1edit",
+                "email": "u1@test.com",
+                "image_url": "/static/images/edited.png",
+                "password": "password",
+            })
+            html = c.get("/messages/new").get_data(as_text=True)
+
+        self.assertIn('alt="u1edit"', html)
+        self.assertIn("edited.png", html)
+        self.assertEqual(session_store.viewer(self.u1_id).username, "u1edit")
@@ -0,0 +1,213 @@
+"""Push-model home timeline tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User, Message, Follows, TimelineEntry, Job
+from jobs import run_pending
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATE_LIMITS'] = {}
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        app.config['TIMELINE_FANOUT'] = True
+        app.config['TIMELINE_INBOX_SIZE'] = 3
+
+        self.client = app.test_client()
+
+        self.author = User(username="author",
+                           email="author@test.com",
+                           password="HASHED_PASSWORD")
+        self.reader = User(username="reader",
+                           email="reader@test.com",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT'] = False
+
+    def inbox(self, user_id):
+        """Message ids in a user's inbox, newest first."""
+
+        return [entry.message_id for entry in (TimelineEntry
+                                               .query
+                                               .filter_by(user_id=user_id)
+                                               .order_by(TimelineEntry.timestamp.desc()))]
+
+    def post(self, user_id, text):
+        """Post a message through the app as `user_id`, and fan it out."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/messages/new", data={"text": text})
+
+        run_pending()
+
+        return Message.query.filter_by(text=text).one().id
+
+    def test_fan_out_to_followers(self):
+        """test posting delivers to the author and their followers"""
+
+        self.author.followers.append(self.reader)
+        db.session.commit()
+
+        message_id = self.post(self.author_id, "hello followers")
+
+        self.assertEqual(self.inbox(self.author_id), [message_id])
+        self.assertEqual(self.inbox(self.reader_id), [message_id])
+
+    def test_inbox_is_bounded(self):
+        """test inbox only keeps the newest TIMELINE_INBOX_SIZE entries"""
+
+        message_ids = [self.post(self.author_id, f"message {i}")
+                       for i in range(5)]
+
+        self.assertEqual(self.inbox(self.author_id),
+                         list(reversed(message_ids))[:3])
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        """test following backfills an inbox and unfollowing cleans it up"""
+
+        message_id = self.post(self.author_id, "before the follow")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(self.inbox(self.reader_id), [message_id])
+
+            c.post(f"/users/stop-following/{self.author_id}")
+            self.assertEqual(self.inbox(self.reader_id), [])
+
+    def test_follow_before_fan_out_job(self):
+        """test a follow backfilling a message before its fan-out job runs"""
+
+        follower = User(username="follower", email="follower@test.com",
+                        password="HASHED_PASSWORD")
+        db.session.add(follower)
+        db.session.commit()
+        follower_id = follower.id
+        Follows.follow(follower_id, [self.author_id])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            c.post("/messages/new", data={"text": "raced"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            c.post(f"/users/follow/{self.author_id}")
+
+        message_id = Message.query.filter_by(text="raced").one().id
+        self.assertEqual(self.inbox(self.reader_id), [message_id])
+
+        run_pending()
+
+        self.assertIsNone(Job.query.filter(Job.failed_at.isnot(None)).first())
+        self.assertEqual(self.inbox(self.author_id), [message_id])
+        self.assertEqual(self.inbox(self.reader_id), [message_id])
+        self.assertEqual(self.inbox(follower_id), [message_id])
+
+    def test_homepage_reads_inbox(self):
+        """test the home page renders messages from the inbox"""
+
+        self.author.followers.append(self.reader)
+        db.session.commit()
+        self.post(self.author_id, "from the inbox")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("from the inbox</p>", html)
+
+    def test_paging_past_a_full_inbox(self):
+        """test paging on past an inbox ending at a page boundary"""
+
+        app.config['TIMELINE_INBOX_SIZE'] = 4
+        message_ids = [self.post(self.author_id, f"message {i}")
+                       for i in range(6)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            seen, cursors = [], [""]
+            while cursors[-1] is not None and len(cursors) < 5:
+                page = c.get("/api/v1/timeline",
+                             query_string={"limit": 2,
+                                           "before": cursors[-1]}).json
+                seen += [message['id'] for message in page['messages']]
+                cursors.append(page['before'])
+
+            # (the page ending the inbox still links to older messages)
+            html = c.get("/", query_string={"limit": 2,
+                                            "before": cursors[1]}
+                         ).get_data(as_text=True)
+
+        self.assertEqual(len(self.inbox(self.author_id)), 4)
+        self.assertEqual(seen, list(reversed(message_ids)))
+        self.assertIn("before=", html)
+
+    def test_fan_out_on_sqlite(self):
+        """test fan-out delivers on SQLite too"""
+
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        directory = tempfile.TemporaryDirectory()
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = (
+            f"sqlite:///{directory.name}/warbler.db")
+        try:
+            db.create_all()
+            author = User(username="author", email="author@test.com",
+                          password="HASHED_PASSWORD")
+            reader = User(username="reader", email="reader@test.com",
+                          password="HASHED_PASSWORD")
+            db.session.add_all([author, reader])
+            db.session.commit()
+            Follows.follow(reader.id, [author.id])
+
+            message = Message(text="on SQLite", user_id=author.id)
+            db.session.add(message)
+            db.session.flush()
+            TimelineEntry.fan_out(message, 3)
+            db.session.commit()
+
+            self.assertEqual(self.inbox(author.id), [message.id])
+            self.assertEqual(self.inbox(reader.id), [message.id])
+        finally:
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = uri
+            directory.cleanup()
@@ -0,0 +1,97 @@
+"""Traffic recording and replay tests."""
+
+from wsgi import app
+from app import CURR_USER_KEY, traffic
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User, Message, LikedMessage
+from traffic import load_traffic, replay, summarize
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATE_LIMITS'] = {}
+
+
+class TrafficTestCase(TestCase):
+    """Test recording and replaying requests."""
+
+    def setUp(self):
+        """Create test client and users, one with a message."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        m1 = Message(text="hello", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction and stop recording."""
+
+        db.session.rollback()
+        traffic.path = None
+
+    def test_record(self):
+        """test requests are recorded with their user, passwords blanked"""
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            traffic.path = os.path.join(log_dir, "traffic.jsonl")
+
+            with self.client as c:
+                c.post("/login", data={"username": "u1",
+                                       "password": "secret"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.get(f"/users/{self.u2_id}?page=2")
+
+            login, profile = load_traffic(traffic.path)
+
+        self.assertEqual(login['method'], "POST")
+        self.assertIsNone(login['user_id'])
+        self.assertEqual(login['form'], {"username": "u1", "password": ""})
+
+        self.assertEqual(profile['path'], f"/users/{self.u2_id}?page=2")
+        self.assertEqual(profile['user_id'], self.u1_id)
+        self.assertEqual(profile['status'], 200)
+
+    def test_replay(self):
+        """test replayed requests run as their user and are summarized"""
+
+        records = [
+            dict(method="GET", path="/", user_id=self.u1_id, form={}),
+            dict(method="GET", path=f"/users/{self.u2_id}", user_id=None,
+                 form={}),
+            dict(method="POST", path=f"/messages/{self.m1_id}/like",
+                 user_id=self.u1_id, form={}),
+        ]
+
+        results, seconds = replay(app, records,
+                                  concurrency=2, session_key=CURR_USER_KEY)
+        rows = {row['route']: row for row in summarize(results, seconds)}
+
+        self.assertEqual(rows['total']['requests'], 3)
+        self.assertEqual(rows['total']['errors'], 0)
+        self.assertEqual(rows['warbler.add_liked_message']['requests'], 1)
+        self.assertGreater(rows['warbler.homepage']['p99'], 0)
+
+        self.assertIsNotNone(
+            LikedMessage.query.get((self.m1_id, self.u1_id)))
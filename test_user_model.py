@@ -1,9 +1,9 @@
 """User model tests."""
 
-from app import app
+from wsgi import app
 import os
 from unittest import TestCase
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, bcrypt
 from sqlalchemy import exc
 
 
@@ -108,6 +108,21 @@ class UserModelTestCase(TestCase):
         resp = self.test_user.is_followed_by(self.test_user2)
         self.assertEqual(False, resp)
 
+    def test_user_follow_states(self):
+        """test resolving follow state for a batch of users"""
+
+        test_user3 = User.signup(**TEST_USER_DATA3)
+        self.test_user.following.append(self.test_user2)
+        self.test_user.followers.append(test_user3)
+        db.session.commit()
+
+        following_ids, follower_ids = self.test_user.follow_states(
+            [self.test_user2.id, test_user3.id])
+
+        self.assertEqual(following_ids, {self.test_user2.id})
+        self.assertEqual(follower_ids, {test_user3.id})
+        self.assertEqual(self.test_user.follow_states([]), (set(), set()))
+
     def test_user_signup(self):
         """test if a new user is successfully created when given valid credentials"""
 
@@ -138,3 +153,46 @@ class UserModelTestCase(TestCase):
 
         resp = User.authenticate("testuser2", "HASHED_PASSWORDNOTTHIS")
         self.assertFalse(resp)
+
+    def test_user_adjust_counters(self):
+        """test counters can be adjusted for several users at once"""
+
+        User.adjust_counters([self.test_user.id, self.test_user2.id],
+                             followers_count=2, likes_count=1)
+        User.adjust_counters(self.test_user.id, followers_count=-1)
+        db.session.commit()
+
+        self.assertEqual(self.test_user.followers_count, 1)
+        self.assertEqual(self.test_user2.followers_count, 2)
+        self.assertEqual(self.test_user2.likes_count, 1)
+
+    def test_user_recount(self):
+        """test recount rebuilds counters from the source tables"""
+
+        self.test_user.following.append(self.test_user2)
+        self.test_user.messages.append(Message(text="counted"))
+        User.adjust_counters(self.test_user2.id, following_count=5)
+        db.session.flush()
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(self.test_user.messages_count, 1)
+        self.assertEqual(self.test_user.following_count, 1)
+        self.assertEqual(self.test_user2.followers_count, 1)
+        self.assertEqual(self.test_user2.following_count, 0)
+
+    def test_user_authenticate_upgrades_hash(self):
+        """test a hash with an outdated work factor is upgraded at login"""
+
+        old_rounds = bcrypt.rounds
+        bcrypt.rounds = 4
+
+        try:
+            user = User.authenticate("testuser2", "HASHED_PASSWORD2")
+            db.session.commit()
+
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertTrue(User.authenticate("testuser2", "HASHED_PASSWORD2"))
+        finally:
+            bcrypt.rounds = old_rounds
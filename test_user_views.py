@@ -1,7 +1,9 @@
 """User View tests."""
 
-from app import app, CURR_USER_KEY
+from wsgi import app
+from app import CURR_USER_KEY
 import os
+import tempfile
 from unittest import TestCase
 from models import db, Message, User
 
@@ -10,6 +12,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATE_LIMITS'] = {}
 
 
 class UserViewTestCase(TestCase):
@@ -104,6 +107,35 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser", html)
             self.assertIn("testuser2", html)
 
+    def test_search_users(self):
+        """test searching users by username and bio"""
+
+        self.testuser2.bio = "Birdwatcher and warbler enthusiast"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users?q=birdwatch')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@testuser2</p>", html)
+            self.assertNotIn("@testuser</p>", html)
+
+            resp = c.get('/users?q=nobodyhere')
+            html = resp.get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_autocomplete_users(self):
+        """test username prefix autocomplete"""
+
+        with self.client as c:
+            resp = c.get('/users/autocomplete?q=TESTUSER2')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [user["username"] for user in resp.json["users"]],
+                ["testuser2"])
+
     def test_show_individual_user(self):
         """test to show individual user info page"""
 
@@ -184,6 +216,55 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser2", html)
             self.assertIn("You are following these people</h1>", html)
 
+    def test_user_follow_counters(self):
+        """test following and unfollowing keep both users' counters current"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user_id
+
+            c.post(f'/users/follow/{self.test_user2_id}')
+            user = User.query.get(self.test_user_id)
+            user2 = User.query.get(self.test_user2_id)
+            self.assertEqual(user.following_count, 1)
+            self.assertEqual(user2.followers_count, 1)
+
+            c.post(f'/users/stop-following/{self.test_user2_id}')
+            user = User.query.get(self.test_user_id)
+            user2 = User.query.get(self.test_user2_id)
+            self.assertEqual(user.following_count, 0)
+            self.assertEqual(user2.followers_count, 0)
+
+    def test_user_follow_twice(self):
+        """test following again changes nothing, and missing users 404"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user_id
+
+            c.post(f'/users/follow/{self.test_user2_id}')
+            resp = c.post(f'/users/follow/{self.test_user2_id}')
+            user2 = User.query.get(self.test_user2_id)
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(user2.followers_count, 1)
+
+            resp = c.post('/users/stop-following/0')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_import_follows(self):
+        """test the import-follows command"""
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(f"{self.test_user2_id}\n0\n\n{self.test_user_id}\n")
+            f.flush()
+
+            result = app.test_cli_runner().invoke(
+                args=["import-follows", str(self.test_user_id), f.name])
+
+        self.assertIn("Followed 1 of 3 users.", result.output)
+        self.assertEqual(User.query.get(self.test_user_id).following_count, 1)
+
     def test_user_fail_add_follow(self):
         """test if invalid user could follow another user"""
 
@@ -291,6 +372,28 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("testuser2", html)
             self.assertIn("Sign me up!</button>", html)
 
+    def test_deleted_user_hidden(self):
+        """test a deleted user can't log in or be found before the purge"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+            c.post('/users/delete')
+
+            resp = c.post("/login", data={
+                "username": "testuser2",
+                "password": "testuser2"
+            }, follow_redirects=True)
+            self.assertIn("Invalid credentials.", resp.get_data(as_text=True))
+
+            resp = c.get("/users?q=testuser")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@testuser<", html)
+            self.assertNotIn("@testuser2", html)
+
+            resp = c.get(f"/api/v1/users/{self.test_user2_id}")
+            self.assertEqual(resp.status_code, 404)
+
     def test_fail_delete_user_profile(self):
         """test to delete user's profile page"""
 
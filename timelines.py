@@ -0,0 +1,104 @@
+"""Home timelines: a user's messages and those of everyone they follow.
+
+With TIMELINE_FANOUT on, messages are read from the user's materialized
+inbox instead of being gathered from every followed user. Inboxes are
+bounded, so paging past the end of one falls back to the pull-model query.
+
+The pull-model query only considers each author's newest few messages (past
+the cursor): a page can't hold more than a page from any one author. On
+Postgres these are found with a LATERAL join, one short index range scan
+per followed user, however much each of them has posted.
+"""
+
+from flask import current_app
+from sqlalchemy import literal, select, true, tuple_
+from sqlalchemy.orm import aliased
+
+from models import db, Message, Follows, TimelineEntry
+from pagination import paginate
+
+
+def home_timeline(query, user_id, before=None, after=None, per_page=20):
+    """Get one page of `user_id`'s home timeline.
+
+    `query` selects what to return for each message: e.g. `Message.query`
+    with loader options, or a query of Message (and joined) columns.
+    """
+
+    if current_app.config['TIMELINE_FANOUT']:
+        messages = paginate(query
+                            .join(TimelineEntry,
+                                  TimelineEntry.message_id == Message.id)
+                            .filter(TimelineEntry.user_id == user_id),
+                            TimelineEntry.timestamp, TimelineEntry.message_id,
+                            before=before, after=after, per_page=per_page)
+
+        if len(messages) == per_page:
+            # (an inbox ending with this page may have had older messages
+            # trimmed from it: the next page falls back to the pull model)
+            if not messages.before and not after and TimelineEntry.is_full(
+                    user_id, current_app.config['TIMELINE_INBOX_SIZE']):
+                messages.before = messages.last
+            return messages
+
+        if not before:
+            return messages
+
+    # (a single IN, rather than `= user_id OR IN (...)`, so each author's
+    # messages are read from the index on messages (user_id, timestamp, id))
+    author_ids = (select(Follows.user_being_followed_id.label('user_id'))
+                  .where(Follows.user_following_id == user_id)
+                  .union_all(select(literal(user_id))))
+
+    if db.engine.dialect.name == 'postgresql':
+        condition = Message.id.in_(
+            recent_message_ids(author_ids, before, after, per_page + 1))
+    else:
+        condition = Message.user_id.in_(author_ids)
+
+    return paginate(query.filter(condition),
+                    Message.timestamp, Message.id,
+                    before=before, after=after, per_page=per_page)
+
+
+def recent_message_ids(author_ids, before, after, limit):
+    """Select the ids of each author's `limit` messages nearest the cursor.
+
+    These are the newest messages older than `before` (or the oldest newer
+    than `after`): every message a page from that cursor could show.
+    Postgres only.
+    """
+
+    authors = author_ids.subquery('authors')
+    message = aliased(Message, name='recent_messages')
+    key = tuple_(message.timestamp, message.id)
+
+    recent = select(message.id).where(message.user_id == authors.c.user_id)
+    if after:
+        recent = (recent
+                  .where(key > tuple_(*after))
+                  .order_by(message.timestamp.asc(), message.id.asc()))
+    else:
+        if before:
+            recent = recent.where(key < tuple_(*before))
+        recent = recent.order_by(message.timestamp.desc(), message.id.desc())
+    recent = recent.limit(limit).lateral('recent')
+
+    return select(recent.c.id).select_from(authors).join(recent, true())
+
+
+def update_inbox(user_id, followed_ids=(), unfollowed_ids=()):
+    """Bring a user's inbox up to date after they (un)followed users.
+
+    Does nothing unless TIMELINE_FANOUT is on.
+    """
+
+    if not current_app.config['TIMELINE_FANOUT']:
+        return
+
+    size = current_app.config['TIMELINE_INBOX_SIZE']
+
+    if unfollowed_ids or len(followed_ids) > 1:
+        TimelineEntry.rebuild(user_id, size)
+    elif followed_ids:
+        TimelineEntry.backfill(user_id, followed_ids[0], size)
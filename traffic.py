@@ -0,0 +1,226 @@
+"""Recording and replaying Warbler traffic, for load tests.
+
+Recorded traffic is JSON lines, one request per line:
+
+    {"ts": 1634567890.12, "method": "POST", "path": "/messages/5/like",
+     "user_id": 42, "form": {}, "status": 302, "ms": 8.1}
+
+`user_id` is the logged-in user (or null), `form` the posted form fields.
+CSRF tokens aren't recorded and password fields are blanked, so a recording
+is safe to share. `status` and `ms` are what the app answered at the time.
+
+Set TRAFFIC_LOG to a file to record everything a process serves (static
+files and /metrics excepted); each process appends to it a line at a time.
+
+`replay` sends recorded requests to the app's test client, or to a running
+server at a base URL, from `concurrency` threads as fast as they go. Each
+request is sent as its recorded user, with a session saved in the app's
+SESSION_DIR (see sessions.py), so the server must share that directory, and
+must run with WTF_CSRF_ENABLED=0 for form posts to get through. `summarize` reports
+per-route throughput and latency percentiles.
+"""
+
+import http.client
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from flask import g, request, session
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+REDACTED_FIELDS = {'password'}
+UNRECORDED_FIELDS = {'csrf_token'}
+UNRECORDED_ENDPOINTS = {'static', 'assets', 'metrics'}
+
+
+class TrafficRecorder:
+    """Appends every request a process serves to TRAFFIC_LOG."""
+
+    def __init__(self, app=None, session_key="curr_user"):
+        self.session_key = session_key
+        self.path = None
+
+        self._file = None
+        self._file_pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install request hooks (they do nothing unless TRAFFIC_LOG is set)."""
+
+        app.config.setdefault('TRAFFIC_LOG', None)
+        self.path = app.config['TRAFFIC_LOG']
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        if self.path and request.endpoint not in UNRECORDED_ENDPOINTS:
+            # taken before the view runs, which may log the user in or out
+            g.traffic = dict(
+                ts=time.time(),
+                method=request.method,
+                path=request.full_path.rstrip("?"),
+                user_id=session.get(self.session_key),
+                form={key: "" if key in REDACTED_FIELDS else value
+                      for key, value in request.form.items()
+                      if key not in UNRECORDED_FIELDS},
+            )
+
+    def _finish_request(self, response):
+        if 'traffic' in g and self.path:
+            record = g.traffic
+            record['status'] = response.status_code
+            record['ms'] = round((time.time() - record['ts']) * 1000, 2)
+            self.write(record)
+
+        return response
+
+    def write(self, record):
+        """Append one record to the log."""
+
+        line = json.dumps(record) + "\n"
+
+        with self._lock:
+            # each process opens the file itself, for appending
+            if self._file is None or self._file_pid != os.getpid():
+                self._file = open(self.path, "a")
+                self._file_pid = os.getpid()
+
+            self._file.write(line)
+            self._file.flush()
+
+
+def load_traffic(path):
+    """Read recorded requests from a JSON lines file."""
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(app, records, target=None, concurrency=8, session_key="curr_user"):
+    """Send `records` to `app` (or the server at URL `target`).
+
+    Returns (results, seconds), where results are (endpoint, status,
+    seconds) for each request, in completion order.
+    """
+
+    urls = app.url_map.bind("localhost")
+    local = threading.local()
+    cookies = {}
+
+    def cookie(user_id):
+        if user_id not in cookies:
+            cookies[user_id] = (
+                f"{app.session_cookie_name}="
+                f"{app.session_interface.save({session_key: user_id})}")
+        return cookies[user_id]
+
+    def endpoint(record):
+        try:
+            return urls.match(urlsplit(record['path']).path,
+                              record['method'])[0]
+        except (HTTPException, RequestRedirect):
+            return "none"
+
+    def send(record):
+        headers = {}
+        if record.get('user_id') is not None:
+            headers['Cookie'] = cookie(record['user_id'])
+
+        start = time.perf_counter()
+        if target:
+            status = send_http(target, local, record, headers)
+        else:
+            if not hasattr(local, 'client'):
+                local.client = app.test_client(use_cookies=False)
+            status = local.client.open(
+                record['path'], method=record['method'],
+                data=record.get('form') or None, headers=headers).status_code
+
+        return endpoint(record), status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, records))
+
+    return results, time.perf_counter() - start
+
+
+def send_http(target, local, record, headers):
+    """Send one record to a server over HTTP, without following redirects."""
+
+    if not hasattr(local, 'connection'):
+        url = urlsplit(target)
+        local.connection = http.client.HTTPConnection(
+            url.hostname, url.port or 80, timeout=30)
+
+    body = None
+    if record.get('form'):
+        body = urlencode(record['form'])
+        headers['Content-Type'] = "application/x-www-form-urlencoded"
+
+    try:
+        local.connection.request(record['method'], record['path'],
+                                 body=body, headers=headers)
+        response = local.connection.getresponse()
+        response.read()
+    except (OSError, http.client.HTTPException):
+        # the server closed the connection; try once more on a new one
+        local.connection.close()
+        local.connection.request(record['method'], record['path'],
+                                 body=body, headers=headers)
+        response = local.connection.getresponse()
+        response.read()
+
+    if response.getheader('Connection', '').lower() == 'close':
+        local.connection.close()
+
+    return response.status
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return 0.0
+
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(results, seconds):
+    """Per-route statistics of a replay, busiest route first.
+
+    Returns dicts of route, requests, errors (5xx), rps and p50/p95/p99 in
+    milliseconds. The last one is the total over all routes.
+    """
+
+    routes = {}
+    for route, status, elapsed in results:
+        routes.setdefault(route, []).append((status, elapsed))
+
+    def stats(route, samples):
+        times = sorted(elapsed * 1000 for _, elapsed in samples)
+        return dict(
+            route=route,
+            requests=len(samples),
+            errors=sum(status >= 500 for status, _ in samples),
+            rps=len(samples) / seconds if seconds else 0.0,
+            p50=percentile(times, 50),
+            p95=percentile(times, 95),
+            p99=percentile(times, 99),
+        )
+
+    rows = [stats(route, samples) for route, samples in routes.items()]
+    rows.sort(key=lambda row: -row['requests'])
+    rows.append(stats("total", [(status, elapsed)
+                                for _, status, elapsed in results]))
+    return rows
@@ -0,0 +1,14 @@
+"""The Warbler app, for WSGI servers and `flask`.
+
+    gunicorn --preload wsgi:app
+"""
+
+from app import create_app
+from models import db
+
+app = create_app()
+
+# Build the engines (which doesn't connect) now, so that with --preload the
+# workers inherit them rather than each loading the database driver
+for bind in [None, *(app.config['SQLALCHEMY_BINDS'] or ())]:
+    db.get_engine(app, bind)